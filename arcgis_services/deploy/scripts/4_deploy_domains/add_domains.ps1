@@ -1,3 +1,9 @@
+param(
+    [int]$Workers = 1,
+    [int]$PerServer = 1,
+    [switch]$Resume
+)
+
 $scriptPath = $MyInvocation.MyCommand.Path
 $scriptDir = Split-Path $scriptPath -Parent
 
@@ -8,7 +14,9 @@ $scriptFile  = Join-Path -Path $scriptDir -ChildPath 'add_domains.py'
 
 Write-Output "Script to execute : $scriptFile"
 
-$proc = Start-Process python -ArgumentList $scriptFile -NoNewWindow -PassThru
+$arguments = @($scriptFile, "--workers", $Workers, "--per-server", $PerServer)
+if ($Resume) { $arguments += "--resume" }
+$proc = Start-Process python -ArgumentList $arguments -NoNewWindow -PassThru
 $handle = $proc.Handle # cache proc.Handle
 $proc.WaitForExit();
 
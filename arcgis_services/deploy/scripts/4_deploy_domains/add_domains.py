@@ -1,252 +1,966 @@
 # RSA 2022
 
-# TODO:
-# Read from secret!
+# Passwords come from DEPLOY_PASSWORD_<USERNAME>, DEPLOY_SECRETS_FILE or a
+# prompt, once per connection (see deploy_common/connections.py)
 
 # Notes
 #---------
 # This can run from the built machine
+# Set DEPLOY_BACKEND=sqlite:<path> to run against a local stand-in (see deploy_common/backends.py)
+
+import configparser
+import contextlib
+import itertools
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from deploy_common.backends import MergeNotSupported, domain_lock, get_backend
+from deploy_common.before_images import BeforeImages, get_before_images, set_before_images
+from deploy_common.journal import Journal, digest, get_journal, set_journal
+from deploy_common.metrics import get_metrics, profiled
+from deploy_common.plan import DEFAULT_CHUNK_SIZE, apply_inserts, log_plan
+from deploy_common.validation import Problems, ValidationError, check_fields
+from deploy_common.snapshot import SnapshotCache, get_snapshots, mark_written, read_rows, recheck, set_snapshots, source_label
+from deploy_common.spill import SpillDict
+from deploy_common.views import ViewRegistry, get_views, set_views
+from deploy_common.where import equals, match_clauses
+
+from code_source import section_entries, source_path
+from domain_hashes import content_hashes, load_state, save_state
+
+
+logger = logging.getLogger("Add domain entries.py")
+
+DOMAIN_TABLE = "GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS"
+LOOKUP_TABLE_PREFIX = "GLOBAL_EXPOSURE.dbo.Lookup_"
 
 
 # Functions 
 
 
-# SQL clause functions 
+# arcpy search/update logic 
+
+def insert_row(row: tuple, fields: tuple, target_layer: object) -> int:
+    """
+    Insert one row
 
-def build_clause(field: str, value: str) -> str:
-    """ 
+    :returns: OBJECTID of the new row
     """
-    clause = "{0} = '{1}'".format(field, value)
 
-    return clause
+    cursor = get_backend().insert_cursor(target_layer, fields)
 
+    oid = cursor.insertRow(row)
 
-def concat_clauses(clauses: list, andor: str) -> str:
-    """ 
-    Build arcpy-friendly where clause
-    
+    logger.info("Inserted {0}".format(row))
+
+    del cursor 
+    # del target_layer 
+
+    return oid
+
+
+def row_key(row) -> tuple:
     """
-    andor.strip()
-    andor = andor.upper()
-    andor = " {} ".format(andor) # pad and/or
-    big_clause = andor.join(clauses)
+    Normalise a row into a set key the way SQL Server compares it
 
-    return big_clause
+    The default collation is case-insensitive and ignores trailing spaces, so
+    'IPC' and 'ipc ' are the same row as far as the existence check goes.
+    """
+    return tuple(str(value).rstrip().casefold() for value in row)
 
 
-def where_from_iterables(fields: tuple, values: tuple) -> str:
+def existing_keys(in_table: str, fields: list, where: str = None) -> set:
     """
-    Creates a where clause 
-    
+    Scan in_table once and collect the keys of every row already there
+
+    Served from the local snapshot when one is set up and still current.
+
+    :param in_table: path to the table to scan
+    :param fields: fields making up the key
+    :param where: optional clause to narrow the scan, eg. one DomainName
+    :returns: set of row_key tuples
     """
+    keys = set()
+    with get_metrics().timer("scan"):
+        for row in read_rows(in_table, fields, where):
+            keys.add(row_key(row))
 
-    lenf = len(fields)
-    lenv = len(values)
+    return keys
 
-    if lenf != lenv:
 
-        message  = "Different number of fields ({0}) and values ({1})".format(lenf, lenv)
-        raise ValueError("Different number of fields and values")
-    
-    clauses = []
-    
-    for pair in zip(fields, values):
+def existing_keys_among(in_table: str, fields: list, rows: list) -> set:
+    """
+    Collect the keys of those rows that are already in in_table
 
-        field = pair[0]
-        value = pair[1]
-        field_val_clause = build_clause(field, value)
-        clauses.append(field_val_clause)
-    
-    out_clause = concat_clauses(clauses, "AND")
+    Matches the rows with chunked OR/IN clauses (see deploy_common/where.py),
+    so the check costs a few queries for the whole batch rather than one per
+    row, and never scans rows the batch does not mention.
 
-    return out_clause
+    :param in_table: path to the table to check
+    :param fields: fields making up the key
+    :param rows: rows to look for, in fields order
+    :returns: set of row_key tuples found
+    """
+    keys = set()
+    with get_metrics().timer("scan"):
+        for where in match_clauses(fields, rows):
+            for row in read_rows(in_table, fields, where):
+                keys.add(row_key(row))
 
+    return keys
 
-# arcpy search/update logic 
 
-def count_where(in_table: str, fields: list, where: str) -> int:
-    """ 
-    There should be constraints in the database to enforce 
-    uniqueness, etc. 
-    
+class MissingRows:
     """
-    n = 0 
-    with SearchCursor(in_table, fields, where_clause=where) as cursor:
-        for row in cursor:
-            n+=1
-    
-    del cursor 
+    Re-iterable stream of the rows in a source that are not in the table yet
 
-    return n
+    Each pass reads the source from the start and filters it against the keys
+    the table already had, so rows are never collected into a list. Rows
+    already in the table (or repeated in the source) are skipped, and logged
+    on the first pass only. The keys seen so far in a pass are kept in a
+    SpillDict, which moves them to disk once a large source outgrows memory.
 
+    position is how many source rows have been read by the time a row is
+    yielded, so it can be journaled as a resume point.
 
-def insert_row(row: tuple, fields: tuple, target_layer: object) -> bool:
+    :param source: zero-argument callable returning an iterator of rows
+    :param fields: fields making up the uniqueness key
+    :param existing: set of row_key tuples already in the table
+    :param start: source rows to pass over, eg. ones a resumed run already committed
+    """
 
-    cursor = InsertCursor(target_layer, fields)
+    def __init__(self, source, fields: list, existing: set, start: int = 0):
+        self.source = source
+        self.fields = fields
+        self.existing = existing
+        self.start = start
+        self.position = start
+        self.passes = 0
+        self.count = 0
+        self.skipped = 0
 
-    cursor.insertRow(row)
+    def __iter__(self):
+        seen = SpillDict()
+        log_skips = self.passes == 0
+        self.passes += 1
+        self.count = 0
+        self.skipped = 0
+        self.position = self.start
 
-    logger.info("Inserted {0}".format(row))
+        try:
+            for row in itertools.islice(self.source(), self.start, None):
 
-    del cursor 
-    # del target_layer 
+                self.position += 1
 
-    return True
+                key = row_key(row)
 
+                if key in self.existing or not seen.add(key):
 
-def count_then_insert(row: tuple, fields: list, target_path: object, target_layer: object) -> str:
+                    if log_skips:
+                        logger.info("Skipping insert {0}. This row already exists.".format(tuple(row)))
+                    self.skipped += 1
+                    continue
+
+                self.count += 1
+                yield row
+
+        finally:
+            seen.close()
+
+
+# Plan / apply
+
+DOMAIN_FIELDS = ["DomainName", "Code", "Value"]
+LOOKUP_FIELDS = ["Code", "Value"]
+
+
+def plan_section(key: str, section: object, workspace: str, base_dir: str = ".") -> dict:
     """
-    Check whether inserted row values are unique
+    Read DOMAINLOOKUPS and the section's Lookup_* table once and work out what to insert
 
-    If they are unique, inserts them
-    
+    Nothing is written. Fails straight away if the Lookup_* table for the
+    section's domain_type does not exist. The rows to insert are MissingRows
+    streams over the section's codes/values or source file.
+
+    :param base_dir: folder a relative source path is resolved against
+    :returns: plan dict for apply_section
+    """
+    domain_type = section["domain_type"]
+    entries = section_entries(section, base_dir)
+
+    domain_path = os.path.join(workspace, DOMAIN_TABLE)
+    logger.info("DOMAINLOOOKUPS path: {0}".format(domain_path))
+
+    lookup_path = os.path.join(workspace, LOOKUP_TABLE_PREFIX+domain_type)
+    logger.info("Lookup path: {0}".format(lookup_path))
+
+    # confirm lookup path, built with config domain_type, is valid
+    # this will throw an informative error if the lookup path does not exist
+    get_views().get(lookup_path, workspace)
+
+    scope = "domains:{0}:{1}".format(source_label(workspace), key)
+    scope_digest = section_digest(section, base_dir)
+
+    domain_where = equals("DomainName", domain_type)
+    domain_rows = plan_rows(scope+":DOMAINLOOKUPS", scope_digest, domain_path, DOMAIN_FIELDS,
+                            lambda: ([domain_type, code, value] for code, value in entries()), domain_where)
+    lookup_rows = plan_rows(scope+":Lookup_"+domain_type, scope_digest, lookup_path, LOOKUP_FIELDS,
+                            lambda: ([code, value] for code, value in entries()))
+
+    return {
+        "key": key,
+        "domain_type": domain_type,
+        "toolbox_path": section["toolbox_path"],
+        "workspace": workspace,
+        "domain_path": domain_path,
+        "lookup_path": lookup_path,
+        "domain_rows": domain_rows,
+        "lookup_rows": lookup_rows,
+        "digest": scope_digest,
+        "scopes": {"domain_rows": scope+":DOMAINLOOKUPS", "lookup_rows": scope+":Lookup_"+domain_type},
+        "paths": {"domain_rows": domain_path, "lookup_rows": lookup_path},
+    }
+
+
+def section_digest(section: object, base_dir: str = ".") -> str:
+    """
+    Digest of a section's config and source file, so a resume notices if either changed
     """
+    path = source_path(section, base_dir)
+    stamp = None
+    if path and os.path.exists(path):
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+    return digest([dict(section), stamp])
 
-    logger.info("Executing count_then_insert: {}".format(row))
 
+def plan_rows(scope: str, scope_digest: str, path: str, fields: list, source, where: str = None) -> MissingRows:
+    """
+    MissingRows for one table, picking up where the journaled run left off
+
+    Without a journal, or with nothing journaled for scope, the table is
+    scanned as usual. A scope the journal has as done plans nothing and reads
+    nothing. A scope with checkpoints skips the source rows already committed
+    and only checks the rest for existence, with batched IN queries instead
+    of a full scan.
+    """
+    journal = get_journal()
+
+    if journal is None:
+        return MissingRows(source, fields, existing_keys(path, fields, where))
+
+    if journal.is_done(scope, scope_digest):
+        logger.info("{0} already done in run {1}, skipping".format(scope, journal.run_id))
+        return MissingRows(lambda: iter(()), fields, set())
+
+    start = journal.position(scope, scope_digest)
+    if not start:
+        return MissingRows(source, fields, existing_keys(path, fields, where))
+
+    logger.info("Resuming {0} after source row {1}".format(scope, start))
+    existing = existing_keys_among(path, fields, itertools.islice(source(), start, None))
+    return MissingRows(source, fields, existing, start)
+
+
+def describe_plan(plan: dict):
+    for row in plan["domain_rows"]:
+        yield "+ DOMAINLOOKUPS {0}".format(tuple(row))
+    for row in plan["lookup_rows"]:
+        yield "+ Lookup_{0} {1}".format(plan["domain_type"], tuple(row))
+
+
+def apply_section(plan: dict, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """
+    Write a plan from plan_section, committing every chunk_size rows
+
+    :returns: summary dict of inserted/skipped counts and any errors logged on the way
+    """
+    workspace = plan["workspace"]
+    summary = {"domain_inserted": 0, "domain_skipped": 0, "lookup_inserted": 0, "lookup_skipped": 0, "errors": []}
+
+    # dbo.DOMAINUPDATES
+
+    # views are shared across sections and deleted by the registry, see deploy_common/views.py
+    domainlookups_layer = get_views().get(plan["domain_path"], workspace)
+    summary["domain_inserted"] = apply_journaled(
+        plan, "domain_rows", domainlookups_layer, DOMAIN_FIELDS, chunk_size)
+    summary["domain_skipped"] = plan["domain_rows"].skipped
+
+    # 3. PnP domain update model runs once per workspace after every section, see rebuild_domains
+
+    # Update lookup table 
+    logger.info("Updating dbo.Lookup_* tables...")
     try: 
+        lookup_layer = get_views().get(plan["lookup_path"], workspace)
+        summary["lookup_inserted"] = apply_journaled(
+            plan, "lookup_rows", lookup_layer, LOOKUP_FIELDS, chunk_size)
+        summary["lookup_skipped"] = plan["lookup_rows"].skipped
 
-        # target_layer = arcpy.management.MakeTableView(target_path, "target_layer", workspace=workspace)
+    except Exception as e:
 
-        # Make a WHERE clause 
+        logger.error(e)
+        summary["errors"].append("Lookup_{0}: {1}".format(plan["domain_type"], e))
 
-        where = where_from_iterables(fields, row)
+    return summary
 
-        # Search using SearchCursor
 
-        existing_count = count_where(target_path, fields, where)
+def apply_journaled(plan: dict, rows_key: str, layer: object, fields: list, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    apply_inserts for one of the plan's row streams, journaling every commit and
+    recording the OBJECTIDs it inserts as before-images
+
+    The table is marked as written in the snapshot cache once a chunk goes in,
+    so later reads of it in this run go to the server.
+    """
+    rows = plan[rows_key]
+    journal = get_journal()
+    before_images = get_before_images()
 
-        if existing_count > 0: 
+    def record_oids(oids):
+        mark_written(plan["paths"][rows_key])
+        if before_images is not None:
+            before_images.inserted(plan["paths"][rows_key], oids)
 
-            logger.info("Skipping insert WHERE {1}. This row already exists.".format(existing_count, where))
+    if journal is None:
+        return apply_inserts(get_backend(), plan["workspace"], layer, fields, rows, chunk_size, record_oids=record_oids)
 
-        else: 
+    scope = plan["scopes"][rows_key]
+
+    def checkpoint(inserted):
+        journal.checkpoint(scope, plan["digest"], rows.position, inserted=inserted)
+
+    inserted = apply_inserts(get_backend(), plan["workspace"], layer, fields, rows, chunk_size, checkpoint, record_oids)
+    journal.done(scope, plan["digest"], inserted=inserted, skipped=rows.skipped)
+
+    return inserted
+
+
+def deploy_section(key: str, section: object, workspace: str, dry_run: bool = False,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE, base_dir: str = ".") -> dict:
+    """
+    Add one config section's codes/values to DOMAINLOOKUPS and its Lookup_* table
+
+    :param key: config section name, used to keep table view names unique
+    :param section: config section with domain_type, toolbox_path and either codes/values
+        or a source file (see code_source.py)
+    :param workspace: path to the .sde connection for the section
+    :param dry_run: only log the plan, write nothing
+    :param chunk_size: rows per edit session commit
+    :param base_dir: folder a relative source path is resolved against
+    :returns: summary dict of inserted/skipped counts and any errors logged on the way
+    """
+    # the check for missing rows and their insert happen under one lock per
+    # domain type (its DOMAINLOOKUPS rows and its Lookup_* table), so two
+    # deploys of the same type can't both find a code missing and both insert it
+    lock = contextlib.nullcontext() if dry_run else get_backend().lock(workspace, [domain_lock(section["domain_type"])])
+
+    with lock:
+        if not dry_run:
+            # another deploy may have committed since this phase checked the snapshots
+            recheck(os.path.join(workspace, DOMAIN_TABLE))
+            recheck(os.path.join(workspace, LOOKUP_TABLE_PREFIX+section["domain_type"]))
+
+        if not section.getboolean("bulk", fallback=True):
+            return deploy_section_per_row(key, section, workspace)
+
+        if section.getboolean("pushdown", fallback=False) and not dry_run:
+            try:
+                return deploy_section_pushdown(key, section, workspace, base_dir)
+            except MergeNotSupported as e:
+                logger.warning("Section {0}: no server-side merge ({1}), inserting through cursors".format(key, e))
+
+        plan = plan_section(key, section, workspace, base_dir)
+        log_plan("section {0}".format(key), describe_plan(plan), logger)
+
+        if dry_run:
+            return {"domain_inserted": 0, "domain_skipped": plan["domain_rows"].skipped,
+                    "lookup_inserted": 0, "lookup_skipped": plan["lookup_rows"].skipped,
+                    "domain_planned": plan["domain_rows"].count, "lookup_planned": plan["lookup_rows"].count,
+                    "errors": []}
+
+        return apply_section(plan, chunk_size)
+
+def deploy_section_pushdown(key: str, section: object, workspace: str, base_dir: str = ".") -> dict:
+    """
+    Set-based deploy (pushdown=true): one server-side merge per table instead of a scan and cursor inserts
+
+    The section's rows are staged on the server once and DOMAINLOOKUPS and the
+    Lookup_* table each get the ones they are missing, in one transaction, so
+    nothing is read back to the client. Both tables are journaled as done
+    together; there are no checkpoints to resume from.
+
+    :raises MergeNotSupported: if the backend or the tables can't take a
+        set-based insert, before anything is written
+    """
+    backend = get_backend()
+    journal = get_journal()
+    before_images = get_before_images()
+    summary = {"domain_inserted": 0, "domain_skipped": 0, "lookup_inserted": 0, "lookup_skipped": 0, "errors": []}
+
+    domain_type = section["domain_type"]
+    entries = section_entries(section, base_dir)
+
+    domain_path = os.path.join(workspace, DOMAIN_TABLE)
+    lookup_path = os.path.join(workspace, LOOKUP_TABLE_PREFIX+domain_type)
+
+    get_views().get(lookup_path, workspace)
+
+    scope = "domains:{0}:{1}".format(source_label(workspace), key)
+    scopes = [scope+":DOMAINLOOKUPS", scope+":Lookup_"+domain_type]
+    scope_digest = section_digest(section, base_dir)
+
+    if journal is not None and all(journal.is_done(name, scope_digest) for name in scopes):
+        logger.info("{0} already done in run {1}, skipping".format(scope, journal.run_id))
+        return summary
+
+    with get_metrics().timer("merge_pushdown"):
+        results = backend.merge_rows(
+            workspace, DOMAIN_FIELDS, ([domain_type, code, value] for code, value in entries()),
+            [(domain_path, DOMAIN_FIELDS), (lookup_path, LOOKUP_FIELDS)],
+            record_oids=None if before_images is None else before_images.inserted)
+    summary["domain_inserted"], summary["domain_skipped"] = results[0]
+    summary["lookup_inserted"], summary["lookup_skipped"] = results[1]
+    if summary["domain_inserted"]:
+        mark_written(domain_path)
+    if summary["lookup_inserted"]:
+        mark_written(lookup_path)
+    get_metrics().count("rows_inserted", summary["domain_inserted"] + summary["lookup_inserted"])
+
+    if journal is not None:
+        journal.done(scopes[0], scope_digest, inserted=summary["domain_inserted"], skipped=summary["domain_skipped"])
+        journal.done(scopes[1], scope_digest, inserted=summary["lookup_inserted"], skipped=summary["lookup_skipped"])
+
+    logger.info("Section {0} merged on the server: {1} DOMAINLOOKUPS and {2} Lookup_{3} row(s) inserted".format(
+        key, summary["domain_inserted"], summary["lookup_inserted"], domain_type))
+    return summary
+
+
+def deploy_section_per_row(key: str, section: object, workspace: str) -> dict:
+    """
+    Row-by-row deploy, one insert per code (bulk=false)
+
+    Rows go in one at a time outside an edit session, as they always have, but
+    whether they already exist is checked with a few batched queries per table
+    rather than a count per row.
+    """
+    summary = {"domain_inserted": 0, "domain_skipped": 0, "lookup_inserted": 0, "lookup_skipped": 0, "errors": []}
+
+    domain_type = section["domain_type"]
+    codes = section["codes"].split(",")
+    values = section["values"].split(",")
+
+    domain_path = os.path.join(workspace, DOMAIN_TABLE)
+    lookup_path = os.path.join(workspace, LOOKUP_TABLE_PREFIX+domain_type)
+
+    get_views().get(lookup_path, workspace)
+
+    domainlookups_layer = get_views().get(domain_path, workspace)
+
+    domain_entries = [[domain_type]+list(entry) for entry in zip(codes, values)]  # we need 3 fields to get unique value in domain
+    summary["domain_inserted"], summary["domain_skipped"], errors = insert_missing_per_row(
+        domain_entries, DOMAIN_FIELDS, domain_path, domainlookups_layer)
+    summary["errors"].extend("DOMAINLOOKUPS: {0}".format(error) for error in errors)
+
+    logger.info("Updating dbo.Lookup_* tables...")
+    try: 
+        lookup_layer = get_views().get(lookup_path, workspace)
         
-            insert_row(row, fields, target_layer)
+        summary["lookup_inserted"], summary["lookup_skipped"], errors = insert_missing_per_row(
+            [list(entry) for entry in zip(codes, values)], LOOKUP_FIELDS, lookup_path, lookup_layer)
+        summary["errors"].extend("Lookup_{0}: {1}".format(domain_type, error) for error in errors)
 
     except Exception as e:
 
         logger.error(e)
+        summary["errors"].append("Lookup_{0}: {1}".format(domain_type, e))
 
-    finally: 
+    return summary
 
-        if target_layer:
-            
-            del target_layer
 
-    return target_path
+def insert_missing_per_row(rows: list, fields: list, target_path: object, target_layer: object) -> tuple:
+    """
+    Per-row insert for a batch: one batched existence check, then insert_row per new row
 
+    Each row is committed as it goes in, outside an edit session, so its
+    OBJECTID is recorded as a before-image straight after the insert, before
+    the next row, and a crash part way leaves nothing committed unrecorded.
+    A row whose insert fails is left out and reported, and the rest carry on.
 
-# Logic 
+    :returns: (inserted, skipped, errors): the counts of rows inserted and of
+        rows skipped as already there or repeated, and a message per failed insert
+    """
+    inserted = 0
+    errors = []
+    before_images = get_before_images()
+    existing = existing_keys_among(target_path, fields, rows)
+    missing = MissingRows(lambda: iter(rows), fields, existing)
+
+    for row in missing:
+        logger.info("Adding row: "+", ".join(row[-2:]))
+        mark_written(target_path)
+        try:
+            oid = insert_row(row, fields, target_layer)
+        except Exception as e:
+            logger.error(e)
+            errors.append("{0}: {1}".format(tuple(row), e))
+            continue
+        if before_images is not None:
+            before_images.inserted(target_path, [oid])
+        inserted += 1
+
+    return inserted, missing.skipped, errors
+
+
+# Validation
+
+def validate_section(key: str, section: object, workspace: str, base_dir: str = ".", problems: Problems = None) -> Problems:
+    """
+    Check one section against the schema before anything is written
 
-if __name__ == "__main__":
+    Looks for a missing or unknown domain_type (the Lookup_* table has to
+    exist), codes and values lists of different lengths, a source that can't
+    be read, a source on a bulk=false section (which only takes inline
+    codes/values), codes listed twice with different values and values too
+    long for DOMAINLOOKUPS or the Lookup_* table. Table descriptions come from
+    the backend's describe(), which caches them. The first value of each code
+    is kept in a SpillDict, so a large source is checked in bounded memory.
 
-    # Imports
+    :returns: Problems, with everything found added to it
+    """
+    problems = problems if problems is not None else Problems()
+    backend = get_backend()
+
+    domain_type = section.get("domain_type")
+    if not domain_type:
+        problems.add("[{0}] no domain_type".format(key), "[{0}] has no domain_type".format(key))
+        return problems
+    if not section.get("toolbox_path"):
+        problems.add("[{0}] no toolbox_path".format(key), "[{0}] has no toolbox_path".format(key))
+
+    # label -> describe() result, for the tables that exist
+    tables = {}
+    for label, path in (("DOMAINLOOKUPS", os.path.join(workspace, DOMAIN_TABLE)),
+                        ("Lookup_"+domain_type, os.path.join(workspace, LOOKUP_TABLE_PREFIX+domain_type))):
+        with get_metrics().timer("describe"):
+            description = backend.describe(path)
+        if description is None:
+            problems.add("[{0}] {1} missing".format(key, label),
+                         "[{0}] {1} does not exist, check domain_type '{2}'".format(key, label, domain_type))
+        else:
+            tables["[{0}] {1}".format(key, label)] = description
+
+    domain_label = "[{0}] DOMAINLOOKUPS".format(key)
+    if domain_label in tables:
+        check_fields(problems, domain_label, tables[domain_label], {"DomainName": domain_type})
+
+    bulk = configparser.ConfigParser.BOOLEAN_STATES.get(str(section.get("bulk", "true")).strip().lower(), True)
+    if not bulk and section.get("source"):
+        problems.add("[{0}] per-row source".format(key),
+                     "[{0}] bulk=false takes inline codes/values, not a source".format(key))
+        return problems
+
+    if not section.get("source"):
+        codes = section.get("codes", "").split(",")
+        values = section.get("values", "").split(",")
+        if len(codes) != len(values):
+            problems.add("[{0}] count mismatch".format(key),
+                         "[{0}] has {1} codes but {2} values".format(key, len(codes), len(values)))
+            return problems
+
+    values_by_code = SpillDict()
+    try:
+        for code, value in section_entries(section, base_dir)():
+            for label, description in tables.items():
+                check_fields(problems, label, description, {"Code": code, "Value": value})
+
+            folded_code, folded_value = row_key((code, value))
+            first = values_by_code.setdefault(folded_code, (value, folded_value))
+            if first[1] != folded_value:
+                problems.add("[{0}] duplicate codes".format(key),
+                             "[{0}] code '{1}' is listed with values '{2}' and '{3}'".format(key, code, first[0], value))
+
+    except (OSError, KeyError, ValueError) as e:
+        problems.add("[{0}] source".format(key), "[{0}] cannot read codes/values: {1}".format(key, e))
+
+    finally:
+        values_by_code.close()
+
+    return problems
+
+
+def validate_sections(jobs: list) -> list:
+    """
+    Validate every job's section, connecting through the shared pool
 
-    print("Starting")
-    print("Importing dependencies")
+    :returns: list of problem descriptions, empty if every section is fine
+    """
+    from deploy_common.connections import get_pool
+
+    problems = Problems()
+    with get_metrics().timer("validate"):
+        for job in jobs:
+            section = job["section"]
+            try:
+                workspace = get_pool().get(section["server"], section["database"], section["username"])
+            except Exception as e:
+                problems.add("[{0}] connection".format(job["key"]), "[{0}] cannot connect: {1}".format(job["key"], e))
+                continue
+            validate_section(job["key"], section, workspace, job.get("options", {}).get("base_dir", "."), problems)
 
-    import arcpy
-    import configparser
-    import logging
-    import logging.handlers
-    import os
-    import sys
-    from getpass import getpass
-    import tempfile
+    return problems.report()
+
+
+# Section runner
+
+def run_section_job(job: dict) -> dict:
+    """
+    Run one section and turn the outcome into a result row, never raising
+
+    Used for both the in-process and the worker-pool runs. A job carries the
+    section name, its config values, deploy_section options and, for worker
+    processes, the password resolved by the parent (workers can't prompt).
+    """
+    import time
+
+    from deploy_common.connections import get_pool
+
+    key = job["key"]
+    section = job["section"]
+    result = {"section": key, "domain_type": section.get("domain_type"), "server": section.get("server"),
+              "database": section.get("database"), "username": section.get("username"),
+              "toolbox_path": section.get("toolbox_path"), "status": "ok", "error": None}
+    started = time.perf_counter()
+
+    try:
+        config = configparser.ConfigParser()
+        config.read_dict({key: section})
+
+        pool = get_pool()
+        if job.get("password") is not None:
+            pool.set_password(section["server"], section["database"], section["username"], job["password"])
+
+        # sections on the same server/database/user share one connection file
+        workspace = pool.get(section["server"], section["database"], section["username"])
+
+        summary = deploy_section(key, config[key], workspace, **job.get("options", {}))
+        result.update(summary)
+        if summary["errors"]:
+            result["status"] = "failed"
+            result["error"] = "; ".join(summary["errors"])
+
+    except Exception as e:
+
+        logger.error("Section {0} failed: {1}".format(key, e))
+        result["status"] = "failed"
+        result["error"] = str(e)
+
+    result["seconds"] = round(time.perf_counter() - started, 2)
+    return result
+
+
+def _init_worker(log_file: str, snapshot_path: str = None, journal: tuple = None, before_images: tuple = None) -> None:
+    global logger
 
-    from arcpy.da import SearchCursor, InsertCursor
-    
     from helpers import get_logger
-    from helpers import create_sde_connection_file
 
-    logger = get_logger("Add domain entries.py", "./app.log")
+    logger = get_logger("Add domain entries.py", log_file)
+
+    # each worker opens its own connection to the parent's snapshot file
+    set_snapshots(SnapshotCache(snapshot_path) if snapshot_path else None)
+    # and appends to the parent's run in the journal
+    set_journal(Journal(*journal) if journal else None)
+    set_before_images(BeforeImages(*before_images) if before_images else None)
+    # table views live in this process's memory, so the worker keeps its own
+    set_views(ViewRegistry())
+    # a forked worker starts with a copy of the parent's metrics, which the parent already has
+    get_metrics().clear()
+
+
+def _run_worker_job(job: dict) -> dict:
+    """
+    run_section_job in a worker process, with the metrics it collected for the parent to merge
+    """
+    result = run_section_job(job)
+    result["metrics"] = get_metrics().take()
+    return result
+
+
+def run_sections(jobs: list, workers: int = 1, per_server: int = 1, log_file: str = "./app.log") -> list:
+    """
+    Run section jobs, in this process or across a pool of worker processes
+
+    With workers > 1 at most per_server sections run against the same server at
+    once; the rest wait for a slot. Results come back in completion order, and
+    each worker's metrics are merged into this process's.
+
+    :param jobs: list of job dicts for run_section_job
+    :param workers: number of worker processes, 1 runs everything in this process
+    :param per_server: concurrency cap per server
+    :returns: list of result dicts
+    :raises ValueError: if workers or per_server is less than 1, as no section could ever start
+    """
+    if workers < 1 or per_server < 1:
+        raise ValueError("workers and per_server must be at least 1, not {0} and {1}".format(workers, per_server))
+
+    if workers == 1:
+        return [run_section_job(job) for job in jobs]
+
+    from collections import Counter
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    pending = list(jobs)
+    running = {}
+    per_server_running = Counter()
+    results = []
+    snapshots = get_snapshots()
+    journal = get_journal()
+    before_images = get_before_images()
+    initargs = (log_file, snapshots.path if snapshots is not None else None,
+                (journal.path, journal.run_id) if journal is not None else None,
+                (before_images.path, before_images.run_id) if before_images is not None else None)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+                server = job["section"]["server"].lower()
+                if per_server_running[server] < per_server:
+                    pending.remove(job)
+                    per_server_running[server] += 1
+                    running[executor.submit(_run_worker_job, job)] = job
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                per_server_running[job["section"]["server"].lower()] -= 1
+                result = future.result()
+                get_metrics().merge(result.pop("metrics"))
+                results.append(result)
+
+    return results
+
+
+def rebuild_domains(results: list, state_path: str, force: bool = False) -> list:
+    """
+    Run the PnP CreateDomains tool once per workspace, only where lookup content changed
+
+    The DOMAINLOOKUPS content of every domain type the sections deployed is
+    hashed and compared with the hashes saved after the last successful
+    rebuild. Workspaces where nothing changed are left alone.
+
+    :param results: section results from run_sections
+    :param state_path: JSON file holding the hashes from earlier runs
+    :param force: rebuild every workspace regardless of the hashes
+    :returns: list of result dicts, one per workspace rebuilt or that failed
+    """
+    from deploy_common.connections import get_pool
+
+    backend = get_backend()
+    state = load_state(state_path)
+    rebuilds = []
+
+    workspaces = {}
+    for result in results:
+        if not result.get("server") or not result.get("domain_type"):
+            continue
+        key = (result["server"].lower(), result["database"].lower(), result["username"])
+        workspaces.setdefault(key, {"toolbox_path": result["toolbox_path"], "domain_types": set(), "written": False})
+        workspaces[key]["domain_types"].add(result["domain_type"])
+        # a failed section may have committed rows before it failed
+        workspaces[key]["written"] |= bool(result.get("domain_inserted")) or result["status"] != "ok"
+
+    for (server, database, username), target in sorted(workspaces.items()):
+        state_key = "{0}/{1}".format(server, database)
+        rebuild = {"section": "CreateDomains " + state_key, "status": "ok", "error": None, "seconds": 0}
+
+        try:
+            workspace = get_pool().get(server, database, username)
+            domain_path = os.path.join(workspace, DOMAIN_TABLE)
+            if target["written"]:
+                # written by the sections, maybe in worker processes, so don't copy it down again
+                mark_written(domain_path)
+
+            with get_metrics().timer("hash_domains"):
+                hashes = content_hashes(backend, domain_path, sorted(target["domain_types"]))
+            previous = state.get(state_key, {})
+            changed = sorted(t for t, digest in hashes.items() if previous.get(t) != digest)
+
+            if not changed and not force:
+                logger.info("Domains on {0} unchanged, skipping CreateDomains".format(state_key))
+                continue
+
+            logger.info("Executing PnP domain update model on {0} for {1}...".format(state_key, ", ".join(changed) or "all"))
+            with get_metrics().timer("create_domains"):
+                backend.create_domains(target["toolbox_path"], domain_path, workspace)
+            logger.info("Esri script tool output: \n\n{}\n".format(backend.get_messages()))
+
+            # only remember the content once the rebuild has gone through
+            state.setdefault(state_key, {}).update(hashes)
+            save_state(state_path, state)
+
+        except Exception as e:
+
+            logger.error(e)
+            rebuild["status"] = "failed"
+            rebuild["error"] = "CreateDomains: {0}".format(e)
+
+        rebuilds.append(rebuild)
+
+    return rebuilds
+
+
+def log_summary(results: list) -> None:
+    logger.info("Section summary:")
+    for result in results:
+        logger.info("  {section}: {status} in {seconds}s ({0} domain / {1} lookup rows inserted){2}".format(
+            result.get("domain_inserted", 0), result.get("lookup_inserted", 0),
+            " - " + result["error"] if result["error"] else "", **result))
+
+
+def deploy_domains(config_ini_path: str = "./config.ini", workers: int = 1, per_server: int = 1,
+                   dry_run: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE, force_rebuild: bool = False,
+                   log_file: str = "./app.log", resume: bool = False, journal_path: str = None) -> list:
+    """
+    Validate every section of config_ini_path, deploy them, then rebuild the changed domains
+
+    Nothing is written if any section fails validation; every problem found
+    is logged and returned in one failed "validation" result.
+
+    Unless this is a dry run, every commit is journaled (see
+    deploy_common/journal.py) so a run that dies part way can be picked up
+    again with resume=True. The rows inserted are recorded in the process's
+    before-images file, if it has one, under the journal's run id, so
+    deploy_common/before_images.py can roll the run back.
+
+    Sections share table views through a registry for the run, which deletes
+    them all at the end (see deploy_common/views.py).
+
+    :param resume: carry on from the last unfinished run in the journal
+    :param journal_path: journal file, defaults to journal.jsonl next to config_ini_path
+    :returns: list of section and rebuild result dicts, see run_section_job
+    """
+    from deploy_common.connections import get_pool
+
+    results = []
+    journal = None
+    previous_journal = get_journal()
+    previous_before_images = get_before_images()
+    views = ViewRegistry()
+    previous_views = set_views(views)
 
     try: 
         config = configparser.ConfigParser()
-        config_ini_path = "./config.ini"
         config.read(config_ini_path)
-       
+        base_dir = os.path.dirname(os.path.abspath(config_ini_path))
+
+        jobs = []
         for key in config:
             if key == 'DEFAULT':
                 continue
         
             logger.info("Executing for config key " + key) 
 
-            toolbox_path = config[key]["toolbox_path"]
-            username = config[key]["username"]
-            server = config[key]["server"]
-            database = config[key]["database"]
-            domain_type = config[key]["domain_type"]
-            codes = config[key]["codes"].split(",")
-            values = config[key]["values"].split(",")
-
-            password = getpass(prompt='Password for user '+username+': ')
-            
-            temp_dir = tempfile.TemporaryDirectory()  # this needs creating outside the function so that the garbage collector doesnt delete it when function context closes
-            workspace = create_sde_connection_file(username, password, temp_dir.name, server, database)
-
-            domain_name = "GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS"
-            domain_path = os.path.join(workspace, domain_name)
-            logger.info("DOMAINLOOOKUPS path: {0}".format(domain_path))
-
-            lookup_name = "GLOBAL_EXPOSURE.dbo.Lookup_"+domain_type
-
-            lookup_path = os.path.join(workspace, lookup_name)
-            logger.info("Lookup path: {0}".format(lookup_path))
-            
-            # confirm lookup path, built with config domain_type, is valid
-            # this will throw an informative error if the lookup path does not exist
-            arcpy.management.MakeTableView(lookup_path, "confirm_lookup_path_check_"+key, workspace=workspace)
-       
-            # dbo.DOMAINUPDATES
-
-            domainlookups_layer = arcpy.management.MakeTableView(domain_path, "target_layer"+key, workspace=workspace)
-
-            domain_fields = ["DomainName", "Code", "Value"]
-            for entry in zip(codes, values):
-                logger.info("Adding row: "+entry[0]+", "+entry[1])
-                domain_entry = [domain_type]+list(entry)  # we need 3 fields to get unique value in domain
-                count_then_insert(domain_entry, domain_fields, domain_path, domainlookups_layer)
-            
-            del domainlookups_layer
-
-            # 3. Execute PnP domain update model 
-
-            logger.info("Executing PnP domain update model...") 
-            try: 
-                toolbox = arcpy.AddToolbox(toolbox_path)
-
-                toolbox.CreateDomains(
-                    lookupTable=domain_path,
-                    pnpWorkspace=workspace
-                )
-
-                logger.info("Esri script tool output: \n\n{}\n".format(arcpy.GetMessages()))
+            section = dict(config[key])
+            options = {"dry_run": dry_run, "chunk_size": chunk_size, "base_dir": base_dir}
+            job = {"key": key, "section": section, "options": options}
 
-            except Exception as e:
+            if workers > 1:
+                # prompt here, once per connection, before handing off to the workers
+                job["password"] = get_pool().resolve_password(section["server"], section["database"], section["username"])
 
-                logger.error(e)
+            jobs.append(job)
 
-            # Update lookup table 
-            logger.info("Updating dbo.Lookup_* tables...")
-            try: 
-                lookup_layer = arcpy.management.MakeTableView(lookup_path, "lookup_layer"+key, workspace=workspace)
-                
-                lookup_fields = ["Code", "Value"]
-                for entry in zip(codes, values):
-                    logger.info("Adding row: "+entry[0]+", "+entry[1])
-                    count_then_insert(list(entry), lookup_fields, lookup_path, lookup_layer)
-                
-                del lookup_layer
+        problems = validate_sections(jobs)
+        if problems:
+            raise ValidationError(problems)
 
-            except Exception as e:
+        if not dry_run:
+            journal = Journal.start(journal_path or os.path.join(base_dir, "journal.jsonl"), resume)
+            set_journal(journal)
+            if previous_before_images is not None:
+                set_before_images(previous_before_images.for_run(journal.run_id))
 
-                logger.error(e)
+        results = run_sections(jobs, workers, per_server, log_file)
+        if not dry_run:
+            results += rebuild_domains(results, os.path.join(base_dir, "domain_hashes.json"), force_rebuild)
+        log_summary(results)
+
+        if journal is not None and all(result["status"] == "ok" for result in results):
+            journal.finish()
         
+    except ValidationError as e:
+
+        for problem in e.problems:
+            logger.error("Validation: {0}".format(problem))
+        results.append({"section": "validation", "status": "failed", "error": str(e), "seconds": 0})
+
     except Exception as e:
 
         logger.error(e)
+        results.append({"section": "add_domains", "status": "failed", "error": str(e), "seconds": 0})
+
+    finally:
+
+        set_journal(previous_journal)
+        set_before_images(previous_before_images)
+        views.close()
+        set_views(previous_views)
+
+    return results
+
+
+# Logic 
+
+if __name__ == "__main__":
+
+    # Imports
+
+    print("Starting")
+    print("Importing dependencies")
+
+    import argparse
+
+    from deploy_common import before_images, snapshot
+    from helpers import get_logger
+
+    parser = argparse.ArgumentParser(description="Add domain codes/values from config.ini")
+    parser.add_argument("--workers", type=int, default=1, help="run sections in this many worker processes")
+    parser.add_argument("--per-server", type=int, default=1, help="max sections running against one server at once")
+    parser.add_argument("--plan", action="store_true", help="dry run: print what would be inserted and stop")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rows per edit session commit")
+    parser.add_argument("--force-rebuild", action="store_true", help="run CreateDomains even if no lookup content changed")
+    parser.add_argument("--metrics-file", default="./metrics.jsonl", help="JSON Lines file for phase timings")
+    parser.add_argument("--profile", help="write cProfile stats for the whole run to this file")
+    parser.add_argument("--snapshot-cache", default=snapshot.DEFAULT_PATH,
+                        help="local SQLite snapshot of the tables read while planning")
+    parser.add_argument("--no-snapshot-cache", action="store_true", help="always read the tables from the server")
+    parser.add_argument("--resume", action="store_true", help="carry on from the last run that did not finish")
+    parser.add_argument("--journal", default="./journal.jsonl", help="operation journal used by --resume")
+    parser.add_argument("--before-images", default=before_images.DEFAULT_PATH,
+                        help="file the inserted OBJECTIDs are recorded in, for deploy.py --rollback")
+    parser.add_argument("--no-pause", action="store_true", help="exit without waiting for return")
+    args = parser.parse_args()
+    if args.workers < 1 or args.per_server < 1:
+        parser.error("--workers and --per-server must be at least 1")
+
+    log_file = "./app.log"
+    logger = get_logger("Add domain entries.py", log_file)
+
+    if not args.no_snapshot_cache:
+        set_snapshots(SnapshotCache(args.snapshot_cache))
+    set_before_images(BeforeImages(args.before_images))
+
+    with profiled(args.profile), get_metrics().timer("run"):
+        results = deploy_domains("./config.ini", args.workers, args.per_server, args.plan, args.chunk_size,
+                                 args.force_rebuild, log_file, args.resume, args.journal)
+
+    get_metrics().flush(args.metrics_file)
     
-    input("Press return to exit")
-        
+    if not args.no_pause:
+        input("Press return to exit")
+
+    sys.exit(1 if any(result["status"] != "ok" for result in results) else 0)
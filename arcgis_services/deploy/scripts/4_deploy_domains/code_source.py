@@ -0,0 +1,94 @@
+# RSA 2022
+
+# Streaming code/value sources for add_domains.py
+#
+# A config section can either list codes/values inline:
+#
+#     codes=IPC,RSA
+#     values=Intact Personal Canada,RSA UK
+#
+# or point at a CSV / JSON Lines file for large loads:
+#
+#     source=postcodes.csv          (relative to config.ini)
+#     source_format=csv             (optional, taken from the extension)
+#     code_field=Code               (optional, default Code)
+#     value_field=Value             (optional, default Value)
+#
+# File sources are read one record at a time, so a 500k code load is never
+# held in memory as a list.
+
+import csv
+import json
+import os
+
+
+def read_csv(path: str, code_field: str, value_field: str):
+    """
+    Yield (code, value) pairs from a CSV file with a header row
+    """
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        for line_number, record in enumerate(reader, start=2):
+            if record.get(code_field) is None or record.get(value_field) is None:
+                raise ValueError("{0} line {1}: missing {2} or {3}".format(path, line_number, code_field, value_field))
+            yield record[code_field], record[value_field]
+
+
+def read_jsonl(path: str, code_field: str, value_field: str):
+    """
+    Yield (code, value) pairs from a JSON Lines file, one object per line
+    """
+    with open(path, encoding="utf-8-sig") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get(code_field) is None or record.get(value_field) is None:
+                raise ValueError("{0} line {1}: missing {2} or {3}".format(path, line_number, code_field, value_field))
+            yield str(record[code_field]), str(record[value_field])
+
+
+readers = {
+    "csv": read_csv,
+    "jsonl": read_jsonl,
+    "ndjson": read_jsonl,
+}
+
+
+def source_path(section: object, base_dir: str = "."):
+    """
+    Path of the section's source file, or None when codes/values are inline
+    """
+    source = section.get("source")
+    if not source:
+        return None
+    return source if os.path.isabs(source) else os.path.join(base_dir, source)
+
+
+def section_entries(section: object, base_dir: str = "."):
+    """
+    Build a function returning a fresh iterator of (code, value) pairs for a section
+
+    Returning a factory rather than an iterator lets the plan and apply phases
+    each stream the source from the start.
+
+    :param section: config section with codes/values or source
+    :param base_dir: folder relative source paths are resolved against
+    :returns: zero-argument callable yielding (code, value) tuples
+    """
+    path = source_path(section, base_dir)
+
+    if not path:
+        codes = section["codes"].split(",")
+        values = section["values"].split(",")
+        return lambda: zip(codes, values)
+
+    source_format = section.get("source_format") or os.path.splitext(path)[1].lstrip(".").lower()
+    if source_format not in readers:
+        raise ValueError("Unknown source_format '{0}' for {1}".format(source_format, path))
+
+    reader = readers[source_format]
+    code_field = section.get("code_field", "Code")
+    value_field = section.get("value_field", "Value")
+
+    return lambda: reader(path, code_field, value_field)
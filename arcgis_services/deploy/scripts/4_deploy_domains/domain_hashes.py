@@ -0,0 +1,64 @@
+# RSA 2022
+
+# Content hashes of DOMAINLOOKUPS per domain type
+#
+# add_domains.py only runs the PnP CreateDomains tool for a workspace when the
+# lookup content of one of the domain types it deployed differs from the hash
+# recorded after the last successful rebuild. Hashes are kept in a small JSON
+# file next to config.ini, keyed on server/database then domain type.
+
+import hashlib
+import json
+import os
+
+from deploy_common.snapshot import read_rows
+from deploy_common.where import in_clauses
+
+
+HASH_BITS = 256
+
+
+def row_digest(row) -> int:
+    """
+    Hash one (Code, Value) row, normalised the way SQL Server compares it
+    """
+    text = "\x1f".join(str(value).rstrip().casefold() for value in row)
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest(), "big")
+
+
+def content_hashes(backend, domain_path: str, domain_types: list) -> dict:
+    """
+    Hash the DOMAINLOOKUPS rows of each domain type with a single scan per IN chunk
+
+    Row digests are summed rather than chained, so the result does not depend
+    on the order the cursor returns rows in and nothing needs sorting.
+
+    :param backend: CursorBackend to read through
+    :param domain_path: path to DOMAINLOOKUPS
+    :param domain_types: domain types to hash
+    :returns: dict of domain type -> hex digest (types with no rows hash to 0)
+    """
+    totals = {domain_type: 0 for domain_type in domain_types}
+    by_folded = {domain_type.casefold(): domain_type for domain_type in domain_types}
+
+    for where in in_clauses("DomainName", sorted(domain_types)):
+        for domain_name, code, value in read_rows(domain_path, ["DomainName", "Code", "Value"], where, backend):
+            domain_type = by_folded.get(str(domain_name).casefold())
+            if domain_type is not None:
+                totals[domain_type] = (totals[domain_type] + row_digest((code, value))) % (1 << HASH_BITS)
+
+    return {domain_type: "{0:064x}".format(total) for domain_type, total in totals.items()}
+
+
+def load_state(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: dict) -> None:
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
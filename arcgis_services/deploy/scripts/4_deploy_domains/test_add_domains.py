@@ -0,0 +1,457 @@
+import configparser
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import add_domains
+from deploy_common.backends import LockTimeout, MergeNotSupported, SqliteBackend, SqliteInsertCursor, set_backend
+from deploy_common.before_images import BeforeImages, rollback, set_before_images
+from deploy_common.journal import read_records
+from deploy_common.metrics import get_metrics
+from deploy_common.snapshot import SnapshotCache, set_snapshots
+from deploy_common.views import ViewRegistry, set_views
+
+
+def section(domain_type, codes, values, server="server"):
+    return {
+        "toolbox_path": "ArcDatabaseSettings.pyt",
+        "username": "PNP_USER",
+        "server": server,
+        "database": "GLOBAL_EXPOSURE",
+        "domain_type": domain_type,
+        "codes": codes,
+        "values": values,
+    }
+
+
+class TestDeploySection(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["ProducingOperation"])
+        self.previous = set_backend(self.backend)
+        config = configparser.ConfigParser()
+        config.read_dict({"add_prod_op": section("ProducingOperation", "IPC,RSA", "Intact,RSA UK")})
+        self.section = config["add_prod_op"]
+
+    def tearDown(self):
+        set_backend(self.previous)
+
+    def lookup_rows(self):
+        with self.backend.search_cursor("Lookup_ProducingOperation", ["Code"]) as cursor:
+            return list(cursor)
+
+    def test_dry_run_plans_without_writing(self):
+        summary = add_domains.deploy_section("add_prod_op", self.section, "local.sde", dry_run=True)
+        self.assertEqual((summary["domain_planned"], summary["lookup_planned"]), (2, 2))
+        self.assertEqual(self.lookup_rows(), [])
+        self.assertEqual(self.backend.create_domains_calls, [])
+
+    def test_streams_csv_source(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "codes.csv"), "w", newline="") as f:
+                f.write('Code,Value\nIPC,"Intact, Canada"\nRSA,RSA UK\nRSA,RSA UK\n')
+            config = configparser.ConfigParser()
+            config.read_dict({"csv": {"toolbox_path": "x.pyt", "domain_type": "ProducingOperation", "source": "codes.csv"}})
+            summary = add_domains.deploy_section("csv", config["csv"], "local.sde", chunk_size=1, base_dir=directory)
+
+        self.assertEqual((summary["lookup_inserted"], summary["lookup_skipped"]), (2, 1))
+        with self.backend.search_cursor("Lookup_ProducingOperation", ["Code", "Value"]) as cursor:
+            self.assertIn(("IPC", "Intact, Canada"), list(cursor))
+
+    def test_apply_commits_in_chunks(self):
+        summary = add_domains.deploy_section("add_prod_op", self.section, "local.sde", chunk_size=1)
+        self.assertEqual((summary["domain_inserted"], summary["lookup_inserted"]), (2, 2))
+        self.assertEqual(len(self.lookup_rows()), 2)
+        self.assertEqual(self.backend.stats["commits"], 6)  # a commit per row plus a final save, per table
+
+    def test_check_and_insert_hold_the_domain_type_lock(self):
+        insert_row = SqliteInsertCursor.insertRow
+        refused = []
+
+        def locked_insert(cursor, row):
+            for domain_type in ("ProducingOperation", "Peril"):
+                try:
+                    with self.backend.lock("local.sde", [add_domains.domain_lock(domain_type)], timeout=0):
+                        pass
+                except LockTimeout:
+                    refused.append(domain_type)
+            return insert_row(cursor, row)
+
+        config = configparser.ConfigParser()
+        config.read_dict({"per_row": dict(section("ProducingOperation", "A", "a"), bulk="false")})
+        with mock.patch.object(SqliteInsertCursor, "insertRow", locked_insert):
+            add_domains.deploy_section("add_prod_op", self.section, "local.sde")
+            add_domains.deploy_section("per_row", config["per_row"], "local.sde")
+
+        # another deploy of the same domain type waits, other types carry on
+        self.assertEqual(refused, ["ProducingOperation"] * 6)
+        with self.backend.lock("local.sde", [add_domains.domain_lock("ProducingOperation")], timeout=0):
+            pass
+
+    def test_rows_committed_by_another_deploy_mid_phase_are_not_repeated(self):
+        with self.backend.insert_cursor("DOMAINLOOKUPS", ["DomainName", "Code", "Value"]) as cursor:
+            cursor.insertRow(["ProducingOperation", "IPC", "Intact"])
+        with self.backend.insert_cursor("Lookup_ProducingOperation", ["Code", "Value"]) as cursor:
+            cursor.insertRow(["IPC", "Intact"])
+        snapshots = SnapshotCache(":memory:", self.backend)
+        previous = set_snapshots(snapshots)
+        self.addCleanup(set_snapshots, previous)
+        self.addCleanup(snapshots.close)
+        config = configparser.ConfigParser()
+        config.read_dict({"first": section("ProducingOperation", "IPC", "Intact"),
+                          "second": section("ProducingOperation", "IPC,RSA", "Intact,RSA UK")})
+
+        add_domains.deploy_section("first", config["first"], "local.sde")
+        # another deploy of the same domain type commits after the snapshots were checked
+        with self.backend.insert_cursor("DOMAINLOOKUPS", ["DomainName", "Code", "Value"]) as cursor:
+            cursor.insertRow(["ProducingOperation", "RSA", "RSA UK"])
+        with self.backend.insert_cursor("Lookup_ProducingOperation", ["Code", "Value"]) as cursor:
+            cursor.insertRow(["RSA", "RSA UK"])
+        summary = add_domains.deploy_section("second", config["second"], "local.sde")
+
+        self.assertEqual((summary["domain_inserted"], summary["lookup_inserted"]), (0, 0))
+        with self.backend.search_cursor("DOMAINLOOKUPS", ["Code"]) as cursor:
+            self.assertEqual(sorted(row[0] for row in cursor), ["IPC", "RSA"])
+        self.assertEqual(sorted(self.lookup_rows()), [("IPC",), ("RSA",)])
+
+    def test_bulk_skips_existing_and_repeated_rows(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"bulk": section("ProducingOperation", "ipc ,RSA,RSA", "intact,RSA UK,RSA UK")})
+        with self.backend.insert_cursor("DOMAINLOOKUPS", ["DomainName", "Code", "Value"]) as cursor:
+            cursor.insertRow(["ProducingOperation", "IPC", "Intact"])
+        with self.backend.insert_cursor("Lookup_ProducingOperation", ["Code", "Value"]) as cursor:
+            cursor.insertRow(["IPC", "Intact"])
+        self.backend.reset_stats()
+
+        summary = add_domains.deploy_section("bulk", config["bulk"], "local.sde")
+
+        # one existence scan per table, then one insert cursor per table for the single chunk
+        self.assertEqual(self.backend.stats["cursor_opens"], 2 + 2)
+        self.assertEqual((summary["domain_inserted"], summary["domain_skipped"]), (1, 2))
+        self.assertEqual((summary["lookup_inserted"], summary["lookup_skipped"]), (1, 2))
+        self.assertEqual(sorted(self.lookup_rows()), [("IPC",), ("RSA",)])
+
+    def test_per_row_escapes_quotes_and_batches_checks(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"per_row": dict(section("ProducingOperation", "OBR,IPC,IPC", "O'Brien,Intact,Intact"), bulk="false")})
+        with self.backend.insert_cursor("Lookup_ProducingOperation", ["Code", "Value"]) as cursor:
+            cursor.insertRow(["IPC", "Intact"])
+        self.backend.reset_stats()
+
+        summary = add_domains.deploy_section("per_row", config["per_row"], "local.sde")
+        # one existence query per table, then an insert cursor per new row
+        self.assertEqual(self.backend.stats["cursor_opens"], 2 + 3)
+
+        self.assertEqual((summary["domain_inserted"], summary["domain_skipped"]), (2, 1))
+        self.assertEqual((summary["lookup_inserted"], summary["lookup_skipped"]), (1, 2))
+        with self.backend.search_cursor("Lookup_ProducingOperation", ["Value"], "Code = 'OBR'") as cursor:
+            self.assertEqual(list(cursor), [("O'Brien",)])
+
+    def test_inserted_rows_can_be_rolled_back(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "before_images.jsonl")
+            previous = set_before_images(BeforeImages(path, "run-1"))
+            try:
+                add_domains.deploy_section("add_prod_op", self.section, "local.sde")
+                config = configparser.ConfigParser()
+                config.read_dict({"per_row": dict(section("ProducingOperation", "OBR", "O'Brien"), bulk="false")})
+                add_domains.deploy_section("per_row", config["per_row"], "local.sde")
+            finally:
+                set_before_images(previous)
+
+            self.assertEqual(rollback(path, "run-1", self.backend), {"deleted": 6, "restored": 0})
+        self.assertEqual(self.lookup_rows(), [])
+
+    def test_per_row_insert_failures_are_reported(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"per_row": dict(section("ProducingOperation", "IPC,RSA", "Intact,RSA UK"), bulk="false")})
+        insert_row = add_domains.insert_row
+
+        def failing_insert(row, fields, target_layer):
+            if row[-2] == "RSA":
+                raise RuntimeError("string too long")
+            return insert_row(row, fields, target_layer)
+
+        with mock.patch.object(add_domains, "insert_row", failing_insert):
+            result = add_domains.run_section_job({"key": "per_row", "section": dict(config["per_row"]),
+                                                  "password": "pw"})
+
+        self.assertEqual(result["status"], "failed")
+        self.assertEqual((result["domain_inserted"], result["domain_skipped"]), (1, 0))
+        self.assertEqual((result["lookup_inserted"], result["lookup_skipped"]), (1, 0))
+        self.assertEqual(result["errors"], [
+            "DOMAINLOOKUPS: ('ProducingOperation', 'RSA', 'RSA UK'): string too long",
+            "Lookup_ProducingOperation: ('RSA', 'RSA UK'): string too long",
+        ])
+
+    def test_per_row_records_each_insert_before_the_next(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"per_row": dict(section("ProducingOperation", "IPC,RSA", "Intact,RSA UK"), bulk="false")})
+        insert_row = add_domains.insert_row
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "before_images.jsonl")
+            recorded = []
+
+            def checked_insert(row, fields, target_layer):
+                # what a crash at this point would leave behind
+                recorded.append(sum(len(record["oids"]) for record in read_records(path)))
+                return insert_row(row, fields, target_layer)
+
+            previous = set_before_images(BeforeImages(path, "run-1"))
+            try:
+                with mock.patch.object(add_domains, "insert_row", checked_insert):
+                    add_domains.deploy_section("per_row", config["per_row"], "local.sde")
+            finally:
+                set_before_images(previous)
+
+        self.assertEqual(recorded, [0, 1, 2, 3])
+
+    def test_sections_share_table_views(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"per_row": dict(section("ProducingOperation", "OBR", "O'Brien"), bulk="false")})
+        views = ViewRegistry()
+        previous = set_views(views)
+        try:
+            add_domains.deploy_section("add_prod_op", self.section, "local.sde")
+            add_domains.deploy_section("per_row", config["per_row"], "local.sde")
+        finally:
+            set_views(previous)
+
+        # DOMAINLOOKUPS and Lookup_ProducingOperation, the confirm check included
+        self.assertEqual(len(self.backend.views), 2)
+        views.close()
+        self.assertEqual(self.backend.views, {})
+
+    def test_pushdown_merges_without_cursors(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"merge": dict(section("ProducingOperation", "IPC,RSA,RSA", "Intact,RSA UK,RSA UK"), pushdown="true")})
+        with self.backend.insert_cursor("Lookup_ProducingOperation", ["Code", "Value"]) as cursor:
+            cursor.insertRow(["ipc", "intact"])
+        self.backend.reset_stats()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "before_images.jsonl")
+            previous = set_before_images(BeforeImages(path, "run-1"))
+            try:
+                summary = add_domains.deploy_section("merge", config["merge"], "local.sde")
+            finally:
+                set_before_images(previous)
+
+            self.assertEqual(self.backend.stats["cursor_opens"], 0)
+            self.assertEqual((summary["domain_inserted"], summary["domain_skipped"]), (2, 1))
+            self.assertEqual((summary["lookup_inserted"], summary["lookup_skipped"]), (1, 2))
+            self.assertEqual(rollback(path, "run-1", self.backend), {"deleted": 3, "restored": 0})
+        self.assertEqual(self.lookup_rows(), [("ipc",)])
+
+    def test_pushdown_falls_back_to_cursors(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"merge": dict(section("ProducingOperation", "IPC,RSA", "Intact,RSA UK"), pushdown="true")})
+
+        with mock.patch.object(SqliteBackend, "merge_rows", side_effect=MergeNotSupported("no IDENTITY")):
+            with self.assertLogs(add_domains.logger, "WARNING"):
+                summary = add_domains.deploy_section("merge", config["merge"], "local.sde")
+
+        self.assertEqual((summary["domain_inserted"], summary["lookup_inserted"]), (2, 2))
+        self.assertEqual(len(self.lookup_rows()), 2)
+
+
+class TestRebuildDomains(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["ProducingOperation", "Peril"])
+        self.previous = set_backend(self.backend)
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.directory.name, "domain_hashes.json")
+
+    def tearDown(self):
+        set_backend(self.previous)
+        self.directory.cleanup()
+
+    def deploy(self, *jobs):
+        results = add_domains.run_sections(list(jobs))
+        return add_domains.rebuild_domains(results, self.state_path)
+
+    def job(self, key, domain_type, codes, values):
+        return {"key": key, "section": section(domain_type, codes, values), "password": "pw"}
+
+    def test_one_rebuild_per_workspace(self):
+        rebuilds = self.deploy(self.job("a", "ProducingOperation", "IPC", "Intact"), self.job("b", "Peril", "EQ", "Earthquake"))
+        self.assertEqual([r["status"] for r in rebuilds], ["ok"])
+        self.assertEqual(len(self.backend.create_domains_calls), 1)
+
+    def test_rerun_without_changes_skips_rebuild(self):
+        self.deploy(self.job("a", "ProducingOperation", "IPC", "Intact"))
+        self.assertEqual(self.deploy(self.job("a", "ProducingOperation", "IPC", "Intact")), [])
+        self.assertEqual(len(self.backend.create_domains_calls), 1)
+
+    def test_no_worker_or_server_slots_is_refused(self):
+        job = self.job("a", "ProducingOperation", "IPC", "Intact")
+        for workers, per_server in ((0, 1), (2, 0)):
+            with self.assertRaises(ValueError):
+                add_domains.run_sections([job], workers, per_server)
+
+    def test_new_code_triggers_rebuild(self):
+        self.deploy(self.job("a", "ProducingOperation", "IPC", "Intact"))
+        self.deploy(self.job("a", "ProducingOperation", "RSA", "RSA UK"))
+        self.assertEqual(len(self.backend.create_domains_calls), 2)
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["ProducingOperation"])
+        self.previous = set_backend(self.backend)
+        self.directory = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"DEPLOY_PASSWORD_PNP_USER": "pw"})
+        self.env.start()
+
+        config = configparser.ConfigParser()
+        config.read_dict({"add_prod_op": section("ProducingOperation", "A,B,C,D", "a,b,c,d")})
+        self.config_path = os.path.join(self.directory.name, "config.ini")
+        with open(self.config_path, "w") as f:
+            config.write(f)
+        self.journal_path = os.path.join(self.directory.name, "journal.jsonl")
+
+    def tearDown(self):
+        self.env.stop()
+        set_backend(self.previous)
+        self.directory.cleanup()
+
+    def deploy(self, resume=False):
+        return add_domains.deploy_domains(self.config_path, chunk_size=1, resume=resume)[0]
+
+    def test_resume_carries_on_after_last_checkpoint(self):
+        insert_row = SqliteInsertCursor.insertRow
+        calls = []
+
+        def flaky_insert(cursor, row):
+            calls.append(row)
+            if len(calls) == 3:
+                raise RuntimeError("network blip")
+            return insert_row(cursor, row)
+
+        with mock.patch.object(SqliteInsertCursor, "insertRow", flaky_insert):
+            self.assertEqual(self.deploy()["status"], "failed")
+
+        result = self.deploy(resume=True)
+
+        self.assertEqual(result["status"], "ok")
+        self.assertEqual((result["domain_inserted"], result["lookup_inserted"]), (2, 4))
+        with self.backend.search_cursor("DOMAINLOOKUPS", ["Code"]) as cursor:
+            self.assertEqual(sorted(cursor), [("A",), ("B",), ("C",), ("D",)])
+        records = read_records(self.journal_path)
+        self.assertEqual([r["type"] for r in records if r["type"] in ("start", "resume", "finish")],
+                         ["start", "resume", "finish"])
+
+    def test_resume_skips_done_scopes(self):
+        with mock.patch.object(add_domains, "rebuild_domains", side_effect=RuntimeError("toolbox missing")):
+            self.deploy()
+        self.backend.reset_stats()
+
+        result = self.deploy(resume=True)
+
+        self.assertEqual((result["domain_inserted"], result["lookup_inserted"]), (0, 0))
+        # both tables journaled as done: no existence scans, no inserts
+        self.assertEqual(self.backend.stats["cursor_opens"], 1)  # the DOMAINLOOKUPS hash scan
+
+
+class TestValidation(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["Peril"])
+        self.backend.create_table("Lookup_ProducingOperation", ["Code", "Value"], {"Code": 3})
+        self.previous = set_backend(self.backend)
+        self.directory = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"DEPLOY_PASSWORD_PNP_USER": "pw"})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        set_backend(self.previous)
+        self.directory.cleanup()
+
+    def deploy(self, sections):
+        config = configparser.ConfigParser()
+        config.read_dict(sections)
+        config_path = os.path.join(self.directory.name, "config.ini")
+        with open(config_path, "w") as f:
+            config.write(f)
+        return add_domains.deploy_domains(config_path)
+
+    def test_all_problems_reported_before_any_write(self):
+        results = self.deploy({
+            "good": section("Peril", "EQ", "Earthquake"),
+            "typo": section("Peirl", "FL", "Flood"),
+            "counts": section("Peril", "ST,WS", "Storm"),
+            "lengths": section("ProducingOperation", "IPCX,RSA,rsa", "Intact,RSA UK,RSA Ireland"),
+            "per_row": {"toolbox_path": "x.pyt", "username": "PNP_USER", "server": "server", "database": "GLOBAL_EXPOSURE",
+                        "domain_type": "Peril", "source": "codes.csv", "bulk": "no"},
+        })
+
+        self.assertEqual([result["section"] for result in results], ["validation"])
+        error = results[0]["error"]
+        self.assertIn("Lookup_Peirl does not exist", error)
+        self.assertIn("[counts] has 2 codes but 1 values", error)
+        self.assertIn("Code 'IPCX' is 4 characters, the field allows 3", error)
+        self.assertIn("code 'rsa' is listed with values 'RSA UK' and 'RSA Ireland'", error)
+        self.assertIn("[per_row] bulk=false takes inline codes/values, not a source", error)
+        # the good section was not written either
+        with self.backend.search_cursor("Lookup_Peril", ["Code"]) as cursor:
+            self.assertEqual(list(cursor), [])
+        self.assertEqual(self.backend.create_domains_calls, [])
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "journal.jsonl")))
+
+    def test_repeated_identical_rows_are_fine(self):
+        results = self.deploy({"good": section("Peril", "EQ,eq ", "Earthquake,earthquake")})
+        self.assertEqual(results[0]["status"], "ok")
+
+
+class TestRunSections(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        database = os.path.join(self.directory.name, "gdb.sqlite")
+        backend = SqliteBackend(database)
+        backend.create_schema(["ProducingOperation", "Peril"])
+        backend.connection.close()
+        self.env = mock.patch.dict(os.environ, {"DEPLOY_BACKEND": "sqlite:" + database})
+        self.env.start()
+        self.previous = set_backend(None)
+
+    def tearDown(self):
+        set_backend(self.previous)
+        self.env.stop()
+        self.directory.cleanup()
+
+    def jobs(self):
+        return [
+            {"key": "add_prod_op", "section": section("ProducingOperation", "IPC,RSA", "Intact,RSA UK"), "password": "pw"},
+            {"key": "add_peril", "section": section("Peril", "EQ", "Earthquake", server="other"), "password": "pw"},
+            {"key": "bad_type", "section": section("Nope", "X", "Y"), "password": "pw"},
+        ]
+
+    def check(self, results):
+        by_section = {result["section"]: result for result in results}
+        self.assertEqual(by_section["add_prod_op"]["status"], "ok")
+        self.assertEqual(by_section["add_prod_op"]["domain_inserted"], 2)
+        self.assertEqual(by_section["add_peril"]["lookup_inserted"], 1)
+        self.assertEqual(by_section["bad_type"]["status"], "failed")
+        self.assertIn("Lookup_Nope", by_section["bad_type"]["error"])
+
+    def test_in_process(self):
+        self.check(add_domains.run_sections(self.jobs()))
+
+    def test_worker_pool(self):
+        get_metrics().clear()
+        results = add_domains.run_sections(self.jobs(), workers=2, per_server=1,
+                                           log_file=os.path.join(self.directory.name, "app.log"))
+        self.check(results)
+        # what the workers counted and timed reaches this process
+        self.assertEqual(get_metrics().counters["rows_inserted"], 2 + 2 + 1 + 1)
+        self.assertEqual(get_metrics().calls["scan"], 4)
+        self.assertNotIn("metrics", results[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
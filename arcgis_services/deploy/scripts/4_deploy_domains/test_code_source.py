@@ -0,0 +1,58 @@
+import configparser
+import os
+import tempfile
+import unittest
+
+from code_source import section_entries
+
+
+class TestSectionEntries(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def section(self, **values):
+        config = configparser.ConfigParser()
+        config.read_dict({"section": values})
+        return config["section"]
+
+    def write(self, name, text):
+        with open(os.path.join(self.directory.name, name), "w", newline="") as f:
+            f.write(text)
+
+    def test_inline_codes(self):
+        entries = section_entries(self.section(codes="A,B", values="Alpha,Beta"))
+        self.assertEqual(list(entries()), [("A", "Alpha"), ("B", "Beta")])
+
+    def test_jsonl_with_custom_fields(self):
+        self.write("codes.jsonl", '{"pc": "AB1", "name": "Aberdeen"}\n\n{"pc": "B2", "name": "Birmingham"}\n')
+        entries = section_entries(self.section(source="codes.jsonl", code_field="pc", value_field="name"),
+                                  self.directory.name)
+        self.assertEqual(list(entries()), [("AB1", "Aberdeen"), ("B2", "Birmingham")])
+
+    def test_source_can_be_read_twice(self):
+        self.write("codes.csv", "Code,Value\nA,Alpha\n")
+        entries = section_entries(self.section(source="codes.csv"), self.directory.name)
+        self.assertEqual(list(entries()), list(entries()))
+
+    def test_missing_column(self):
+        self.write("codes.csv", "Code,Name\nA,Alpha\n")
+        entries = section_entries(self.section(source="codes.csv"), self.directory.name)
+        with self.assertRaises(ValueError):
+            list(entries())
+
+    def test_jsonl_null_is_missing(self):
+        self.write("codes.jsonl", '{"Code": "A", "Value": "Alpha"}\n{"Code": "B", "Value": null}\n')
+        entries = section_entries(self.section(source="codes.jsonl"), self.directory.name)
+        with self.assertRaises(ValueError):
+            list(entries())
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            section_entries(self.section(source="codes.xlsx"), self.directory.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
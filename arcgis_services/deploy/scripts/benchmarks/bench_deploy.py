@@ -0,0 +1,167 @@
+"""
+Throughput benchmarks for the domain and peril deploy scripts
+
+Runs add_domains.deploy_section and UpdateCountryPeril against synthetic
+DOMAINLOOKUPS, Lookup_* and COUNTRYCONFIG tables in the SQLite backend and
+reports rows/sec, cursor opens, queries issued and peak Python memory.
+
+Usage:
+    python bench_deploy.py --sizes 10000 100000 1000000 --output results.json
+
+Row logging is switched off while timing, so the numbers cover the deploy
+logic and the cursor traffic rather than console/file I/O. What the scripts
+still log goes to --log-dir, or a temporary folder removed after the run.
+"""
+import argparse
+import configparser
+import datetime
+import functools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, scripts_dir)
+sys.path.insert(0, os.path.join(scripts_dir, "4_deploy_domains"))
+sys.path.insert(0, os.path.join(scripts_dir, "update_country_config"))
+
+from deploy_common.backends import SqliteBackend, set_backend
+from deploy_common.logs import stop_logging
+
+import add_domains
+from update_country_peril import UpdateCountryPeril
+
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DOMAIN_TYPE = "BenchDomain"
+WORKSPACE = "bench_server_GLOBAL_EXPOSURE.sde"
+
+
+def measure(name: str, rows: int, backend: SqliteBackend, func) -> dict:
+    """
+    Time func() and collect the backend counters and peak memory for it
+    """
+    backend.reset_stats()
+    tracemalloc.start()
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "scenario": name,
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed else None,
+        "cursor_opens": backend.stats["cursor_opens"],
+        "queries": backend.stats["queries"],
+        "peak_memory_bytes": peak,
+    }
+
+
+def seed(backend: SqliteBackend, table: str, fields: list, rows) -> None:
+    backend.connection.executemany(
+        "INSERT INTO \"{0}\" ({1}) VALUES ({2})".format(table, ", ".join(fields), ", ".join("?" for _ in fields)),
+        rows,
+    )
+    backend.connection.commit()
+
+
+def bench_add_domains(size: int) -> dict:
+    """
+    Load size codes where half of them are already in DOMAINLOOKUPS and Lookup_*
+    """
+    backend = SqliteBackend()
+    backend.create_schema([DOMAIN_TYPE])
+    existing = size // 2
+    seed(backend, "DOMAINLOOKUPS", ["DomainName", "Code", "Value"],
+         ((DOMAIN_TYPE, "C{0}".format(i), "Value {0}".format(i)) for i in range(existing)))
+    seed(backend, "Lookup_"+DOMAIN_TYPE, ["Code", "Value"],
+         (("C{0}".format(i), "Value {0}".format(i)) for i in range(existing)))
+
+    config = configparser.ConfigParser()
+    config["bench"] = {
+        "toolbox_path": "bench.pyt",
+        "domain_type": DOMAIN_TYPE,
+        "codes": ",".join("C{0}".format(i) for i in range(size)),
+        "values": ",".join("Value {0}".format(i) for i in range(size)),
+    }
+
+    previous = set_backend(backend)
+    try:
+        return measure("add_domains", size, backend, lambda: add_domains.deploy_section("bench", config["bench"], WORKSPACE))
+    finally:
+        set_backend(previous)
+
+
+def bench_update_country_peril(size: int, log_dir: str = None) -> dict:
+    """
+    Add two perils to and remove one from every one of size COUNTRYCONFIG rows
+
+    :param log_dir: folder for UpdateCountryPeril's log, defaults to its usual file
+    """
+    backend = SqliteBackend()
+    backend.create_schema()
+    countries = ["C{0}".format(i) for i in range(size)]
+    seed(backend, "COUNTRYCONFIG", ["ISO2", "Perils"], ((country, "EQ,FL,OLD") for country in countries))
+
+    config = configparser.ConfigParser()
+    config["add_perils"] = {"perils": "ST,WS", "countries_iso2_codes": ",".join(countries), "include": "true"}
+    config["remove_perils"] = {"perils": "OLD", "countries_iso2_codes": ",".join(countries), "include": "false"}
+    log_file = os.path.join(log_dir, "update_country_peril.log") if log_dir else None
+
+    return measure("update_country_peril", size, backend,
+                   lambda: UpdateCountryPeril(workspace=WORKSPACE, config=config, backend=backend, log_file=log_file))
+
+
+def run(sizes: list, log_dir: str = None) -> dict:
+    """
+    :param log_dir: folder the scripts log to, defaults to a temporary one removed afterwards
+    """
+    temporary = tempfile.TemporaryDirectory() if log_dir is None else None
+    log_dir = log_dir or temporary.name
+    os.makedirs(log_dir, exist_ok=True)
+    logging.disable(logging.INFO)
+    try:
+        results = []
+        for size in sizes:
+            for bench in (bench_add_domains, functools.partial(bench_update_country_peril, log_dir=log_dir)):
+                result = bench(size)
+                print("{scenario:>22} {rows:>9} rows {seconds:>9.2f}s {rows_per_sec:>11} rows/s "
+                      "{cursor_opens:>5} cursors {queries:>9} queries {peak_memory_bytes:>12} bytes".format(**result))
+                results.append(result)
+    finally:
+        logging.disable(logging.NOTSET)
+        if temporary is not None:
+            # the log file has to be closed before its folder can go
+            stop_logging()
+            temporary.cleanup()
+
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "backend": "sqlite",
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the domain and peril deploy scripts")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="table sizes to run")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file to write the results to")
+    parser.add_argument("--log-dir", help="folder for the scripts' logs, by default a temporary one")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.log_dir)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print("Results written to {0}".format(args.output))
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import bench_deploy
+import update_country_peril
+from deploy_common.logs import stop_logging
+
+
+class TestBenchDeploy(unittest.TestCase):
+    def setUp(self):
+        # keep UpdateCountryPeril's log out of the working folder
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(stop_logging)
+        log_file = mock.patch.object(update_country_peril, "default_log_file", os.path.join(directory.name, "update.log"))
+        log_file.start()
+        self.addCleanup(log_file.stop)
+
+    def test_small_run_reports_every_scenario(self):
+        report = bench_deploy.run([20])
+        self.assertEqual([r["scenario"] for r in report["results"]], ["add_domains", "update_country_peril"])
+        for result in report["results"]:
+            self.assertEqual(result["rows"], 20)
+            self.assertGreater(result["queries"], 0)
+            self.assertGreater(result["peak_memory_bytes"], 0)
+
+    def test_update_country_peril_reads_and_writes_with_one_cursor_each(self):
+        result = bench_deploy.bench_update_country_peril(20)
+        self.assertEqual(result["cursor_opens"], 2)
+
+
+class TestBenchLogs(unittest.TestCase):
+
+    def test_run_logs_to_a_temporary_folder(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                bench_deploy.run([5])
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(os.listdir(directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
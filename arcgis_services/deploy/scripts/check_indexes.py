@@ -0,0 +1,63 @@
+"""
+Check, and create, the attribute indexes the deploy's lookups rely on
+
+For every table, compares the columns the deploy scripts filter on with the
+indexes arcpy.ListIndexes reports, adds the missing ones with
+AddIndex_management and prints each predicate's query time before and after
+(see deploy_common/indexes.py). With --check-only nothing is created and the
+exit code is 1 if any index is missing.
+
+Usage:
+    python check_indexes.py --source pnp_user@prod-sql/GLOBAL_EXPOSURE \\
+                            --tables COUNTRYCONFIG DOMAINLOOKUPS Lookup_Peril --check-only
+
+Sources are user@server/database labels, connected through the shared pool
+(passwords as in deploy_common/connections.py), or .sde paths.
+"""
+import argparse
+import os
+import sys
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scripts_dir)
+
+from deploy_common.indexes import DEFAULT_REPEAT, describe_result, provision
+from deploy_common.metrics import get_metrics
+from deploy_common.snapshot import source_workspace
+
+
+QUALIFIER = "GLOBAL_EXPOSURE.dbo."
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Check and create the indexes behind the deploy's lookups")
+    parser.add_argument("--source", action="append", required=True,
+                        help="user@server/database or .sde path to check, can be given more than once")
+    parser.add_argument("--tables", nargs="+", default=["COUNTRYCONFIG", "DOMAINLOOKUPS"],
+                        help="tables to check, eg. COUNTRYCONFIG DOMAINLOOKUPS Lookup_Peril")
+    parser.add_argument("--qualifier", default=QUALIFIER, help="prefix of the table names in every workspace")
+    parser.add_argument("--check-only", action="store_true", help="report missing indexes, create nothing")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="runs of each predicate per timing, the fastest is printed")
+    parser.add_argument("--metrics-file", default=os.path.join(scripts_dir, "index_metrics.jsonl"),
+                        help="JSON Lines file for phase timings and counters")
+    args = parser.parse_args(argv)
+
+    ok = True
+    for source in args.source:
+        workspace = source_workspace(source)
+        print("{0}:".format(source))
+        for table in args.tables:
+            results = provision(os.path.join(workspace, args.qualifier + table), check_only=args.check_only,
+                                repeat=args.repeat)
+            for result in results:
+                print("  " + describe_result(table, result))
+            ok = ok and all(result["status"] in ("present", "created") for result in results)
+
+    get_metrics().flush(args.metrics_file)
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+param(
+    [string[]]$Stages = @("domains", "perils"),
+    [int]$Workers = 1,
+    [int]$PerServer = 1,
+    [switch]$Resume,
+    [string]$Rollback
+)
+
+$scriptPath = $MyInvocation.MyCommand.Path
+$scriptDir = Split-Path $scriptPath -Parent
+
+Set-Location -path $scriptDir
+Write-Output "Working directory : $scriptDir"
+
+$scriptFile  = Join-Path -Path $scriptDir -ChildPath 'deploy.py'
+
+Write-Output "Script to execute : $scriptFile"
+
+$arguments = @($scriptFile, "--stages") + $Stages + @("--workers", $Workers, "--per-server", $PerServer)
+if ($Resume) { $arguments += "--resume" }
+if ($Rollback) { $arguments = @($scriptFile, "--rollback", $Rollback) }
+$proc = Start-Process python -ArgumentList $arguments -NoNewWindow -PassThru
+$handle = $proc.Handle # cache proc.Handle
+$proc.WaitForExit();
+
+if ($proc.ExitCode -ne 0) {
+    Write-Warning "$_ exited with status code $($proc.ExitCode)"
+    throw [System.Exception] "Error executing the python script"
+}
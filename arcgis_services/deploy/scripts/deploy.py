@@ -0,0 +1,161 @@
+"""
+Single-process deploy runner
+
+Runs the domain deployment (4_deploy_domains/add_domains.py) and the country
+peril update (update_country_config/update_country_peril.py) as stages of one
+Python process, so arcpy is imported once, toolboxes are loaded once and the
+.sde connection pool is shared between stages.
+
+Usage:
+    python deploy.py                          # both stages, in that order
+    python deploy.py --stages perils --plan   # dry run of the peril stage only
+    python deploy.py --rollback <run id>      # undo a run from its before-images
+"""
+import argparse
+import os
+import sys
+import time
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+domains_dir = os.path.join(scripts_dir, "4_deploy_domains")
+perils_dir = os.path.join(scripts_dir, "update_country_config")
+
+sys.path.insert(0, scripts_dir)
+sys.path.insert(0, perils_dir)
+sys.path.insert(0, domains_dir)
+
+from deploy_common.before_images import DEFAULT_PATH as BEFORE_IMAGES_PATH, BeforeImages, rollback, set_before_images
+from deploy_common.metrics import get_metrics, profiled
+from deploy_common.plan import DEFAULT_CHUNK_SIZE
+from deploy_common.snapshot import DEFAULT_PATH as SNAPSHOT_PATH, SnapshotCache, new_phase, set_snapshots
+
+
+STAGES = ["domains", "perils"]
+
+
+def log_path(args, script_dir: str, name: str) -> str:
+    """
+    Where a stage logs to: --log-dir if given, else next to the stage's script
+    """
+    return os.path.join(args.log_dir or script_dir, name)
+
+
+def run_domains(args) -> list:
+    import add_domains
+    from helpers import get_logger
+
+    log_file = log_path(args, domains_dir, "app.log")
+    add_domains.logger = get_logger("Add domain entries.py", log_file)
+
+    return add_domains.deploy_domains(
+        args.domains_config, args.workers, args.per_server, args.plan, args.chunk_size,
+        args.force_rebuild, log_file, args.resume,
+    )
+
+
+def run_perils(args) -> list:
+    import configparser
+
+    from update_country_peril import UpdateCountryPeril
+
+    config = configparser.ConfigParser()
+    config.read(args.perils_config)
+
+    started = time.perf_counter()
+    journal_path = os.path.join(os.path.dirname(os.path.abspath(args.perils_config)), "journal.jsonl")
+    processor = UpdateCountryPeril(config=config, dry_run=args.plan, chunk_size=args.chunk_size,
+                                   journal_path=journal_path, resume=args.resume,
+                                   log_file=log_path(args, perils_dir, "update_country_peril.log"))
+
+    return [{
+        "section": "update_country_peril",
+        "status": "failed" if processor.errors else "ok",
+        "error": "; ".join(processor.errors) or None,
+        "seconds": round(time.perf_counter() - started, 2),
+    }]
+
+
+runners = {
+    "domains": run_domains,
+    "perils": run_perils,
+}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run the domain and country peril deploys in one process")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to run, in order")
+    parser.add_argument("--domains-config", default=os.path.join(domains_dir, "config.ini"))
+    parser.add_argument("--perils-config", default=os.path.join(perils_dir, "config", "config.ini"))
+    parser.add_argument("--plan", action="store_true", help="dry run: print the changes and stop")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rows per edit session commit")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the domains stage")
+    parser.add_argument("--per-server", type=int, default=1, help="max domain sections against one server at once")
+    parser.add_argument("--force-rebuild", action="store_true", help="run CreateDomains even if no lookup content changed")
+    parser.add_argument("--metrics-file", default=os.path.join(scripts_dir, "deploy_metrics.jsonl"),
+                        help="JSON Lines file for phase timings and counters")
+    parser.add_argument("--profile", help="write cProfile stats for the whole run to this file")
+    parser.add_argument("--log-dir", help="folder for app.log and update_country_peril.log, defaults to each stage's own folder")
+    parser.add_argument("--snapshot-cache", default=SNAPSHOT_PATH,
+                        help="local SQLite snapshot of the tables read while planning")
+    parser.add_argument("--no-snapshot-cache", action="store_true", help="always read the tables from the server")
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on from each stage's last unfinished run, journaled next to its config")
+    parser.add_argument("--before-images", default=BEFORE_IMAGES_PATH,
+                        help="file recording the rows each run inserts and the values it replaces")
+    parser.add_argument("--rollback", metavar="RUN_ID",
+                        help="undo everything run RUN_ID changed and stop (with --plan, only log it)")
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.per_server < 1:
+        parser.error("--workers and --per-server must be at least 1")
+
+    if args.rollback:
+        return run_rollback(args)
+
+    snapshots = None if args.no_snapshot_cache else SnapshotCache(args.snapshot_cache)
+    previous_snapshots = set_snapshots(snapshots)
+    previous_before_images = set_before_images(BeforeImages(args.before_images))
+
+    metrics = get_metrics()
+    failed = False
+    try:
+        with profiled(args.profile):
+            for stage in args.stages:
+                print("Stage: {0}".format(stage))
+                # fingerprints are checked once per table per stage
+                new_phase()
+                with metrics.timer("stage_" + stage):
+                    results = runners[stage](args)
+                for result in results:
+                    print("  {section}: {status} in {seconds}s{0}".format(
+                        " - " + result["error"] if result.get("error") else "", **result))
+                failed = failed or any(result["status"] != "ok" for result in results)
+    finally:
+        set_before_images(previous_before_images)
+        set_snapshots(previous_snapshots)
+        if snapshots is not None:
+            snapshots.close()
+
+    metrics.flush(args.metrics_file)
+    print("Metrics for run {0} written to {1}".format(metrics.run_id, args.metrics_file))
+
+    return 1 if failed else 0
+
+
+def run_rollback(args) -> int:
+    print("Rollback: {0}".format(args.rollback))
+    started = time.perf_counter()
+    try:
+        summary = rollback(args.before_images, args.rollback, dry_run=args.plan)
+    except Exception as e:
+        print("  rollback: failed - {0}".format(e))
+        return 1
+
+    print("  rollback: ok in {0}s ({deleted} row(s) deleted, {restored} value(s) restored){1}".format(
+        round(time.perf_counter() - started, 2), " - dry run" if args.plan else "", **summary))
+    if summary["deleted"]:
+        print("  CreateDomains has not run: redeploy with --stages domains --force-rebuild to drop the deleted codes from the domains")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
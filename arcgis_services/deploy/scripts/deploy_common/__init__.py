@@ -0,0 +1,4 @@
+# RSA 2022
+
+# Code shared by the 4_deploy_domains and update_country_config scripts.
+# The scripts add this folder's parent to sys.path before importing it.
@@ -0,0 +1,793 @@
+"""
+Cursor backends for the deploy scripts
+
+add_domains.py and update_country_peril.py go through a backend instead of
+calling arcpy.da and arcpy.management directly. ArcpyBackend is what runs on
+the ArcGIS boxes; SqliteBackend models DOMAINLOOKUPS, the Lookup_* tables and
+COUNTRYCONFIG in SQLite so the deploy logic can run (and be profiled) on a
+plain Linux agent.
+
+The backend used by the scripts is picked with the DEPLOY_BACKEND environment
+variable: "arcpy" (default), "sqlite" for an in-memory database or
+"sqlite:<path>" for a database file.
+
+Deploys that write the same tables at the same time serialise on advisory
+locks taken with lock(): sp_getapplock on SQL Server, lock files next to a
+SQLite database file.
+"""
+import contextlib
+import hashlib
+import itertools
+import os
+import re
+import sqlite3
+import threading
+
+
+DOMAINLOOKUPS = "DOMAINLOOKUPS"
+COUNTRYCONFIG = "COUNTRYCONFIG"
+LOOKUP_PREFIX = "Lookup_"
+
+# most row value constructors SQL Server takes in one INSERT
+SQL_SERVER_ROW_VALUES = 1000
+# seconds lock() waits for another deploy to let go
+DEFAULT_LOCK_TIMEOUT = 600
+# keeps the deploy's application locks apart from anyone else's
+LOCK_PREFIX = "deploy:"
+
+
+def domain_lock(domain_type: str) -> str:
+    """
+    Name of the deploy lock (see CursorBackend.lock) covering one domain type's
+    DOMAINLOOKUPS rows and its Lookup_* table
+    """
+    # domain types match case-insensitively on the server, lock names don't
+    return DOMAINLOOKUPS + ":" + domain_type.upper()
+
+
+class LockTimeout(RuntimeError):
+    """
+    Another deploy held a lock for longer than the timeout
+    """
+
+
+class MergeNotSupported(Exception):
+    """
+    The backend or a target table can't take a set-based merge; nothing was written
+    """
+
+
+def table_name(path: str) -> str:
+    """
+    Reduce a geodatabase table path to its bare table name
+
+    eg. D:\\conn.sde\\GLOBAL_EXPOSURE.dbo.Lookup_Peril -> Lookup_Peril
+
+    :param path: table path, fully qualified name or bare name
+    :returns: unqualified table name
+    """
+    base = str(path).replace("\\", "/").split("/")[-1]
+    return base.split(".")[-1]
+
+
+class CursorBackend:
+    """
+    Interface the deploy scripts use for every geodatabase read and write
+
+    Cursors follow the arcpy.da contract: they are context managers, iterate
+    rows in field order, and expose insertRow/updateRow/deleteRow.
+    """
+
+    name = None
+
+    def search_cursor(self, in_table, field_names, where_clause=None):
+        raise NotImplementedError
+
+    def insert_cursor(self, in_table, field_names):
+        raise NotImplementedError
+
+    def update_cursor(self, in_table, field_names, where_clause=None):
+        raise NotImplementedError
+
+    def make_table_view(self, in_table, out_view, workspace=None):
+        raise NotImplementedError
+
+    def delete(self, in_data):
+        raise NotImplementedError
+
+    def create_database_connection(self, directory, server, database, username, password):
+        raise NotImplementedError
+
+    def edit_session(self, workspace):
+        """
+        Context manager wrapping writes in a transaction on workspace
+
+        The session object has commit(), which saves everything written so far
+        and carries on editing. Leaving the block saves; an exception rolls back
+        whatever was written since the last commit.
+        """
+        raise NotImplementedError
+
+    def create_domains(self, toolbox_path, lookup_table, workspace):
+        raise NotImplementedError
+
+    def describe(self, in_table):
+        """
+        Fields of in_table and their lengths, or None if the table does not exist
+
+        :returns: dict of field name -> max length (None for fields without one)
+        """
+        raise NotImplementedError
+
+    def table_fingerprint(self, in_table) -> str:
+        """
+        Cheap summary of a table's content that moves whenever a row is added,
+        removed or edited: row count, max OBJECTID and a checksum of the rows
+        """
+        raise NotImplementedError
+
+    def partition_digests(self, in_table, key_fields, value_fields, prefix_length) -> dict:
+        """
+        Row count and checksum of every key-range partition of in_table, grouped on the server
+
+        A partition holds the rows with the same upper-cased leading key fields
+        and the same first prefix_length characters of the upper-cased last one.
+        Checksums only compare between tables on the same kind of backend.
+
+        :returns: dict of partition tuple -> (row count, checksum)
+        """
+        raise NotImplementedError
+
+    def merge_rows(self, workspace, fields, rows, targets, record_oids=None) -> list:
+        """
+        Insert the rows each target table is missing with set-based SQL on the server
+
+        rows are bulk appended to a temporary staging table, then each target
+        gets the staged rows it does not already have (compared on its fields)
+        in one statement, every target in the same transaction.
+
+        :param fields: staging fields, in row order
+        :param rows: iterable of rows
+        :param targets: list of (table path, fields), the fields a subset of the staging ones
+        :param record_oids: optional callable run with (table path, inserted OBJECTIDs)
+            for each target before the transaction commits
+        :returns: list of (inserted, skipped) per target; skipped counts the staged
+            rows that were already there or repeated
+        :raises MergeNotSupported: if the backend or a target table can't take
+            set-based inserts, so the caller can fall back to cursors
+        """
+        raise MergeNotSupported("{0} backend has no set-based merge".format(self.name))
+
+    def lock(self, workspace, resources, timeout=DEFAULT_LOCK_TIMEOUT):
+        """
+        Context manager holding an exclusive advisory lock on each resource name
+
+        Only deploys taking the same locks wait for each other; nothing else is
+        blocked. Locks are taken in sorted order, so two deploys asking for an
+        overlapping set can't deadlock.
+
+        :param resources: lock names, eg. table names
+        :param timeout: seconds to wait for each lock
+        :raises LockTimeout: if a lock is still held by someone else after timeout
+        """
+        raise NotImplementedError
+
+    def list_indexes(self, in_table) -> list:
+        """
+        Attribute indexes on in_table
+
+        :returns: list of (index name, list of field names in index order)
+        """
+        raise NotImplementedError
+
+    def add_index(self, in_table, fields, index_name):
+        raise NotImplementedError
+
+    def get_messages(self) -> str:
+        return ""
+
+
+class ArcpyBackend(CursorBackend):
+    """
+    Backend over arcpy; arcpy is only imported when a cursor or tool is first needed
+
+    Toolboxes are loaded once per path and reused, so several deploy stages in
+    one process share the arcpy import and the AddToolbox call.
+    """
+
+    name = "arcpy"
+
+    def __init__(self):
+        self._arcpy = None
+        self._toolboxes = {}
+        self._descriptions = {}
+
+    @property
+    def arcpy(self):
+        if self._arcpy is None:
+            import arcpy
+            self._arcpy = arcpy
+        return self._arcpy
+
+    def toolbox(self, toolbox_path: str):
+        if toolbox_path not in self._toolboxes:
+            self._toolboxes[toolbox_path] = self.arcpy.AddToolbox(toolbox_path)
+        return self._toolboxes[toolbox_path]
+
+    def search_cursor(self, in_table, field_names, where_clause=None):
+        return self.arcpy.da.SearchCursor(in_table, field_names, where_clause=where_clause)
+
+    def insert_cursor(self, in_table, field_names):
+        return self.arcpy.da.InsertCursor(in_table, field_names)
+
+    def update_cursor(self, in_table, field_names, where_clause=None):
+        return self.arcpy.da.UpdateCursor(in_table=in_table, field_names=field_names, where_clause=where_clause)
+
+    def make_table_view(self, in_table, out_view, workspace=None):
+        return self.arcpy.management.MakeTableView(in_table, out_view, workspace=workspace)
+
+    def delete(self, in_data):
+        self.arcpy.Delete_management(in_data)
+
+    def create_database_connection(self, directory, server, database, username, password):
+        filename = server+"_"+database+".sde"
+        filepath = self.arcpy.CreateDatabaseConnection_management(
+            out_folder_path=directory,
+            out_name=filename,
+            database_platform="SQL_SERVER",
+            instance=server,
+            username=username,
+            password=password,
+            save_user_pass="SAVE_USERNAME",
+            database=database,
+        )
+
+        return str(filepath)
+
+    def edit_session(self, workspace):
+        return ArcpyEditSession(self.arcpy.da.Editor(workspace))
+
+    def create_domains(self, toolbox_path, lookup_table, workspace):
+        toolbox = self.toolbox(toolbox_path)
+        toolbox.CreateDomains(
+            lookupTable=lookup_table,
+            pnpWorkspace=workspace
+        )
+
+    def describe(self, in_table):
+        # Describe is slow against SDE and the schema doesn't change mid run
+        key = str(in_table)
+        if key not in self._descriptions:
+            if not self.arcpy.Exists(key):
+                self._descriptions[key] = None
+            else:
+                fields = self.arcpy.Describe(key).fields
+                self._descriptions[key] = {
+                    field.name: field.length if field.type == "String" else None for field in fields
+                }
+        return self._descriptions[key]
+
+    def table_fingerprint(self, in_table) -> str:
+        # count and max OBJECTID miss in place updates (eg. COUNTRYCONFIG.Perils),
+        # so add a server side checksum; all three come back from one query
+        workspace, table = os.path.split(str(in_table))
+        sql = "SELECT COUNT(*), MAX(OBJECTID), CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM {0}".format(table)
+        result = self.arcpy.ArcSDESQLExecute(workspace).execute(sql)
+        return ":".join(str(value) for value in result[0])
+
+    def partition_digests(self, in_table, key_fields, value_fields, prefix_length) -> dict:
+        workspace, table = os.path.split(str(in_table))
+        partition = ", ".join(["UPPER([{0}])".format(field) for field in key_fields[:-1]] +
+                              ["UPPER(LEFT([{0}], {1}))".format(key_fields[-1], int(prefix_length))])
+        # one checksum per row, summed rather than CHECKSUM_AGG'd (an XOR) so repeated rows don't cancel out
+        checksum = "SUM(CAST(BINARY_CHECKSUM({0}) AS bigint))".format(", ".join(
+            ["UPPER([{0}])".format(field) for field in key_fields] + ["[{0}]".format(field) for field in value_fields]))
+        result = self.arcpy.ArcSDESQLExecute(workspace).execute(
+            "SELECT {0}, COUNT(*), {1} FROM {2} GROUP BY {0}".format(partition, checksum, table))
+        width = len(key_fields)
+        return {tuple(row[:width]): (int(row[width]), int(row[width + 1])) for row in _result_rows(result)}
+
+    def merge_rows(self, workspace, fields, rows, targets, record_oids=None) -> list:
+        sql = self.arcpy.ArcSDESQLExecute(workspace)
+        tables = [os.path.split(str(table))[1] for table, _ in targets]
+
+        for table in tables:
+            # OBJECTIDs of a registered table are handed out by the geodatabase,
+            # plain SQL inserts can only leave them to an IDENTITY column
+            identity = sql.execute("SELECT COLUMNPROPERTY(OBJECT_ID('{0}'), 'OBJECTID', 'IsIdentity')".format(table))
+            if _scalar(identity) != 1:
+                raise MergeNotSupported("{0}.OBJECTID is not an IDENTITY column".format(table))
+
+        columns = ", ".join("[{0}] nvarchar(4000) COLLATE DATABASE_DEFAULT".format(field) for field in fields)
+        sql.execute("CREATE TABLE #deploy_stage ({0})".format(columns))
+        try:
+            staged = 0
+            iterator = iter(rows)
+            while True:
+                batch = list(itertools.islice(iterator, SQL_SERVER_ROW_VALUES))
+                if not batch:
+                    break
+                values = ", ".join("({0})".format(", ".join(_sql_literal(value) for value in row)) for row in batch)
+                sql.execute("INSERT INTO #deploy_stage VALUES {0}".format(values))
+                staged += len(batch)
+
+            results = []
+            sql.startTransaction()
+            try:
+                for (table_path, target_fields), table in zip(targets, tables):
+                    target_columns = ", ".join("[{0}]".format(field) for field in target_fields)
+                    match = " AND ".join(
+                        "(t.[{0}] = s.[{0}] OR (t.[{0}] IS NULL AND s.[{0}] IS NULL))".format(field)
+                        for field in target_fields
+                    )
+                    inserted = sql.execute(
+                        "MERGE INTO {0} WITH (HOLDLOCK) AS t "
+                        "USING (SELECT DISTINCT {1} FROM #deploy_stage) AS s ON {2} "
+                        "WHEN NOT MATCHED BY TARGET THEN INSERT ({1}) VALUES ({3}) "
+                        "OUTPUT inserted.OBJECTID;".format(
+                            table, target_columns, match, ", ".join("s.[{0}]".format(field) for field in target_fields))
+                    )
+                    oids = [row[0] for row in _result_rows(inserted)]
+                    if record_oids is not None:
+                        record_oids(table_path, oids)
+                    results.append((len(oids), staged - len(oids)))
+                sql.commitTransaction()
+            except Exception:
+                sql.rollbackTransaction()
+                raise
+        finally:
+            sql.execute("DROP TABLE #deploy_stage")
+
+        return results
+
+    @contextlib.contextmanager
+    def lock(self, workspace, resources, timeout=DEFAULT_LOCK_TIMEOUT):
+        # session owned application locks last as long as this connection, so
+        # it is kept open until they are released
+        sql = self.arcpy.ArcSDESQLExecute(workspace)
+        held = []
+        try:
+            for resource in sorted(set(resources)):
+                result = sql.execute(
+                    "DECLARE @result int; "
+                    "EXEC @result = sp_getapplock @Resource = {0}, @LockMode = 'Exclusive', "
+                    "@LockOwner = 'Session', @LockTimeout = {1}; "
+                    "SELECT @result".format(_sql_literal(LOCK_PREFIX+resource), int(timeout * 1000)))
+                # 0 granted, 1 granted after a wait, negative timed out, deadlocked or failed
+                if int(_scalar(result)) < 0:
+                    raise LockTimeout("{0} is locked by another deploy".format(resource))
+                held.append(resource)
+            yield
+        finally:
+            for resource in reversed(held):
+                sql.execute("EXEC sp_releaseapplock @Resource = {0}, @LockOwner = 'Session'".format(
+                    _sql_literal(LOCK_PREFIX+resource)))
+
+    def list_indexes(self, in_table) -> list:
+        return [(index.name, [field.name for field in index.fields]) for index in self.arcpy.ListIndexes(str(in_table))]
+
+    def add_index(self, in_table, fields, index_name):
+        self.arcpy.AddIndex_management(str(in_table), list(fields), index_name)
+
+    def get_messages(self) -> str:
+        return self.arcpy.GetMessages()
+
+
+def _scalar(result):
+    # ArcSDESQLExecute returns a single value bare, several as a list of rows
+    while isinstance(result, list):
+        result = result[0] if result else None
+    return result
+
+
+def _result_rows(result) -> list:
+    # ArcSDESQLExecute gives a list of rows, a bare value for a single row of
+    # one column and True for a statement without a result set
+    if isinstance(result, list):
+        return result
+    if result is None or result is True:
+        return []
+    return [[result]]
+
+
+def _row_checksum(*values) -> int:
+    # SQLite's stand-in for BINARY_CHECKSUM: a signed 32 bit hash of the row
+    return int.from_bytes(hashlib.sha256(repr(values).encode("utf-8")).digest()[:4], "big", signed=True)
+
+
+def _sql_literal(value) -> str:
+    if value is None:
+        return "NULL"
+    return "N'{0}'".format(str(value).replace("'", "''"))
+
+
+class ArcpyEditSession:
+    """
+    arcpy.da.Editor session committed every time commit() is called
+    """
+
+    def __init__(self, editor):
+        self.editor = editor
+
+    def _start(self):
+        # non-versioned tables: no undo stack, single user mode
+        self.editor.startEditing(False, False)
+        self.editor.startOperation()
+
+    def __enter__(self):
+        self._start()
+        return self
+
+    def commit(self):
+        self.editor.stopOperation()
+        self.editor.stopEditing(True)
+        self._start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.editor.stopOperation()
+            self.editor.stopEditing(True)
+        else:
+            self.editor.abortOperation()
+            self.editor.stopEditing(False)
+
+
+class SqliteEditSession:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        self.backend.connection.commit()
+        self.backend.in_edit_session = True
+        return self
+
+    def commit(self):
+        self.backend.stats["commits"] += 1
+        self.backend.connection.commit()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.backend.in_edit_session = False
+        if exc_type is None:
+            self.commit()
+        else:
+            self.backend.connection.rollback()
+
+
+class _SqliteCursor:
+    """
+    Base for the SQLite cursors; commits pending writes when closed
+    """
+
+    def __init__(self, backend, in_table, field_names):
+        self.backend = backend
+        self.closed = True  # nothing to commit if resolve fails
+        backend.stats["cursor_opens"] += 1
+        self.table = backend.resolve(in_table)
+        self.fields = list(field_names)
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # inside an edit session the session decides when to commit
+            if not self.backend.in_edit_session:
+                self.backend.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _columns(self) -> str:
+        return ", ".join('"{0}"'.format(field) for field in self.fields)
+
+    def _select(self, extra: str, where_clause: str):
+        sql = "SELECT {0}{1} FROM \"{2}\"".format(extra, self._columns(), self.table)
+        if where_clause:
+            sql += " WHERE " + where_clause
+        return self.backend.execute(sql)
+
+
+class SqliteSearchCursor(_SqliteCursor):
+
+    def __init__(self, backend, in_table, field_names, where_clause=None):
+        super().__init__(backend, in_table, field_names)
+        self.rows = self._select("", where_clause)
+
+    def __iter__(self):
+        for row in self.rows:
+            yield tuple(row)
+
+
+class SqliteInsertCursor(_SqliteCursor):
+
+    def insertRow(self, row) -> int:
+        placeholders = ", ".join("?" for _ in self.fields)
+        sql = "INSERT INTO \"{0}\" ({1}) VALUES ({2})".format(self.table, self._columns(), placeholders)
+        return self.backend.execute(sql, list(row)).lastrowid
+
+
+class SqliteUpdateCursor(_SqliteCursor):
+
+    def __init__(self, backend, in_table, field_names, where_clause=None):
+        super().__init__(backend, in_table, field_names)
+        # materialise so updates don't disturb the open SELECT
+        self.rows = self._select("rowid, ", where_clause).fetchall()
+        self.current = None
+
+    def __iter__(self):
+        for row in self.rows:
+            self.current = row[0]
+            yield list(row[1:])
+
+    def updateRow(self, row):
+        assignments = ", ".join('"{0}" = ?'.format(field) for field in self.fields)
+        sql = "UPDATE \"{0}\" SET {1} WHERE rowid = ?".format(self.table, assignments)
+        self.backend.execute(sql, list(row) + [self.current])
+
+    def deleteRow(self):
+        sql = "DELETE FROM \"{0}\" WHERE rowid = ?".format(self.table)
+        self.backend.execute(sql, [self.current])
+
+
+class SqliteBackend(CursorBackend):
+    """
+    Local stand-in for the GLOBAL_EXPOSURE geodatabase
+
+    Tables are addressed by their bare name, so the same workspace paths the
+    scripts build for SQL Server resolve here too. Text columns use NOCASE to
+    match the case-insensitive collation on the server.
+
+    stats counts cursor opens and statements issued, for the benchmarks.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, database: str = ":memory:"):
+        self.database = database
+        self.connection = sqlite3.connect(database)
+        self.connection.create_function("deploy_checksum", -1, _row_checksum)
+        # SQLite's UPPER leaves non-ASCII letters alone, the server's does not
+        self.connection.create_function("deploy_upper", 1, lambda value: None if value is None else str(value).upper())
+        self.views = {}
+        self.create_domains_calls = []
+        self.in_edit_session = False
+        self.field_lengths = {}
+        self.stats = {"cursor_opens": 0, "queries": 0, "commits": 0}
+        # resource -> threading.Lock, for an in-memory database
+        self.locks = {}
+        self.locks_guard = threading.Lock()
+
+    def execute(self, sql: str, parameters=()):
+        self.stats["queries"] += 1
+        return self.connection.execute(sql, parameters)
+
+    def reset_stats(self):
+        for key in self.stats:
+            self.stats[key] = 0
+
+    def create_schema(self, domain_types=()):
+        """
+        Create DOMAINLOOKUPS, COUNTRYCONFIG and a Lookup_<type> table per domain type
+
+        :param domain_types: iterable of domain types, eg. ["ProducingOperation"]
+        """
+        self.create_table(DOMAINLOOKUPS, ["DomainName", "Code", "Value"])
+        self.create_table(COUNTRYCONFIG, ["ISO2", "Perils"])
+        for domain_type in domain_types:
+            self.create_table(LOOKUP_PREFIX+domain_type, ["Code", "Value"])
+
+    def create_table(self, name: str, fields: list, lengths: dict = None):
+        """
+        :param lengths: optional field name -> max length, reported by describe like a
+            SQL Server nvarchar(n) (SQLite itself does not enforce it)
+        """
+        if lengths is not None or name not in self.field_lengths:
+            self.field_lengths[name] = dict(lengths or {})
+        columns = ", ".join('"{0}" TEXT COLLATE NOCASE'.format(field) for field in fields)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS \"{0}\" (OBJECTID INTEGER PRIMARY KEY AUTOINCREMENT, {1})".format(name, columns)
+        )
+        self.connection.commit()
+
+    def exists(self, in_table) -> bool:
+        name = self.views.get(in_table, table_name(in_table))
+        found = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [name]
+        ).fetchone()
+        return found is not None
+
+    def resolve(self, in_table) -> str:
+        """
+        Map a view name or table path onto an existing SQLite table
+        """
+        name = self.views.get(str(in_table), table_name(in_table))
+        if not self.exists(name):
+            # same failure arcpy gives for a bad path
+            raise RuntimeError("cannot open '{0}'".format(in_table))
+        return name
+
+    def search_cursor(self, in_table, field_names, where_clause=None):
+        return SqliteSearchCursor(self, in_table, field_names, where_clause)
+
+    def insert_cursor(self, in_table, field_names):
+        return SqliteInsertCursor(self, in_table, field_names)
+
+    def update_cursor(self, in_table, field_names, where_clause=None):
+        return SqliteUpdateCursor(self, in_table, field_names, where_clause)
+
+    def make_table_view(self, in_table, out_view, workspace=None):
+        self.views[out_view] = self.resolve(in_table)
+        return out_view
+
+    def delete(self, in_data):
+        self.views.pop(str(in_data), None)
+
+    def create_database_connection(self, directory, server, database, username, password):
+        return os.path.join(directory, server+"_"+database+".sde")
+
+    def edit_session(self, workspace):
+        return SqliteEditSession(self)
+
+    def create_domains(self, toolbox_path, lookup_table, workspace):
+        self.create_domains_calls.append((lookup_table, workspace))
+
+    def describe(self, in_table):
+        if not self.exists(in_table):
+            return None
+        name = self.resolve(in_table)
+        lengths = self.field_lengths.get(name, {})
+        columns = self.connection.execute('PRAGMA table_info("{0}")'.format(name))
+        return {column[1]: lengths.get(column[1]) for column in columns}
+
+    def table_fingerprint(self, in_table) -> str:
+        name = self.resolve(in_table)
+        digest = hashlib.sha256()
+        count = 0
+        max_objectid = None
+        for row in self.execute("SELECT * FROM \"{0}\" ORDER BY OBJECTID".format(name)):
+            count += 1
+            max_objectid = row[0]
+            digest.update(repr(row).encode("utf-8"))
+        return "{0}:{1}:{2}".format(count, max_objectid, digest.hexdigest()[:16])
+
+    def partition_digests(self, in_table, key_fields, value_fields, prefix_length) -> dict:
+        name = self.resolve(in_table)
+        partition = ", ".join(['deploy_upper("{0}")'.format(field) for field in key_fields[:-1]] +
+                              ['deploy_upper(SUBSTR("{0}", 1, {1}))'.format(key_fields[-1], int(prefix_length))])
+        checksum = "SUM(deploy_checksum({0}))".format(", ".join(
+            ['deploy_upper("{0}")'.format(field) for field in key_fields] + ['"{0}"'.format(field) for field in value_fields]))
+        width = len(key_fields)
+        rows = self.execute('SELECT {0}, COUNT(*), {1} FROM "{2}" GROUP BY {0}'.format(partition, checksum, name))
+        return {tuple(row[:width]): (row[width], row[width + 1]) for row in rows}
+
+    def merge_rows(self, workspace, fields, rows, targets, record_oids=None) -> list:
+        # SQLite has no MERGE; INSERT ... SELECT ... WHERE NOT EXISTS is the same set-based insert
+        names = [self.resolve(table) for table, _ in targets]
+        columns = ", ".join('"{0}" TEXT COLLATE NOCASE'.format(field) for field in fields)
+        self.execute("DROP TABLE IF EXISTS temp.deploy_stage")
+        self.execute("CREATE TEMP TABLE deploy_stage ({0})".format(columns))
+        try:
+            placeholders = ", ".join("?" for _ in fields)
+            self.stats["queries"] += 1
+            staged = self.connection.executemany(
+                "INSERT INTO temp.deploy_stage VALUES ({0})".format(placeholders), rows).rowcount
+
+            results = []
+            for (table_path, target_fields), name in zip(targets, names):
+                target_columns = ", ".join('"{0}"'.format(field) for field in target_fields)
+                match = " AND ".join('t."{0}" IS s."{0}"'.format(field) for field in target_fields)
+                # OBJECTID is AUTOINCREMENT, so the new rows are the ones above the old maximum
+                highest = self.execute("SELECT COALESCE(MAX(OBJECTID), 0) FROM \"{0}\"".format(name)).fetchone()[0]
+                self.execute(
+                    "INSERT INTO \"{0}\" ({1}) SELECT DISTINCT {2} FROM temp.deploy_stage s "
+                    "WHERE NOT EXISTS (SELECT 1 FROM \"{0}\" t WHERE {3})".format(
+                        name, target_columns, ", ".join('s."{0}"'.format(field) for field in target_fields), match)
+                )
+                oids = [row[0] for row in self.execute(
+                    "SELECT OBJECTID FROM \"{0}\" WHERE OBJECTID > ? ORDER BY OBJECTID".format(name), [highest])]
+                if record_oids is not None:
+                    record_oids(table_path, oids)
+                results.append((len(oids), staged - len(oids)))
+            self.stats["commits"] += 1
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            self.execute("DROP TABLE IF EXISTS temp.deploy_stage")
+
+        return results
+
+    @contextlib.contextmanager
+    def lock(self, workspace, resources, timeout=DEFAULT_LOCK_TIMEOUT):
+        with contextlib.ExitStack() as stack:
+            for resource in sorted(set(resources)):
+                stack.enter_context(self._lock(resource, timeout))
+            yield
+
+    @contextlib.contextmanager
+    def _lock(self, resource, timeout):
+        if self.database == ":memory:":
+            # nobody outside this backend can see the database
+            with self.locks_guard:
+                lock = self.locks.setdefault(resource, threading.Lock())
+            if not lock.acquire(timeout=timeout):
+                raise LockTimeout("{0} is locked by another deploy".format(resource))
+            try:
+                yield
+            finally:
+                lock.release()
+            return
+
+        # an exclusive transaction on a lock file per resource works across
+        # threads and processes alike, and SQLite does the waiting
+        path = "{0}.{1}.lock".format(self.database, re.sub(r"[^\w.-]", "_", resource))
+        connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        try:
+            try:
+                connection.execute("BEGIN EXCLUSIVE")
+            except sqlite3.OperationalError:
+                raise LockTimeout("{0} is locked by another deploy".format(resource))
+            try:
+                yield
+            finally:
+                connection.execute("ROLLBACK")
+        finally:
+            connection.close()
+
+    def list_indexes(self, in_table) -> list:
+        name = self.resolve(in_table)
+        indexes = []
+        for index in self.execute('PRAGMA index_list("{0}")'.format(name)).fetchall():
+            columns = self.execute('PRAGMA index_info("{0}")'.format(index[1])).fetchall()
+            indexes.append((index[1], [column[2] for column in sorted(columns)]))
+        return indexes
+
+    def add_index(self, in_table, fields, index_name):
+        name = self.resolve(in_table)
+        columns = ", ".join('"{0}"'.format(field) for field in fields)
+        self.execute('CREATE INDEX "{0}" ON "{1}" ({2})'.format(index_name, name, columns))
+        self.connection.commit()
+
+
+_backend = None
+
+
+def backend_from_name(name: str) -> CursorBackend:
+    """
+    Build a backend from a DEPLOY_BACKEND style name
+    """
+    kind, _, argument = name.partition(":")
+    if kind == "arcpy":
+        return ArcpyBackend()
+    if kind == "sqlite":
+        return SqliteBackend(argument or ":memory:")
+    raise ValueError("Unknown deploy backend '{0}'".format(name))
+
+
+def get_backend() -> CursorBackend:
+    """
+    Backend shared by the whole process, built from DEPLOY_BACKEND on first use
+    """
+    global _backend
+    if _backend is None:
+        _backend = backend_from_name(os.environ.get("DEPLOY_BACKEND", "arcpy"))
+    return _backend
+
+
+def set_backend(backend: CursorBackend) -> CursorBackend:
+    """
+    Replace the process-wide backend, eg. with a SqliteBackend in tests
+
+    :returns: the backend that was in use before
+    """
+    global _backend
+    previous = _backend
+    _backend = backend
+    return previous
@@ -0,0 +1,229 @@
+"""
+Before-images of the rows a deploy run changes, and rollback from them
+
+The deploy scripts only ever insert DOMAINLOOKUPS and Lookup_* rows and
+update COUNTRYCONFIG.Perils, so undoing a run needs very little: the
+OBJECTIDs of the rows it inserted and the Perils value each country had
+before. Both are appended to a JSON Lines file before the edit session
+commits them, one line per committed chunk, so a crash never leaves a
+committed change without its before-image.
+
+rollback() reads one run's lines back and, per table, deletes the inserted
+rows and puts the original values back with one cursor per IN chunk, all in
+a single edit session per workspace.
+"""
+import datetime
+import json
+import logging
+import os
+
+from deploy_common.backends import COUNTRYCONFIG, DOMAINLOOKUPS, LOOKUP_PREFIX, domain_lock, get_backend, table_name
+from deploy_common.journal import read_records
+from deploy_common.metrics import get_metrics
+from deploy_common.snapshot import source_label, source_workspace
+from deploy_common.where import in_clauses
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "before_images.jsonl")
+
+OBJECTID = "OBJECTID"
+
+
+def split_table(table_path) -> tuple:
+    """
+    (source, table) for a table path, source as snapshot.source_label names the workspace
+    """
+    workspace, table = os.path.split(str(table_path))
+    return source_label(workspace), table
+
+
+class BeforeImages:
+    """
+    One run's before-images file
+
+    :param path: JSON Lines file, created on the first write
+    :param run_id: run the lines belong to, the journal's run id when there is one
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, run_id: str = None):
+        self.path = path
+        self.run_id = run_id or get_metrics().run_id
+
+    def write(self, record_type: str, **details) -> dict:
+        record = {"run_id": self.run_id, "type": record_type,
+                  "time": datetime.datetime.now().isoformat(timespec="seconds")}
+        record.update(details)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return record
+
+    def inserted(self, table_path, oids: list) -> None:
+        """
+        Record the OBJECTIDs of rows about to be committed into table_path
+        """
+        if oids:
+            source, table = split_table(table_path)
+            self.write("inserted", source=source, table=table, oids=list(oids))
+
+    def updated(self, table_path, key_field: str, field: str, values: dict) -> None:
+        """
+        Record the values of field that a commit is about to replace
+
+        :param values: dict of key_field value -> original field value
+        """
+        if values:
+            source, table = split_table(table_path)
+            self.write("updated", source=source, table=table, key_field=key_field, field=field, values=values)
+
+    def for_run(self, run_id: str):
+        """
+        The same file, written under another run id (eg. the journaled run being resumed)
+        """
+        return self if run_id == self.run_id else BeforeImages(self.path, run_id)
+
+
+def run_changes(path: str, run_id: str) -> dict:
+    """
+    Everything run_id changed, merged per table
+
+    Where the run updated a row more than once (eg. across a resume), the
+    first before-image is the one kept.
+
+    :returns: dict of (source, table) -> {"oids": set, "updates": {(key_field, field): {key: value}}}
+    :raises ValueError: if the file has nothing for run_id, or it was already rolled back
+    """
+    changes = {}
+    for record in read_records(path):
+        if record["run_id"] != run_id:
+            continue
+        if record["type"] == "rolled_back":
+            raise ValueError("Run {0} was already rolled back at {1}".format(run_id, record["time"]))
+
+        table = changes.setdefault((record.get("source"), record.get("table")), {"oids": set(), "updates": {}})
+        if record["type"] == "inserted":
+            table["oids"].update(record["oids"])
+        elif record["type"] == "updated":
+            values = table["updates"].setdefault((record["key_field"], record["field"]), {})
+            for key, value in record["values"].items():
+                values.setdefault(key.strip().upper(), value)
+
+    changes.pop((None, None), None)
+    if not changes:
+        raise ValueError("No before-images for run {0} in {1}".format(run_id, path))
+    return changes
+
+
+def rollback(path: str, run_id: str, backend=None, dry_run: bool = False) -> dict:
+    """
+    Put every table run_id changed back the way it was
+
+    Each workspace is restored holding the deploy locks (see CursorBackend.lock)
+    of the rows it touches, so a rollback never interleaves with a deploy.
+
+    :param path: before-images file the run wrote
+    :param backend: CursorBackend to write through, defaults to the process backend
+    :param dry_run: only log what would be deleted and restored
+    :returns: dict with the number of rows deleted and restored
+    """
+    backend = backend or get_backend()
+    summary = {"deleted": 0, "restored": 0}
+    changes = run_changes(path, run_id)
+
+    by_source = {}
+    for (source, table), change in sorted(changes.items()):
+        by_source.setdefault(source, []).append((table, change))
+
+    with get_metrics().timer("rollback"):
+        for source, tables in by_source.items():
+            for table, change in tables:
+                logger.info("Rollback {0} on {1}: delete {2} row(s), restore {3} value(s)".format(
+                    table, source, len(change["oids"]), sum(len(values) for values in change["updates"].values())))
+            if dry_run:
+                continue
+
+            workspace = source_workspace(source)
+            locks = set()
+            for table, change in tables:
+                locks.update(table_locks(backend, os.path.join(workspace, table), change))
+            with backend.lock(workspace, locks), backend.edit_session(workspace) as session:
+                for table, change in tables:
+                    table_path = os.path.join(workspace, table)
+                    summary["deleted"] += delete_rows(backend, table_path, change["oids"])
+                    for (key_field, field), values in change["updates"].items():
+                        summary["restored"] += restore_values(backend, table_path, key_field, field, values)
+                    session.commit()
+
+    if dry_run:
+        logger.info("Dry run, nothing rolled back")
+    else:
+        BeforeImages(path, run_id).write("rolled_back", **summary)
+        logger.info("Rolled back run {0}: {deleted} row(s) deleted, {restored} value(s) restored".format(run_id, **summary))
+    return summary
+
+
+def table_locks(backend, table_path: str, change: dict) -> set:
+    """
+    Names of the deploy locks covering the rows a rollback changes in table_path
+    """
+    name = table_name(table_path)
+    if name == COUNTRYCONFIG:
+        return {COUNTRYCONFIG}
+    if name.startswith(LOOKUP_PREFIX):
+        return {domain_lock(name[len(LOOKUP_PREFIX):])}
+    if name == DOMAINLOOKUPS:
+        # deploys never change a row's DomainName, so it can be read before the locks are held
+        domain_types = set()
+        for where in in_clauses(OBJECTID, sorted(change["oids"])):
+            with backend.search_cursor(table_path, ["DomainName"], where_clause=where) as cursor:
+                domain_types.update(row[0] for row in cursor if row[0] is not None)
+        return {domain_lock(domain_type) for domain_type in domain_types}
+    return set()
+
+
+def delete_rows(backend, table_path: str, oids) -> int:
+    deleted = 0
+    for where in in_clauses(OBJECTID, sorted(oids)):
+        with backend.update_cursor(table_path, [OBJECTID], where_clause=where) as cursor:
+            for _ in cursor:
+                cursor.deleteRow()
+                deleted += 1
+    return deleted
+
+
+def restore_values(backend, table_path: str, key_field: str, field: str, values: dict) -> int:
+    """
+    :param values: dict of upper case key -> original value; keys match case-insensitively
+    """
+    restored = 0
+    for where in in_clauses(key_field, sorted(values)):
+        with backend.update_cursor(table_path, [key_field, field], where_clause=where) as cursor:
+            for row in cursor:
+                row[1] = values[str(row[0]).strip().upper()]
+                cursor.updateRow(row)
+                restored += 1
+    return restored
+
+
+_before_images = None
+
+
+def get_before_images():
+    """
+    Before-images file of the running deploy, or None when nothing is captured
+    """
+    return _before_images
+
+
+def set_before_images(before_images):
+    """
+    Swap the process before-images file, returning the previous one
+    """
+    global _before_images
+    previous = _before_images
+    _before_images = before_images
+    return previous
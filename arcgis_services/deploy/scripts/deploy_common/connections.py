@@ -0,0 +1,159 @@
+"""
+Shared .sde connection cache for the deploy scripts
+
+One connection file is created per (server, database, username) and reused by
+every config section that targets it. Passwords are resolved once per key, in
+this order:
+
+1. DEPLOY_PASSWORD_<USERNAME> environment variable
+2. a secrets ini file named by DEPLOY_SECRETS_FILE, with a section called
+   <username>@<server>/<database> or just <username> holding password=...
+3. an interactive getpass prompt
+
+The connection files live in one temporary directory that is removed when the
+process exits.
+"""
+import atexit
+import configparser
+import logging
+import os
+import re
+import tempfile
+from getpass import getpass
+
+from deploy_common.backends import get_backend
+from deploy_common.metrics import get_metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def password_env_var(username: str) -> str:
+    return "DEPLOY_PASSWORD_" + re.sub(r"[^A-Z0-9]", "_", username.upper())
+
+
+def read_secrets_file(path: str, server: str, database: str, username: str):
+    """
+    Look a password up in a secrets ini file
+
+    :returns: password, or None if the file has no entry for the key
+    """
+    secrets = configparser.ConfigParser(interpolation=None)
+    secrets.read(path)
+    for section in ("{0}@{1}/{2}".format(username, server, database), username):
+        if secrets.has_option(section, "password"):
+            return secrets.get(section, "password")
+    return None
+
+
+class ConnectionPool:
+    """
+    Cache of .sde connection files keyed on (server, database, username)
+    """
+
+    def __init__(self, backend=None, prompt=getpass):
+        self.backend = backend
+        self.prompt = prompt
+        self._passwords = {}
+        self._workspaces = {}
+        self._labels = {}
+        self._temp_dir = None
+
+    def resolve_password(self, server: str, database: str, username: str) -> str:
+        key = (server.lower(), database.lower(), username.lower())
+        if key in self._passwords:
+            return self._passwords[key]
+
+        password = os.environ.get(password_env_var(username))
+        source = "environment"
+
+        secrets_file = os.environ.get("DEPLOY_SECRETS_FILE")
+        if password is None and secrets_file:
+            password = read_secrets_file(secrets_file, server, database, username)
+            source = "secrets file"
+
+        if password is None:
+            password = self.prompt('Password for user '+username+': ')
+            source = "prompt"
+
+        logger.info("Resolved password for {0} on {1}/{2} from {3}".format(username, server, database, source))
+        self._passwords[key] = password
+        return password
+
+    def set_password(self, server: str, database: str, username: str, password: str) -> None:
+        """
+        Seed the password for a key, eg. one resolved by a parent process
+        """
+        self._passwords[(server.lower(), database.lower(), username.lower())] = password
+
+    def get(self, server: str, database: str, username: str) -> str:
+        """
+        Return the .sde workspace for the key, creating it on first use
+
+        :returns: string path to .sde file
+        """
+        key = (server.lower(), database.lower(), username.lower())
+        if key in self._workspaces:
+            return self._workspaces[key]
+
+        password = self.resolve_password(server, database, username)
+
+        if self._temp_dir is None:
+            self._temp_dir = tempfile.TemporaryDirectory(prefix="deploy_sde_")
+
+        # one sub folder per key, so two users on the same database don't clash
+        directory = os.path.join(self._temp_dir.name, str(len(self._workspaces)))
+        os.makedirs(directory)
+
+        backend = self.backend or get_backend()
+        with get_metrics().timer("connection"):
+            workspace = backend.create_database_connection(directory, server, database, username, password)
+        logger.info("Created connection {0}".format(workspace))
+
+        self._workspaces[key] = workspace
+        self._labels[workspace] = "{2}@{0}/{1}".format(*key)
+        return workspace
+
+    def label(self, workspace: str):
+        """
+        Stable name for a workspace the pool created, eg. pnp_user@server/global_exposure
+
+        The .sde paths change every run, this does not.
+
+        :returns: label, or None if the workspace did not come from this pool
+        """
+        return self._labels.get(workspace)
+
+    def from_label(self, label: str) -> str:
+        """
+        Workspace for a label() value, eg. one written by an earlier run, connecting if need be
+        """
+        username, _, rest = label.partition("@")
+        server, _, database = rest.partition("/")
+        if not (username and server and database):
+            raise ValueError("Not a connection label: {0}".format(label))
+        return self.get(server, database, username)
+
+    def close(self):
+        """
+        Remove every connection file created by the pool
+        """
+        self._workspaces.clear()
+        self._labels.clear()
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+            self._temp_dir = None
+
+
+_pool = None
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Pool shared by the whole process, cleaned up at exit
+    """
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool()
+        atexit.register(_pool.close)
+    return _pool
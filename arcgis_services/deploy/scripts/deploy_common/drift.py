@@ -0,0 +1,161 @@
+"""
+Drift check of the deploy tables between environments
+
+Each table is split into key-range partitions: rows whose key starts with
+the same prefix (for a multi-field key, the same leading fields and the same
+prefix of the last one). One grouped query per table and environment gives
+every partition a row count and a checksum, worked out on the server (see
+CursorBackend.partition_digests), so no rows come back to the client for it.
+
+Only the partitions whose digests differ between two environments are read,
+with a LIKE 'prefix%' clause each, and compared row by row. A rollout that
+reached every environment costs one grouped query per table and environment.
+"""
+import logging
+
+from deploy_common.backends import get_backend
+from deploy_common.metrics import get_metrics
+from deploy_common.where import equals, starts_with
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFIX_LENGTH = 1
+
+# table -> (key fields, value fields); Lookup_<type> tables use LOOKUP_FIELDS
+TABLE_FIELDS = {
+    "COUNTRYCONFIG": (["ISO2"], ["Perils"]),
+    "DOMAINLOOKUPS": (["DomainName", "Code"], ["Value"]),
+}
+LOOKUP_FIELDS = (["Code"], ["Value"])
+
+
+def table_fields(table: str) -> tuple:
+    """
+    (key fields, value fields) compared for table, eg. Lookup_Peril -> (["Code"], ["Value"])
+    """
+    name = table.split(".")[-1]
+    if name in TABLE_FIELDS:
+        return TABLE_FIELDS[name]
+    if name.startswith("Lookup_"):
+        return LOOKUP_FIELDS
+    raise ValueError("No key fields known for {0}".format(table))
+
+
+def normalise_key(values) -> tuple:
+    # keys compare case-insensitively, like the server's collation
+    return tuple(None if value is None else str(value).upper() for value in values)
+
+
+def partition_of(key: tuple, prefix_length: int) -> tuple:
+    last = key[-1]
+    return key[:-1] + (None if last is None else last[:prefix_length],)
+
+
+def partition_where(key_fields: list, partition: tuple) -> str:
+    """
+    Clause selecting a partition's rows; it may also catch rows of longer prefixes,
+    which partition_rows filters out
+    """
+    clauses = []
+    for index, (field, value) in enumerate(zip(key_fields, partition)):
+        if value is None:
+            clauses.append("{0} IS NULL".format(field))
+        elif index == len(key_fields) - 1:
+            clauses.append(starts_with(field, value))
+        else:
+            clauses.append(equals(field, value))
+    return " AND ".join(clauses)
+
+
+def partition_digests(in_table, key_fields: list, value_fields: list, prefix_length: int = DEFAULT_PREFIX_LENGTH,
+                      backend=None) -> dict:
+    """
+    Row count and checksum of every key-range partition of in_table, from one grouped query
+
+    :returns: dict of partition -> (row count, checksum)
+    """
+    with get_metrics().timer("drift_digest"):
+        return (backend or get_backend()).partition_digests(in_table, key_fields, value_fields, prefix_length)
+
+
+def partition_rows(in_table, key_fields: list, value_fields: list, partition: tuple,
+                   prefix_length: int = DEFAULT_PREFIX_LENGTH, backend=None) -> dict:
+    """
+    Rows of one partition, read straight from the server
+
+    :returns: dict of normalised key -> sorted list of value tuples
+    """
+    width = len(key_fields)
+    rows = {}
+    backend = backend or get_backend()
+    where = partition_where(key_fields, partition)
+    with get_metrics().timer("drift_fetch"), backend.search_cursor(in_table, key_fields + value_fields, where) as cursor:
+        for row in cursor:
+            key = normalise_key(row[:width])
+            if partition_of(key, prefix_length) == partition:
+                rows.setdefault(key, []).append(tuple(row[width:]))
+                get_metrics().count("drift_rows_fetched")
+    return {key: sorted(values, key=repr) for key, values in rows.items()}
+
+
+def compare_table(tables: dict, key_fields: list, value_fields: list, prefix_length: int = DEFAULT_PREFIX_LENGTH,
+                  backends: dict = None) -> list:
+    """
+    Compare one table across environments, the first being the reference
+
+    :param tables: dict of environment name -> table path, in order
+    :param backends: optional dict of environment name -> CursorBackend, else
+        every environment is read through the process backend
+    :returns: list of difference dicts with the environment, key and the values
+        in the reference ("expected") and in that environment ("actual")
+    """
+    names = list(tables)
+    reference = names[0]
+    backends = backends or {}
+    digests = {
+        name: partition_digests(tables[name], key_fields, value_fields, prefix_length, backends.get(name))
+        for name in names
+    }
+    get_metrics().count("drift_partitions", len(digests[reference]))
+
+    differences = []
+    fetched = {}
+
+    def rows(name, partition):
+        if (name, partition) not in fetched:
+            fetched[name, partition] = partition_rows(
+                tables[name], key_fields, value_fields, partition, prefix_length, backends.get(name))
+        return fetched[name, partition]
+
+    for name in names[1:]:
+        differing = [
+            partition for partition in set(digests[reference]) | set(digests[name])
+            if digests[reference].get(partition) != digests[name].get(partition)
+        ]
+        get_metrics().count("drift_partitions_differing", len(differing))
+
+        for partition in sorted(differing, key=repr):
+            expected_rows, actual_rows = rows(reference, partition), rows(name, partition)
+            for key in sorted(set(expected_rows) | set(actual_rows), key=repr):
+                expected, actual = expected_rows.get(key, []), actual_rows.get(key, [])
+                if expected != actual:
+                    differences.append({"environment": name, "key": key, "expected": expected, "actual": actual})
+
+        # keep the reference's rows for the next environment, drop this one's
+        for partition in differing:
+            fetched.pop((name, partition), None)
+
+    return differences
+
+
+def describe_difference(table: str, reference: str, difference: dict) -> str:
+    key = ", ".join("NULL" if value is None else value for value in difference["key"])
+    if not difference["actual"]:
+        return "- {0} {1} [{2}]: only in {3} {4}".format(
+            difference["environment"], table, key, reference, difference["expected"])
+    if not difference["expected"]:
+        return "+ {0} {1} [{2}]: not in {3} {4}".format(
+            difference["environment"], table, key, reference, difference["actual"])
+    return "~ {0} {1} [{2}]: {3} {4} -> {5}".format(
+        difference["environment"], table, key, reference, difference["expected"], difference["actual"])
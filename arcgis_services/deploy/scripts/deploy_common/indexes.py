@@ -0,0 +1,161 @@
+"""
+Attribute indexes behind the deploy's lookup predicates
+
+The deploy scripts filter the same few columns over and over: DOMAINLOOKUPS
+on DomainName, Code and Value (the existence scans and batched checks
+in add_domains.py), each Lookup_* table on Code and Value, and COUNTRYCONFIG
+on ISO2 (every UpdateCountryPeril cursor). Without an index on them each of
+those queries is a full table scan.
+
+provision() compares the predicates with the table's indexes, creates an
+index for every predicate none of them covers (or only reports it, when
+checking), and times each predicate before and after with a sample of the
+table's own values.
+"""
+import logging
+import time
+
+from deploy_common.backends import get_backend, table_name
+from deploy_common.metrics import get_metrics
+from deploy_common.where import equals
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPEAT = 3
+
+# table -> field lists the scripts filter on, widest first so it can cover the narrower ones
+PREDICATES = {
+    "COUNTRYCONFIG": [["ISO2"]],
+    "DOMAINLOOKUPS": [["DomainName", "Code", "Value"], ["DomainName"]],
+}
+LOOKUP_PREDICATES = [["Code", "Value"]]
+
+
+def table_predicates(table: str) -> list:
+    """
+    Field lists the deploy filters table on, eg. Lookup_Peril -> [["Code", "Value"]]
+    """
+    name = table.split(".")[-1]
+    if name in PREDICATES:
+        return PREDICATES[name]
+    if name.startswith("Lookup_"):
+        return LOOKUP_PREDICATES
+    raise ValueError("No predicates known for {0}".format(table))
+
+
+def covers(index_fields: list, fields: list) -> bool:
+    """
+    Whether an index can serve an equality predicate on fields: its leading
+    columns are those fields, in any order
+    """
+    leading = index_fields[:len(fields)]
+    return len(leading) == len(fields) and sorted(f.lower() for f in leading) == sorted(f.lower() for f in fields)
+
+
+def index_name(table: str, fields: list) -> str:
+    return "IX_{0}_{1}".format(table.split(".")[-1], "_".join(fields))
+
+
+def sample_where(in_table, fields: list, backend) -> str:
+    """
+    Predicate on fields with the values of one row of in_table, or None if it is empty
+    """
+    with backend.search_cursor(in_table, fields) as cursor:
+        row = next(iter(cursor), None)
+    if row is None:
+        return None
+    return " AND ".join(
+        "{0} IS NULL".format(field) if value is None else equals(field, value) for field, value in zip(fields, row)
+    )
+
+
+def time_predicate(in_table, fields: list, where: str, backend, repeat: int = DEFAULT_REPEAT) -> float:
+    """
+    Best of repeat runs of the predicate, in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with backend.search_cursor(in_table, fields, where) as cursor:
+            for _ in cursor:
+                pass
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def provision(in_table, predicates: list = None, check_only: bool = False, repeat: int = DEFAULT_REPEAT,
+              backend=None) -> list:
+    """
+    Make sure every predicate on in_table has an index to use
+
+    Predicates are taken in order and each index created counts for the ones
+    after it, so DOMAINLOOKUPS gets one index that serves both of its.
+
+    :param predicates: field lists, defaults to table_predicates for in_table
+    :param check_only: report missing indexes, create nothing
+    :param repeat: runs per timing, the best one is kept
+    :param backend: CursorBackend to go through, defaults to the process backend
+    :returns: list of dicts per predicate: fields, status ("present", "missing",
+        "created" or "failed"), index, error and the timings "before" and "after"
+        in seconds ("after" only for indexes created; both None for an empty table)
+    """
+    backend = backend or get_backend()
+    table = table_name(in_table)
+    predicates = predicates or table_predicates(table)
+    indexes = backend.list_indexes(in_table)
+    results = []
+
+    for fields in predicates:
+        result = {"fields": list(fields), "status": "present", "index": None, "error": None,
+                  "before": None, "after": None}
+        covering = [name for name, index_fields in indexes if covers(index_fields, fields)]
+
+        where = sample_where(in_table, fields, backend)
+        if where is not None:
+            with get_metrics().timer("index_timing"):
+                result["before"] = time_predicate(in_table, fields, where, backend, repeat)
+
+        if covering:
+            result["index"] = covering[0]
+        elif check_only:
+            result["status"] = "missing"
+            get_metrics().count("indexes_missing")
+        else:
+            result["index"] = index_name(table, fields)
+            try:
+                with get_metrics().timer("add_index"):
+                    backend.add_index(in_table, fields, result["index"])
+            except Exception as e:
+                logger.error("Could not index {0} on {1}: {2}".format(table, ", ".join(fields), e))
+                result["status"] = "failed"
+                result["error"] = str(e)
+            else:
+                result["status"] = "created"
+                get_metrics().count("indexes_created")
+                indexes.append((result["index"], list(fields)))
+                if where is not None:
+                    with get_metrics().timer("index_timing"):
+                        result["after"] = time_predicate(in_table, fields, where, backend, repeat)
+
+        results.append(result)
+
+    return results
+
+
+def describe_result(table: str, result: dict) -> str:
+    timing = "no rows to time"
+    if result["before"] is not None:
+        timing = "{0:.1f} ms".format(result["before"] * 1000)
+    if result["after"] is not None:
+        timing += " -> {0:.1f} ms".format(result["after"] * 1000)
+
+    fields = ", ".join(result["fields"])
+    if result["status"] == "present":
+        return "  {0} ({1}): indexed by {2}, {3}".format(table, fields, result["index"], timing)
+    if result["status"] == "missing":
+        return "! {0} ({1}): no index, {2}".format(table, fields, timing)
+    if result["status"] == "created":
+        return "+ {0} ({1}): created {2}, {3}".format(table, fields, result["index"], timing)
+    return "x {0} ({1}): could not create {2}: {3}".format(table, fields, result["index"], result["error"])
@@ -0,0 +1,170 @@
+"""
+Append-only operation journal for resumable deploy runs
+
+Every chunk the scripts commit is recorded as a checkpoint line in a JSON
+Lines file: the run id, the scope it belongs to (eg. one section's
+DOMAINLOOKUPS inserts on one server), how far through the source the commit
+got and what it wrote. A scope that completes gets a done line, and a run
+that completes gets a finish line.
+
+A --resume run picks up the last run without a finish line. Scopes marked
+done are skipped outright; a scope with checkpoints carries on from the last
+one, so only the rows after it need an existence check. Each scope line
+carries a digest of its inputs; if the config changed since, the old
+checkpoints are ignored and the scope starts over.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+from deploy_common.metrics import get_metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def digest(value) -> str:
+    """
+    Short stable hash of a JSON-serialisable value, eg. a config section
+    """
+    text = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def read_records(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # the last line of a run killed mid write
+                logger.warning("Ignoring unreadable journal line in {0}".format(path))
+    return records
+
+
+def last_unfinished_run(path: str):
+    """
+    :returns: run id of the last run in the journal, if it never finished, else None
+    """
+    last = None
+    finished = set()
+    for record in read_records(path):
+        if record["type"] == "start":
+            last = record["run_id"]
+        elif record["type"] == "finish":
+            finished.add(record["run_id"])
+    return last if last not in finished else None
+
+
+class Journal:
+    """
+    One run's view of a journal file
+
+    Lines are appended with a single write and fsynced, so several worker
+    processes can share the file and a crash loses at most the line being
+    written.
+
+    :param path: JSON Lines journal file, created if missing
+    :param run_id: run to append to and read scope state from
+    """
+
+    def __init__(self, path: str, run_id: str):
+        self.path = path
+        self.run_id = run_id
+        self.scopes = {}
+        for record in read_records(path):
+            if record["run_id"] == run_id and "scope" in record:
+                self.scopes.setdefault(record["scope"], []).append(record)
+
+    @classmethod
+    def start(cls, path: str, resume: bool = False, run_id: str = None):
+        """
+        Open the journal for a new run, or for the unfinished run being resumed
+        """
+        if resume:
+            unfinished = last_unfinished_run(path)
+            if unfinished is not None:
+                journal = cls(path, unfinished)
+                journal.write("resume")
+                logger.info("Resuming run {0} from {1}".format(unfinished, path))
+                return journal
+            logger.info("No unfinished run in {0}, starting a new one".format(path))
+
+        journal = cls(path, run_id or get_metrics().run_id)
+        journal.write("start")
+        return journal
+
+    def write(self, record_type: str, **details) -> dict:
+        record = {"run_id": self.run_id, "type": record_type,
+                  "time": datetime.datetime.now().isoformat(timespec="seconds")}
+        record.update(details)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if "scope" in record:
+            self.scopes.setdefault(record["scope"], []).append(record)
+        return record
+
+    def checkpoint(self, scope: str, scope_digest: str, position: int, **details) -> None:
+        """
+        Record that everything in scope up to source position has been committed
+        """
+        self.write("checkpoint", scope=scope, digest=scope_digest, position=position, **details)
+
+    def done(self, scope: str, scope_digest: str, **details) -> None:
+        self.write("done", scope=scope, digest=scope_digest, **details)
+
+    def finish(self) -> None:
+        self.write("finish")
+
+    def records(self, scope: str, scope_digest: str) -> list:
+        """
+        This run's lines for scope, or [] if they were written for different inputs
+        """
+        records = self.scopes.get(scope, [])
+        matching = [record for record in records if record["digest"] == scope_digest]
+        if records and not matching:
+            logger.warning("Inputs for {0} changed since run {1}, starting it over".format(scope, self.run_id))
+        return matching
+
+    def is_done(self, scope: str, scope_digest: str) -> bool:
+        records = self.records(scope, scope_digest)
+        return bool(records) and records[-1]["type"] == "done"
+
+    def position(self, scope: str, scope_digest: str) -> int:
+        """
+        Source position of the last checkpoint in scope, 0 if there is none
+        """
+        positions = [record["position"] for record in self.records(scope, scope_digest) if record["type"] == "checkpoint"]
+        return positions[-1] if positions else 0
+
+
+_journal = None
+
+
+def get_journal():
+    """
+    Journal of the running deploy, or None when nothing is journaled (eg. a dry run)
+    """
+    return _journal
+
+
+def set_journal(journal):
+    """
+    Swap the process journal, returning the previous one
+    """
+    global _journal
+    previous = _journal
+    _journal = journal
+    return previous
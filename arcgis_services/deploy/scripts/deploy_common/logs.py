@@ -0,0 +1,82 @@
+"""
+Non-blocking, idempotent logging for the deploy scripts
+
+Loggers write to a QueueHandler; a QueueListener thread per log file does the
+console and RotatingFileHandler I/O, so logging a row costs a queue put
+rather than a synchronous file write. Calling get_logger again for the same
+logger and file returns it unchanged instead of stacking more handlers.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+
+_listeners = {}
+
+
+def _listener_for(log_file: str, display_name: str) -> logging.handlers.QueueListener:
+    key = (os.path.abspath(log_file), display_name)
+    if key not in _listeners:
+        formatter = logging.Formatter('%(asctime)s - {} - %(levelname)s - %(message)s'.format(display_name))
+
+        consoleHandler = logging.StreamHandler(sys.stdout)
+        consoleHandler.setLevel(logging.DEBUG)
+        consoleHandler.setFormatter(formatter)
+
+        fileHandler = logging.handlers.RotatingFileHandler(filename=log_file, maxBytes=1024000, backupCount=10, mode="a")
+        fileHandler.setLevel(logging.INFO)
+        fileHandler.setFormatter(formatter)
+
+        listener = logging.handlers.QueueListener(queue.Queue(), consoleHandler, fileHandler, respect_handler_level=True)
+        listener.start()
+        _listeners[key] = listener
+
+    return _listeners[key]
+
+
+def get_logger(logger_name: str, log_file: str, display_name: str = None):
+    """
+    Create a logger object configure to write to console and also a supplied log file
+
+    Safe to call repeatedly: the logger only ever gets one handler per log file.
+
+    :param logger_name: Name logger can be referenced by
+    :param log_file: path to log_file, will be created if doesn't exist, will be appended to if does
+    :param display_name: name shown in each line, defaults to logger_name
+    :returns: logging.Logger object
+    """
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(logging.DEBUG)
+
+    listener = _listener_for(log_file, display_name or logger_name)
+
+    live_queues = [live.queue for live in _listeners.values()]
+    for handler in list(logger.handlers):
+        if not isinstance(handler, logging.handlers.QueueHandler):
+            continue
+        if handler.queue is listener.queue:
+            return logger
+        if not any(handler.queue is live_queue for live_queue in live_queues):
+            # left over from a listener stop_logging already shut down
+            logger.removeHandler(handler)
+
+    logger.addHandler(logging.handlers.QueueHandler(listener.queue))
+
+    return logger
+
+
+def stop_logging():
+    """
+    Flush every queued record and stop the listener threads
+    """
+    while _listeners:
+        _, listener = _listeners.popitem()
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,116 @@
+"""
+Per-phase timers and counters for the deploy scripts
+
+Phases (connection setup, MakeTableView, cursor scans and writes,
+CreateDomains, ...) are timed with metrics.timer("phase") and counts are
+bumped with metrics.count("name"). Both are kept in memory and written as
+JSON Lines by flush(): one line per phase and one line of counters, all
+tagged with the run id, so successive runs can be appended to one file.
+A worker process hands its metrics to the parent with take(), and the parent
+adds them to its own with merge().
+
+profiled(path) wraps a whole run in cProfile and dumps the stats to path.
+"""
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import time
+import uuid
+from collections import Counter, defaultdict
+
+
+class Metrics:
+
+    def __init__(self, run_id: str = None):
+        self.run_id = run_id or datetime.datetime.now().strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+
+    @contextlib.contextmanager
+    def timer(self, phase: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[phase] += time.perf_counter() - started
+            self.calls[phase] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def take(self) -> dict:
+        """
+        The metrics collected so far as plain dicts, eg. to send from a worker process; starts afresh
+        """
+        collected = {"seconds": dict(self.seconds), "calls": dict(self.calls), "counters": dict(self.counters)}
+        self.clear()
+        return collected
+
+    def merge(self, collected: dict) -> None:
+        """
+        Add metrics from take(), eg. a worker process's, to these
+        """
+        for phase, seconds in collected["seconds"].items():
+            self.seconds[phase] += seconds
+        self.calls.update(collected["calls"])
+        self.counters.update(collected["counters"])
+
+    def clear(self) -> None:
+        self.seconds.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+    def records(self) -> list:
+        records = [
+            {"run_id": self.run_id, "type": "phase", "phase": phase,
+             "seconds": round(seconds, 6), "calls": self.calls[phase]}
+            for phase, seconds in sorted(self.seconds.items())
+        ]
+        records.append({"run_id": self.run_id, "type": "counters", "counters": dict(sorted(self.counters.items()))})
+        return records
+
+    def flush(self, path: str) -> None:
+        """
+        Append the collected metrics to a JSON Lines file and start afresh
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, "a") as f:
+            for record in self.records():
+                f.write(json.dumps(record) + "\n")
+
+        self.clear()
+
+
+_metrics = None
+
+
+def get_metrics() -> Metrics:
+    """
+    Metrics shared by the whole process
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+@contextlib.contextmanager
+def profiled(path: str = None):
+    """
+    Run the block under cProfile and dump the stats to path; a no-op when path is None
+    """
+    if not path:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,82 @@
+"""
+Plan/apply helpers shared by the deploy scripts
+
+The scripts first read the current table state once and work out the full
+diff in memory (the plan). The plan can be printed and stopped there as a dry
+run, or applied inside edit sessions that commit every chunk_size rows.
+"""
+import itertools
+import logging
+
+from deploy_common.metrics import get_metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def chunked(iterable, size: int):
+    """
+    Yield lists of at most size items from iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def apply_inserts(backend, workspace: str, table: object, fields: list, rows, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  checkpoint=None, record_oids=None) -> int:
+    """
+    Insert rows inside an edit session, committing every chunk_size rows
+
+    If a chunk fails, the rows committed by earlier chunks stay and the error
+    is raised with the count that made it in.
+
+    :param backend: CursorBackend to write through
+    :param workspace: workspace to open the edit session on
+    :param table: table or table view to insert into
+    :param fields: fields, in row order
+    :param rows: iterable of rows
+    :param chunk_size: rows per commit
+    :param checkpoint: optional callable run after each commit with the rows inserted so far,
+        eg. to journal progress
+    :param record_oids: optional callable run with the OBJECTIDs of each chunk just
+        before it is committed, eg. to capture before-images
+    :returns: number of rows inserted
+    """
+    inserted = 0
+    with get_metrics().timer("insert"), backend.edit_session(workspace) as session:
+        for chunk in chunked(rows, chunk_size):
+            with backend.insert_cursor(table, fields) as cursor:
+                oids = [cursor.insertRow(row) for row in chunk]
+            if record_oids is not None:
+                record_oids(oids)
+            session.commit()
+            inserted += len(chunk)
+            get_metrics().count("rows_inserted", len(chunk))
+            logger.info("Committed {0} rows into {1} ({2} so far)".format(len(chunk), table, inserted))
+            if checkpoint is not None:
+                checkpoint(inserted)
+
+    return inserted
+
+
+def log_plan(title: str, lines, log=None) -> int:
+    """
+    Write a plan to the log, one change per line
+
+    :param lines: iterable of change descriptions, may be a generator
+    :returns: number of changes
+    """
+    log = log or logger
+    log.info("Plan - {0}:".format(title))
+    count = 0
+    for line in lines:
+        log.info("    {0}".format(line))
+        count += 1
+    log.info("Plan - {0}: {1} change(s)".format(title, count))
+    return count
@@ -0,0 +1,251 @@
+"""
+Read-through local snapshot of the tables the deploy scripts read
+
+COUNTRYCONFIG, DOMAINLOOKUPS and the Lookup_* tables barely change between
+runs, but every run used to read them from the enterprise geodatabase again.
+SnapshotCache keeps a copy of each table (per source, table and field list)
+in a local SQLite file. The first read of a table in a run phase asks the
+backend for the table's fingerprint, a single cheap query, and only copies
+the table down again when the fingerprint has moved; later reads in the same
+phase trust that check. Where clauses are then run against the local copy,
+whose text columns use NOCASE like the server's collation.
+
+Tables the run writes to itself are marked with mark_written and from then on
+read straight from the server with the caller's where clause, so a write
+never makes the next read copy the whole table down again. recheck makes the
+next read of a table check its fingerprint again, eg. once a deploy lock is
+held and another deploy may have written to it since the phase's check.
+
+Snapshots are keyed on the connection's user@server/database label (see
+ConnectionPool.label), not on the .sde path, which is new every run.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+from deploy_common.backends import get_backend
+from deploy_common.metrics import get_metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "snapshot_cache.sqlite")
+# rows fetched from a snapshot at a time
+FETCH_SIZE = 1000
+
+
+def source_label(workspace: str) -> str:
+    """
+    Stable name for the workspace: the pool's label when it made the connection, else the path
+    """
+    from deploy_common.connections import get_pool
+
+    return get_pool().label(workspace) or os.path.normcase(os.path.abspath(workspace))
+
+
+def source_workspace(source: str) -> str:
+    """
+    Workspace for a source_label value, eg. one recorded by an earlier run
+
+    A connection label is connected again through the pool (that run's .sde
+    file is long gone), a path is the workspace itself.
+    """
+    from deploy_common.connections import get_pool
+
+    if os.path.isabs(source) or source.lower().endswith(".sde"):
+        return source
+    return get_pool().from_label(source)
+
+
+class SnapshotCache:
+    """
+    Local SQLite copies of geodatabase tables, refreshed when their fingerprint moves
+
+    :param path: SQLite file holding the snapshots, created if missing
+    :param backend: CursorBackend to read through, defaults to the process backend
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, backend=None):
+        self.path = path
+        self.backend = backend
+        # worker processes share the file; wait for each other's refreshes
+        self.connection = sqlite3.connect(path, timeout=60)
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots "
+            "(snapshot TEXT PRIMARY KEY, source TEXT, table_name TEXT, fields TEXT, fingerprint TEXT)"
+        )
+        self.connection.commit()
+        self.hits = 0
+        self.refreshes = 0
+        # snapshot -> (source, table) for the snapshots whose fingerprint was checked in this phase
+        self.verified = {}
+        # (source, table) pairs this run has written to
+        self.written = set()
+
+    def get_backend(self):
+        return self.backend or get_backend()
+
+    def key(self, in_table, fields: list) -> tuple:
+        workspace, table = os.path.split(str(in_table))
+        return source_label(workspace) if workspace else "", table, json.dumps(list(fields))
+
+    def new_phase(self) -> None:
+        """
+        Start a new run phase: each table's fingerprint is checked again on its next read
+        """
+        self.verified.clear()
+
+    def recheck(self, in_table) -> None:
+        """
+        Check in_table's fingerprint again on its next read, whatever this phase already checked
+        """
+        source, table, _ = self.key(in_table, [])
+        for snapshot in [snapshot for snapshot, key in self.verified.items() if key == (source, table.lower())]:
+            del self.verified[snapshot]
+
+    def mark_written(self, in_table) -> None:
+        """
+        Note that this run writes to in_table, so its reads bypass the snapshot from now on
+        """
+        source, table, _ = self.key(in_table, [])
+        self.written.add((source, table.lower()))
+
+    def search(self, in_table, fields: list, where_clause: str = None, backend=None):
+        """
+        Rows of in_table, like a SearchCursor but served from the snapshot
+
+        :param backend: CursorBackend for the fingerprint and any refresh, defaults to the cache's
+        :returns: generator of row tuples in fields order
+        """
+        backend = backend or self.get_backend()
+        source, table, field_list = self.key(in_table, fields)
+
+        if (source, table.lower()) in self.written:
+            get_metrics().count("snapshot_bypasses")
+            yield from _cursor_rows(backend, in_table, fields, where_clause)
+            return
+
+        snapshot = "snapshot_" + hashlib.sha1("\x1f".join((source, table, field_list)).encode("utf-8")).hexdigest()[:16]
+
+        if snapshot in self.verified:
+            current = True
+        else:
+            with get_metrics().timer("fingerprint"):
+                fingerprint = backend.table_fingerprint(in_table)
+
+            stored = self.connection.execute(
+                "SELECT fingerprint FROM snapshots WHERE snapshot = ?", [snapshot]
+            ).fetchone()
+
+            current = stored is not None and stored[0] == fingerprint
+            if not current:
+                logger.info("Refreshing snapshot of {0} on {1}".format(table, source or "default workspace"))
+                self.refresh(backend, snapshot, in_table, fields, (source, table, field_list, fingerprint))
+            self.verified[snapshot] = (source, table.lower())
+
+        if current:
+            self.hits += 1
+            get_metrics().count("snapshot_hits")
+
+        columns = ", ".join('"{0}"'.format(field) for field in fields)
+        sql = "SELECT {0} FROM \"{1}\"".format(columns, snapshot)
+        if where_clause:
+            sql += " WHERE " + where_clause
+        rows = self.connection.execute(sql)
+        while True:
+            with get_metrics().timer("snapshot_read"):
+                batch = rows.fetchmany(FETCH_SIZE)
+            if not batch:
+                return
+            for row in batch:
+                yield tuple(row)
+
+    def refresh(self, backend, snapshot: str, in_table, fields: list, details: tuple) -> None:
+        self.refreshes += 1
+        get_metrics().count("snapshot_refreshes")
+
+        columns = ", ".join('"{0}" COLLATE NOCASE'.format(field) for field in fields)
+        placeholders = ", ".join("?" for _ in fields)
+        with get_metrics().timer("snapshot_refresh"), self.connection:
+            self.connection.execute("DROP TABLE IF EXISTS \"{0}\"".format(snapshot))
+            self.connection.execute("CREATE TABLE \"{0}\" ({1})".format(snapshot, columns))
+            with backend.search_cursor(in_table, fields) as cursor:
+                self.connection.executemany(
+                    "INSERT INTO \"{0}\" VALUES ({1})".format(snapshot, placeholders), (tuple(row) for row in cursor)
+                )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)", [snapshot] + list(details)
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+_snapshots = None
+
+
+def get_snapshots():
+    """
+    Snapshot cache shared by the whole process, or None when reads go straight to the server
+    """
+    return _snapshots
+
+
+def set_snapshots(snapshots):
+    """
+    Swap the process snapshot cache (None switches it off), returning the previous one
+    """
+    global _snapshots
+    previous = _snapshots
+    _snapshots = snapshots
+    return previous
+
+
+def mark_written(in_table) -> None:
+    """
+    Tell the process snapshot cache, if there is one, that this run writes to in_table
+    """
+    snapshots = get_snapshots()
+    if snapshots is not None:
+        snapshots.mark_written(in_table)
+
+
+def recheck(in_table) -> None:
+    """
+    Have the process snapshot cache, if there is one, check in_table's fingerprint again on its next read
+    """
+    snapshots = get_snapshots()
+    if snapshots is not None:
+        snapshots.recheck(in_table)
+
+
+def new_phase() -> None:
+    """
+    Start a new run phase in the process snapshot cache, if there is one
+    """
+    snapshots = get_snapshots()
+    if snapshots is not None:
+        snapshots.new_phase()
+
+
+def read_rows(in_table, fields: list, where_clause: str = None, backend=None):
+    """
+    Rows of in_table through the snapshot cache if there is one, else with a SearchCursor
+
+    :returns: iterable of row tuples in fields order
+    """
+    snapshots = get_snapshots()
+    if snapshots is not None:
+        return snapshots.search(in_table, fields, where_clause, backend)
+
+    return _cursor_rows(backend or get_backend(), in_table, fields, where_clause)
+
+
+def _cursor_rows(backend, in_table, fields, where_clause):
+    with backend.search_cursor(in_table, fields, where_clause=where_clause) as cursor:
+        for row in cursor:
+            yield tuple(row)
@@ -0,0 +1,103 @@
+"""
+Key/value store for deduplicating streams in bounded memory
+
+Checking a 500k row source for repeats with a Python set keeps every key in
+memory for the whole pass. SpillDict holds the first max_keys in a dict and,
+past that, moves them into a temporary SQLite database with a primary key on
+the key column, which SQLite pages to a temporary file on disk rather than
+keeping in memory. The file goes when the store is closed.
+
+Keys and values are anything JSON can round-trip; tuples come back as lists.
+"""
+import json
+import sqlite3
+
+from deploy_common.metrics import get_metrics
+
+
+DEFAULT_MAX_KEYS = 50000
+
+
+class SpillDict:
+    """
+    Dict of key -> value that spills to disk past max_keys entries
+
+    :param max_keys: entries held in memory before spilling, at least 1
+    """
+
+    def __init__(self, max_keys: int = DEFAULT_MAX_KEYS):
+        if max_keys < 1:
+            raise ValueError("max_keys must be at least 1, not {0}".format(max_keys))
+        self.max_keys = max_keys
+        self._memory = {}
+        self._db = None
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __contains__(self, key) -> bool:
+        if self._db is None:
+            return key in self._memory
+        return self._db.execute("SELECT 1 FROM entries WHERE k = ?", (self._encode(key),)).fetchone() is not None
+
+    @property
+    def spilled(self) -> bool:
+        return self._db is not None
+
+    def add(self, key) -> bool:
+        """
+        Store key (with no value) unless it is there already
+
+        :returns: True if key is new
+        """
+        return self._put(key, None)[1]
+
+    def setdefault(self, key, value):
+        """
+        Value stored for key, storing value first if key is new
+        """
+        return self._put(key, value)[0]
+
+    def close(self) -> None:
+        """
+        Drop every entry and the temporary file, if there is one
+        """
+        self._memory = {}
+        self._length = 0
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _put(self, key, value) -> tuple:
+        """
+        (value stored for key, whether key is new)
+        """
+        if self._db is None:
+            if key in self._memory:
+                return self._memory[key], False
+            self._memory[key] = value
+            self._length += 1
+            if self._length > self.max_keys:
+                self._spill()
+            return value, True
+
+        encoded = self._encode(key)
+        cursor = self._db.execute("INSERT OR IGNORE INTO entries (k, v) VALUES (?, ?)", (encoded, json.dumps(value)))
+        if cursor.rowcount:
+            self._length += 1
+            return value, True
+        return json.loads(self._db.execute("SELECT v FROM entries WHERE k = ?", (encoded,)).fetchone()[0]), False
+
+    def _spill(self) -> None:
+        # "" opens a private temporary database, kept in a file once it outgrows the page cache
+        self._db = sqlite3.connect("")
+        self._db.execute("CREATE TABLE entries (k TEXT PRIMARY KEY, v TEXT) WITHOUT ROWID")
+        self._db.executemany("INSERT INTO entries (k, v) VALUES (?, ?)",
+                             ((self._encode(key), json.dumps(value)) for key, value in self._memory.items()))
+        self._memory = {}
+        get_metrics().count("dedup_spills")
+
+    @staticmethod
+    def _encode(key) -> str:
+        return json.dumps(key, separators=(",", ":"))
@@ -0,0 +1,206 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from deploy_common.backends import ArcpyBackend, LockTimeout, MergeNotSupported, SqliteBackend, backend_from_name, table_name
+
+
+class TestTableName(unittest.TestCase):
+
+    def test_windows_workspace_path(self):
+        path = 'D:\\conn\\server_GLOBAL_EXPOSURE.sde\\GLOBAL_EXPOSURE.dbo.Lookup_Peril'
+        self.assertEqual(table_name(path), 'Lookup_Peril')
+
+    def test_bare_name(self):
+        self.assertEqual(table_name('COUNTRYCONFIG'), 'COUNTRYCONFIG')
+
+
+class TestSqliteBackend(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["Peril"])
+        self.workspace = self.backend.create_database_connection("/tmp", "server", "GLOBAL_EXPOSURE", "user", "pw")
+        self.domain_path = self.workspace + "\\GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS"
+
+    def test_insert_then_search(self):
+        with self.backend.insert_cursor(self.domain_path, ["DomainName", "Code", "Value"]) as cursor:
+            oid = cursor.insertRow(["Peril", "EQ", "Earthquake"])
+        self.assertEqual(oid, 1)
+        with self.backend.search_cursor(self.domain_path, ["Code", "Value"], "DomainName = 'Peril'") as cursor:
+            self.assertEqual(list(cursor), [("EQ", "Earthquake")])
+
+    def test_describe(self):
+        self.backend.create_table("Lookup_Peril", ["Code", "Value"], {"Code": 10})
+        self.assertEqual(self.backend.describe(self.workspace + "\\GLOBAL_EXPOSURE.dbo.Lookup_Peril"),
+                         {"OBJECTID": None, "Code": 10, "Value": None})
+        self.assertIsNone(self.backend.describe("Lookup_Nope"))
+
+    def test_where_clause_is_case_insensitive(self):
+        with self.backend.insert_cursor(self.domain_path, ["DomainName", "Code", "Value"]) as cursor:
+            cursor.insertRow(["Peril", "EQ", "Earthquake"])
+        with self.backend.search_cursor(self.domain_path, ["Code"], "Code = 'eq'") as cursor:
+            self.assertEqual(len(list(cursor)), 1)
+
+    def test_update_and_delete(self):
+        with self.backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            cursor.insertRow(["NL", "EQ"])
+            cursor.insertRow(["BE", "FL"])
+        with self.backend.update_cursor("COUNTRYCONFIG", ["ISO2", "Perils"], "ISO2 IN ('NL','BE')") as cursor:
+            for row in cursor:
+                if row[0] == "NL":
+                    row[1] = "EQ,FL"
+                    cursor.updateRow(row)
+                else:
+                    cursor.deleteRow()
+        with self.backend.search_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            self.assertEqual(list(cursor), [("NL", "EQ,FL")])
+
+    def test_table_view_of_missing_table_fails(self):
+        with self.assertRaises(RuntimeError):
+            self.backend.make_table_view(self.workspace + "\\GLOBAL_EXPOSURE.dbo.Lookup_Nope", "view")
+
+    def test_table_view_resolves_to_table(self):
+        view = self.backend.make_table_view(self.domain_path, "target_layer")
+        with self.backend.insert_cursor(view, ["DomainName", "Code", "Value"]) as cursor:
+            cursor.insertRow(["Peril", "FL", "Flood"])
+        with self.backend.search_cursor(self.domain_path, ["Code"]) as cursor:
+            self.assertEqual(list(cursor), [("FL",)])
+
+    def test_merge_rows_inserts_only_missing_rows(self):
+        with self.backend.insert_cursor(self.domain_path, ["DomainName", "Code", "Value"]) as cursor:
+            cursor.insertRow(["Peril", "EQ", "Earthquake"])
+        lookup_path = self.workspace + "\\GLOBAL_EXPOSURE.dbo.Lookup_Peril"
+        recorded = []
+        rows = [["Peril", "eq", "earthquake"], ["Peril", "FL", "Flood"], ["Peril", "FL", "Flood"]]
+
+        results = self.backend.merge_rows(
+            self.workspace, ["DomainName", "Code", "Value"], rows,
+            [(self.domain_path, ["DomainName", "Code", "Value"]), (lookup_path, ["Code", "Value"])],
+            record_oids=lambda table, oids: recorded.append((table, oids)))
+
+        # matching is case-insensitive like the server, and repeats are staged once
+        self.assertEqual(results, [(1, 2), (2, 1)])
+        self.assertEqual(recorded, [(self.domain_path, [2]), (lookup_path, [1, 2])])
+        with self.backend.search_cursor(lookup_path, ["Code", "Value"]) as cursor:
+            self.assertEqual(list(cursor), [("eq", "earthquake"), ("FL", "Flood")])
+        self.assertEqual(self.backend.merge_rows(self.workspace, ["DomainName", "Code", "Value"], rows,
+                                                 [(lookup_path, ["Code", "Value"])]), [(0, 3)])
+
+    def test_merge_rows_rolls_back_every_target(self):
+        lookup_path = self.workspace + "\\GLOBAL_EXPOSURE.dbo.Lookup_Peril"
+
+        def fail(table, oids):
+            if table == lookup_path:
+                raise RuntimeError("disk full")
+
+        with self.assertRaises(RuntimeError):
+            self.backend.merge_rows(
+                self.workspace, ["DomainName", "Code", "Value"], [["Peril", "FL", "Flood"]],
+                [(self.domain_path, ["DomainName", "Code", "Value"]), (lookup_path, ["Code", "Value"])],
+                record_oids=fail)
+        with self.backend.search_cursor(self.domain_path, ["Code"]) as cursor:
+            self.assertEqual(list(cursor), [])
+
+
+class TestArcpyBackend(unittest.TestCase):
+    def setUp(self):
+        self.backend = ArcpyBackend()
+        self.backend._arcpy = mock.Mock()
+        self.sql = self.backend._arcpy.ArcSDESQLExecute.return_value
+
+    def test_partition_digests_are_grouped_on_the_server(self):
+        self.sql.execute.return_value = [["PERIL", "F", 2, 1234], ["PERIL", "E", 1, -56]]
+
+        digests = self.backend.partition_digests(
+            os.path.join("conn.sde", "GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS"), ["DomainName", "Code"], ["Value"], 1)
+
+        self.assertEqual(digests, {("PERIL", "F"): (2, 1234), ("PERIL", "E"): (1, -56)})
+        self.backend._arcpy.ArcSDESQLExecute.assert_called_once_with("conn.sde")
+        self.sql.execute.assert_called_once_with(
+            "SELECT UPPER([DomainName]), UPPER(LEFT([Code], 1)), COUNT(*), "
+            "SUM(CAST(BINARY_CHECKSUM(UPPER([DomainName]), UPPER([Code]), [Value]) AS bigint)) "
+            "FROM GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS GROUP BY UPPER([DomainName]), UPPER(LEFT([Code], 1))")
+
+    def test_partition_digests_of_an_empty_table(self):
+        self.sql.execute.return_value = True
+        digests = self.backend.partition_digests(os.path.join("conn.sde", "COUNTRYCONFIG"), ["ISO2"], ["Perils"], 1)
+        self.assertEqual(digests, {})
+
+
+    def test_merge_rows_takes_a_single_inserted_oid_bare(self):
+        domain_path = os.path.join("conn.sde", "GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS")
+        lookup_path = os.path.join("conn.sde", "GLOBAL_EXPOSURE.dbo.Lookup_Peril")
+        # IDENTITY checks, staging table, staged rows, a one-row OUTPUT comes back
+        # bare, an empty one as True, then the staging table is dropped
+        self.sql.execute.side_effect = [1, [[1]], True, True, 7, True, True]
+        recorded = []
+
+        results = self.backend.merge_rows(
+            "conn.sde", ["DomainName", "Code", "Value"], [["Peril", "FL", "Flood"], ["Peril", "EQ", "Earthquake"]],
+            [(domain_path, ["DomainName", "Code", "Value"]), (lookup_path, ["Code", "Value"])],
+            record_oids=lambda table, oids: recorded.append((table, oids)))
+
+        self.assertEqual(results, [(1, 1), (0, 2)])
+        self.assertEqual(recorded, [(domain_path, [7]), (lookup_path, [])])
+        self.sql.commitTransaction.assert_called_once_with()
+        self.assertEqual(self.sql.execute.call_args_list[-1], mock.call("DROP TABLE #deploy_stage"))
+
+    def test_merge_rows_needs_identity_oids(self):
+        self.sql.execute.return_value = 0
+
+        with self.assertRaises(MergeNotSupported):
+            self.backend.merge_rows("conn.sde", ["Code", "Value"], [["FL", "Flood"]],
+                                    [(os.path.join("conn.sde", "Lookup_Peril"), ["Code", "Value"])])
+        self.assertEqual(self.sql.execute.call_count, 1)
+
+
+class TestLocks(unittest.TestCase):
+
+    def test_sqlite_file_locks_are_shared_between_connections(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, "gdb.sqlite")
+            first, second = SqliteBackend(database), SqliteBackend(database)
+            self.addCleanup(first.connection.close)
+            self.addCleanup(second.connection.close)
+
+            with first.lock("local.sde", ["COUNTRYCONFIG"]):
+                with self.assertRaises(LockTimeout):
+                    with second.lock("local.sde", ["DOMAINLOOKUPS:Peril", "COUNTRYCONFIG"], timeout=0):
+                        pass
+                # a lock nobody holds is free
+                with second.lock("local.sde", ["DOMAINLOOKUPS:Peril"], timeout=0):
+                    pass
+            with second.lock("local.sde", ["COUNTRYCONFIG"], timeout=0):
+                pass
+
+    def test_arcpy_releases_what_it_took_when_a_lock_times_out(self):
+        backend = ArcpyBackend()
+        backend._arcpy = mock.Mock()
+        sql = backend._arcpy.ArcSDESQLExecute.return_value
+        # sp_getapplock results come back as a bare value; the release has no result set
+        sql.execute.side_effect = [0, -1, True]
+
+        with self.assertRaises(LockTimeout):
+            with backend.lock("conn.sde", ["DOMAINLOOKUPS:Peril", "COUNTRYCONFIG"], timeout=5):
+                self.fail("entered without the locks")
+
+        statements = [call.args[0] for call in sql.execute.call_args_list]
+        self.assertIn("@Resource = N'deploy:COUNTRYCONFIG'", statements[0])
+        self.assertIn("@LockTimeout = 5000", statements[0])
+        self.assertIn("@Resource = N'deploy:DOMAINLOOKUPS:Peril'", statements[1])
+        self.assertEqual(statements[2], "EXEC sp_releaseapplock @Resource = N'deploy:COUNTRYCONFIG', @LockOwner = 'Session'")
+
+
+class TestBackendFromName(unittest.TestCase):
+
+    def test_sqlite(self):
+        self.assertEqual(backend_from_name("sqlite").name, "sqlite")
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            backend_from_name("oracle")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from deploy_common.backends import LockTimeout, SqliteBackend, SqliteUpdateCursor
+from deploy_common.before_images import BeforeImages, rollback, run_changes
+from deploy_common.journal import read_records
+from deploy_common.plan import apply_inserts
+
+
+class TestBeforeImages(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "before_images.jsonl")
+        self.workspace = os.path.join(self.directory.name, "local.sde")
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["Peril"])
+        with self.backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            cursor.insertRow(["NL", "EQ"])
+            cursor.insertRow(["be", "FL"])
+        with self.backend.insert_cursor("Lookup_Peril", ["Code", "Value"]) as cursor:
+            cursor.insertRow(["EQ", "Earthquake"])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def table(self, name):
+        return os.path.join(self.workspace, "GLOBAL_EXPOSURE.dbo." + name)
+
+    def rows(self, name, fields):
+        with self.backend.search_cursor(name, fields) as cursor:
+            return sorted(tuple(row) for row in cursor)
+
+    def update(self, images, values):
+        images.updated(self.table("COUNTRYCONFIG"), "ISO2", "Perils", {
+            country: dict(self.rows("COUNTRYCONFIG", ["ISO2", "Perils"]))[country] for country in values
+        })
+        with self.backend.update_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            for row in cursor:
+                if row[0] in values:
+                    row[1] = values[row[0]]
+                    cursor.updateRow(row)
+
+    def test_rollback_deletes_inserts_and_restores_values(self):
+        images = BeforeImages(self.path, "run-1")
+        apply_inserts(self.backend, self.workspace, "Lookup_Peril", ["Code", "Value"],
+                      [["FL", "Flood"], ["ST", "Storm"], ["WF", "Wildfire"]], chunk_size=2,
+                      record_oids=lambda oids: images.inserted(self.table("Lookup_Peril"), oids))
+        self.update(images, {"NL": "EQ,ST", "be": "FL,ST"})
+        self.update(images, {"NL": "EQ,ST,WF"})
+
+        summary = rollback(self.path, "run-1", self.backend)
+
+        self.assertEqual(summary, {"deleted": 3, "restored": 2})
+        self.assertEqual(self.rows("Lookup_Peril", ["Code"]), [("EQ",)])
+        # the first before-image of NL wins, and keys match whatever case the row has
+        self.assertEqual(self.rows("COUNTRYCONFIG", ["ISO2", "Perils"]), [("NL", "EQ"), ("be", "FL")])
+
+    def test_rollback_holds_the_deploy_locks(self):
+        images = BeforeImages(self.path, "run-1")
+        apply_inserts(self.backend, self.workspace, "DOMAINLOOKUPS", ["DomainName", "Code", "Value"],
+                      [["Peril", "FL", "Flood"], ["ProducingOperation", "IPC", "Intact"]], chunk_size=10,
+                      record_oids=lambda oids: images.inserted(self.table("DOMAINLOOKUPS"), oids))
+        images.inserted(self.table("Lookup_Peril"), [1])
+        self.update(images, {"NL": "EQ,ST"})
+        delete_row = SqliteUpdateCursor.deleteRow
+        refused = []
+
+        def locked_delete(cursor):
+            try:
+                with self.backend.lock(self.workspace, ["COUNTRYCONFIG"], timeout=0):
+                    pass
+            except LockTimeout:
+                refused.append(cursor.table)
+            delete_row(cursor)
+
+        with mock.patch.object(self.backend, "lock", wraps=self.backend.lock) as lock, \
+                mock.patch.object(SqliteUpdateCursor, "deleteRow", locked_delete):
+            self.assertEqual(rollback(self.path, "run-1", self.backend), {"deleted": 3, "restored": 1})
+
+        lock.assert_any_call(self.workspace, {"COUNTRYCONFIG", "DOMAINLOOKUPS:PERIL", "DOMAINLOOKUPS:PRODUCINGOPERATION"})
+        self.assertEqual(refused, ["DOMAINLOOKUPS", "DOMAINLOOKUPS", "Lookup_Peril"])
+
+    def test_one_line_per_commit(self):
+        images = BeforeImages(self.path, "run-1")
+        apply_inserts(self.backend, self.workspace, "Lookup_Peril", ["Code", "Value"],
+                      [["FL", "Flood"], ["ST", "Storm"], ["WF", "Wildfire"]], chunk_size=2,
+                      record_oids=lambda oids: images.inserted(self.table("Lookup_Peril"), oids))
+        self.assertEqual([record["oids"] for record in read_records(self.path)], [[2, 3], [4]])
+
+    def test_dry_run_and_other_runs_are_left_alone(self):
+        BeforeImages(self.path, "run-1").inserted(self.table("Lookup_Peril"), [1])
+        self.update(BeforeImages(self.path, "run-2"), {"NL": "EQ,ST"})
+
+        self.assertEqual(rollback(self.path, "run-2", self.backend, dry_run=True), {"deleted": 0, "restored": 0})
+        self.assertEqual(rollback(self.path, "run-2", self.backend), {"deleted": 0, "restored": 1})
+        self.assertEqual(self.rows("Lookup_Peril", ["Code"]), [("EQ",)])
+
+    def test_rollback_only_once(self):
+        self.update(BeforeImages(self.path, "run-1"), {"NL": "EQ,ST"})
+        rollback(self.path, "run-1", self.backend)
+        with self.assertRaises(ValueError):
+            rollback(self.path, "run-1", self.backend)
+
+    def test_unknown_run(self):
+        with self.assertRaises(ValueError):
+            run_changes(self.path, "run-1")
+
+
+if __name__ == '__main__':
+    unittest.main()
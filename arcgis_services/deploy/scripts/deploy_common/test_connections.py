@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from deploy_common.backends import SqliteBackend
+from deploy_common.connections import ConnectionPool
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.prompts = []
+        self.pool = ConnectionPool(backend=SqliteBackend(), prompt=self.prompt)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def prompt(self, message):
+        self.prompts.append(message)
+        return "secret"
+
+    def test_same_key_reuses_connection_and_prompts_once(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            first = self.pool.get("server", "GLOBAL_EXPOSURE", "PNP_USER")
+            second = self.pool.get("SERVER", "global_exposure", "PNP_USER")
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.prompts), 1)
+
+    def test_different_database_gets_new_connection(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            first = self.pool.get("server", "GLOBAL_EXPOSURE", "PNP_USER")
+            second = self.pool.get("server", "GRA_REPOSITORY", "PNP_USER")
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.prompts), 2)
+
+    def test_password_from_environment(self):
+        with mock.patch.dict(os.environ, {"DEPLOY_PASSWORD_PNP_USER": "from-env"}, clear=True):
+            password = self.pool.resolve_password("server", "GLOBAL_EXPOSURE", "PNP_USER")
+        self.assertEqual(password, "from-env")
+        self.assertEqual(self.prompts, [])
+
+    def test_password_from_secrets_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "secrets.ini")
+            with open(path, "w") as f:
+                f.write("[PNP_USER@server/GLOBAL_EXPOSURE]\npassword=from-file\n")
+            with mock.patch.dict(os.environ, {"DEPLOY_SECRETS_FILE": path}, clear=True):
+                password = self.pool.resolve_password("server", "GLOBAL_EXPOSURE", "PNP_USER")
+        self.assertEqual(password, "from-file")
+        self.assertEqual(self.prompts, [])
+
+    def test_close_removes_connection_folder(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            self.pool.get("server", "GLOBAL_EXPOSURE", "PNP_USER")
+        directory = self.pool._temp_dir.name
+        self.pool.close()
+        self.assertFalse(os.path.exists(directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
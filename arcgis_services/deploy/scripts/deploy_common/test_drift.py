@@ -0,0 +1,81 @@
+import unittest
+from unittest import mock
+
+from deploy_common.backends import SqliteBackend
+from deploy_common.drift import compare_table, describe_difference, partition_digests, table_fields
+from deploy_common.metrics import Metrics
+
+
+def environment(countries, lookups=()):
+    backend = SqliteBackend()
+    backend.create_schema(["Peril"])
+    with backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+        for row in countries:
+            cursor.insertRow(row)
+    with backend.insert_cursor("Lookup_Peril", ["Code", "Value"]) as cursor:
+        for row in lookups:
+            cursor.insertRow(row)
+    return backend
+
+
+class TestDrift(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics("test")
+        patcher = mock.patch("deploy_common.drift.get_metrics", return_value=self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def compare(self, table, backends, prefix_length=1):
+        tables = {name: name + ".sde/GLOBAL_EXPOSURE.dbo." + table for name in backends}
+        return compare_table(tables, *table_fields(table), prefix_length=prefix_length, backends=backends)
+
+    def test_only_differing_partitions_are_fetched(self):
+        countries = [["NL", "EQ"], ["BE", "EQ"], ["FR", "FL"], ["DE", "FL"]]
+        staging = environment(countries + [["NO", "ST"]])
+        prod = environment([["nl", "EQ,FL"], ["BE", "EQ"], ["DE", "FL"], ["FR", "FL"]])
+
+        differences = self.compare("COUNTRYCONFIG", {"staging": staging, "prod": prod})
+
+        self.assertEqual(differences, [
+            {"environment": "prod", "key": ("NL",), "expected": [("EQ",)], "actual": [("EQ,FL",)]},
+            {"environment": "prod", "key": ("NO",), "expected": [("ST",)], "actual": []},
+        ])
+        # only the N partition is read again, NL and NO from staging and NL from prod
+        self.assertEqual(self.metrics.counters["drift_partitions_differing"], 1)
+        self.assertEqual(self.metrics.counters["drift_rows_fetched"], 3)
+        self.assertEqual(describe_difference("COUNTRYCONFIG", "staging", differences[1]),
+                         "- prod COUNTRYCONFIG [NO]: only in staging [('ST',)]")
+
+    def test_longer_prefixes_are_filtered_out_of_a_partition(self):
+        staging = environment([], [["A", "Ash"], ["AB", "Abc"], ["A%", "Percent"]])
+        prod = environment([], [["A", "Ash fall"], ["AB", "Abc"], ["A%", "Percent"]])
+
+        differences = self.compare("Lookup_Peril", {"staging": staging, "prod": prod}, prefix_length=2)
+
+        self.assertEqual([difference["key"] for difference in differences], [("A",)])
+        self.assertEqual(self.metrics.counters["drift_rows_fetched"], 2)
+
+    def test_no_drift(self):
+        rows = [["NL", "EQ"], ["BE", "EQ"]]
+        self.assertEqual(self.compare("COUNTRYCONFIG", {"a": environment(rows), "b": environment(rows[::-1])}), [])
+        self.assertNotIn("drift_rows_fetched", self.metrics.counters)
+
+    def test_partition_digests_are_one_grouped_query(self):
+        backend = environment([["NL", "EQ"], ["no", "ST"], ["BE", "EQ"]])
+        backend.reset_stats()
+
+        digests = partition_digests("a.sde/COUNTRYCONFIG", ["ISO2"], ["Perils"], backend=backend)
+
+        self.assertEqual({partition: count for partition, (count, _) in digests.items()}, {("N",): 2, ("B",): 1})
+        self.assertEqual((backend.stats["queries"], backend.stats["cursor_opens"]), (1, 0))
+        # the same rows in any order and key case give the same checksums
+        same = environment([["BE", "EQ"], ["NO", "ST"], ["nl", "EQ"]])
+        self.assertEqual(partition_digests("b.sde/COUNTRYCONFIG", ["ISO2"], ["Perils"], backend=same), digests)
+
+    def test_unknown_table(self):
+        with self.assertRaises(ValueError):
+            table_fields("GLOBAL_EXPOSURE.dbo.SOMETHING")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from deploy_common.backends import SqliteBackend
+from deploy_common.indexes import covers, provision, sample_where
+
+
+class TestIndexes(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["Peril"])
+        with self.backend.insert_cursor("DOMAINLOOKUPS", ["DomainName", "Code", "Value"]) as cursor:
+            cursor.insertRow(["Peril", "EQ", "O'Quake"])
+            cursor.insertRow(["Peril", "FL", "Flood"])
+
+    def test_covers_leading_fields_in_any_order(self):
+        self.assertTrue(covers(["code", "DomainName", "Value"], ["DomainName", "Code"]))
+        self.assertFalse(covers(["Code", "Value", "DomainName"], ["DomainName"]))
+        self.assertFalse(covers(["DomainName"], ["DomainName", "Code"]))
+
+    def test_sample_where(self):
+        self.assertEqual(sample_where("DOMAINLOOKUPS", ["Code", "Value"], self.backend),
+                         "Code = 'EQ' AND Value = 'O''Quake'")
+        self.assertIsNone(sample_where("COUNTRYCONFIG", ["ISO2"], self.backend))
+
+    def test_check_only_creates_nothing(self):
+        results = provision("server.sde\\GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS", check_only=True, repeat=1,
+                            backend=self.backend)
+        self.assertEqual([result["status"] for result in results], ["missing", "missing"])
+        self.assertIsNotNone(results[0]["before"])
+        self.assertEqual(self.backend.list_indexes("DOMAINLOOKUPS"), [])
+
+    def test_one_index_serves_both_predicates(self):
+        results = provision("server.sde\\GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS", repeat=1, backend=self.backend)
+
+        self.assertEqual([(result["status"], result["index"]) for result in results], [
+            ("created", "IX_DOMAINLOOKUPS_DomainName_Code_Value"),
+            ("present", "IX_DOMAINLOOKUPS_DomainName_Code_Value"),
+        ])
+        self.assertIsNotNone(results[0]["after"])
+        self.assertEqual(self.backend.list_indexes("DOMAINLOOKUPS"),
+                         [("IX_DOMAINLOOKUPS_DomainName_Code_Value", ["DomainName", "Code", "Value"])])
+        self.assertEqual([result["status"] for result in provision("DOMAINLOOKUPS", repeat=1, backend=self.backend)],
+                         ["present", "present"])
+
+    def test_empty_table_is_indexed_without_timings(self):
+        results = provision("COUNTRYCONFIG", repeat=1, backend=self.backend)
+        self.assertEqual([(result["status"], result["before"], result["after"]) for result in results],
+                         [("created", None, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from deploy_common.logs import get_logger, stop_logging
+from deploy_common.metrics import Metrics, profiled
+
+
+class TestGetLogger(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_file = os.path.join(self.directory.name, "app.log")
+
+    def tearDown(self):
+        stop_logging()
+        self.directory.cleanup()
+
+    def test_repeated_calls_add_one_handler(self):
+        logger = get_logger("test_repeated_calls", self.log_file)
+        get_logger("test_repeated_calls", self.log_file)
+        self.assertEqual(len(logger.handlers), 1)
+
+    def test_lines_reach_the_file_once(self):
+        logger = get_logger("test_lines_reach_the_file", self.log_file, "script.py")
+        get_logger("test_lines_reach_the_file", self.log_file, "script.py")
+        logger.info("hello")
+        logger.debug("console only")
+        stop_logging()
+        with open(self.log_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn("- script.py - INFO - hello", lines[0])
+
+    def test_stale_handler_replaced_after_stop(self):
+        logger = get_logger("test_stale_handler", self.log_file)
+        stop_logging()
+        get_logger("test_stale_handler", self.log_file)
+        self.assertEqual(len(logger.handlers), 1)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_flush_writes_phases_and_counters(self):
+        metrics = Metrics("run-1")
+        with metrics.timer("scan"):
+            pass
+        with metrics.timer("scan"):
+            pass
+        metrics.count("rows_inserted", 5)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.jsonl")
+            metrics.flush(path)
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+
+        self.assertEqual(records[0]["phase"], "scan")
+        self.assertEqual(records[0]["calls"], 2)
+        self.assertEqual(records[1], {"run_id": "run-1", "type": "counters", "counters": {"rows_inserted": 5}})
+        self.assertEqual(metrics.records()[-1]["counters"], {})
+
+    def test_take_and_merge(self):
+        worker = Metrics("run-1")
+        with worker.timer("scan"):
+            pass
+        worker.count("rows_inserted", 5)
+        parent = Metrics("run-1")
+        parent.count("rows_inserted", 2)
+
+        parent.merge(worker.take())
+
+        self.assertEqual(parent.counters, {"rows_inserted": 7})
+        self.assertEqual(parent.calls["scan"], 1)
+        self.assertEqual(worker.take(), {"seconds": {}, "calls": {}, "counters": {}})
+
+    def test_profiled_dumps_stats(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run.prof")
+            with profiled(path):
+                sum(range(10))
+            self.assertTrue(os.path.getsize(path) > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
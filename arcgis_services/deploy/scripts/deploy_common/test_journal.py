@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+from deploy_common.journal import Journal, digest, last_unfinished_run, read_records
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "journal.jsonl")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_resume_picks_up_unfinished_run(self):
+        journal = Journal.start(self.path, run_id="run-1")
+        journal.checkpoint("scope", "d1", 100)
+        journal.checkpoint("scope", "d1", 200)
+
+        resumed = Journal.start(self.path, resume=True)
+
+        self.assertEqual(resumed.run_id, "run-1")
+        self.assertEqual(resumed.position("scope", "d1"), 200)
+        self.assertFalse(resumed.is_done("scope", "d1"))
+
+    def test_finished_run_is_not_resumed(self):
+        journal = Journal.start(self.path, run_id="run-1")
+        journal.done("scope", "d1")
+        journal.finish()
+
+        self.assertIsNone(last_unfinished_run(self.path))
+        resumed = Journal.start(self.path, resume=True, run_id="run-2")
+        self.assertEqual(resumed.run_id, "run-2")
+        self.assertEqual(resumed.position("scope", "d1"), 0)
+
+    def test_changed_inputs_start_over(self):
+        journal = Journal.start(self.path, run_id="run-1")
+        journal.done("scope", digest({"codes": "A"}))
+
+        resumed = Journal.start(self.path, resume=True)
+        self.assertTrue(resumed.is_done("scope", digest({"codes": "A"})))
+        self.assertFalse(resumed.is_done("scope", digest({"codes": "A,B"})))
+
+    def test_torn_last_line_is_ignored(self):
+        Journal.start(self.path, run_id="run-1").checkpoint("scope", "d1", 10)
+        with open(self.path, "a") as f:
+            f.write('{"run_id": "run-1", "type": "checkp')
+
+        self.assertEqual(len(read_records(self.path)), 2)
+        self.assertEqual(Journal.start(self.path, resume=True).position("scope", "d1"), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from deploy_common.backends import SqliteBackend
+from deploy_common.plan import apply_inserts, chunked
+
+
+class TestChunked(unittest.TestCase):
+
+    def test_last_chunk_is_short(self):
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_empty(self):
+        self.assertEqual(list(chunked([], 2)), [])
+
+
+class TestApplyInserts(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["Peril"])
+
+    def count(self):
+        with self.backend.search_cursor("Lookup_Peril", ["Code"]) as cursor:
+            return len(list(cursor))
+
+    def test_commits_each_chunk(self):
+        rows = [["C{0}".format(i), "V"] for i in range(5)]
+        inserted = apply_inserts(self.backend, "local.sde", "Lookup_Peril", ["Code", "Value"], rows, chunk_size=2)
+        self.assertEqual(inserted, 5)
+        self.assertEqual(self.count(), 5)
+
+    def test_failed_chunk_keeps_earlier_commits(self):
+        def rows():
+            yield ["C1", "V"]
+            yield ["C2", "V"]
+            yield ["C3", "V"]
+            raise RuntimeError("network blip")
+
+        with self.assertRaises(RuntimeError):
+            apply_inserts(self.backend, "local.sde", "Lookup_Peril", ["Code", "Value"], rows(), chunk_size=2)
+        self.assertEqual(self.count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from deploy_common.backends import SqliteBackend
+from deploy_common.snapshot import SnapshotCache, read_rows, set_snapshots
+
+
+class TestSnapshotCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = SqliteBackend()
+        self.backend.create_schema()
+        with self.backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            cursor.insertRow(["NL", "FL"])
+            cursor.insertRow(["BE", "EQ"])
+        self.cache = SnapshotCache(os.path.join(self.directory.name, "snapshots.sqlite"), self.backend)
+        self.table = os.path.join("local.sde", "GLOBAL_EXPOSURE.dbo.COUNTRYCONFIG")
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def search(self, where=None):
+        return sorted(self.cache.search(self.table, ["ISO2", "Perils"], where))
+
+    def test_second_read_is_local(self):
+        self.assertEqual(self.search(), [("BE", "EQ"), ("NL", "FL")])
+        self.backend.reset_stats()
+
+        self.assertEqual(self.search("ISO2 IN ('nl')"), [("NL", "FL")])
+        self.assertEqual((self.cache.refreshes, self.cache.hits), (1, 1))
+        self.assertEqual(self.backend.stats["cursor_opens"], 0)
+
+    def test_in_place_update_moves_fingerprint(self):
+        self.search()
+        with self.backend.update_cursor("COUNTRYCONFIG", ["Perils"], "ISO2 = 'NL'") as cursor:
+            for row in cursor:
+                cursor.updateRow(["EQ,FL"])
+
+        # within a phase the first fingerprint check stands
+        self.assertEqual(self.search("ISO2 = 'NL'"), [("NL", "FL")])
+        self.cache.new_phase()
+        self.assertEqual(self.search("ISO2 = 'NL'"), [("NL", "EQ,FL")])
+        self.assertEqual(self.cache.refreshes, 2)
+
+    def test_one_fingerprint_per_table_per_phase(self):
+        with mock.patch.object(self.backend, "table_fingerprint", wraps=self.backend.table_fingerprint) as fingerprint:
+            for where in ("ISO2 IN ('NL')", "ISO2 IN ('BE')", None):
+                self.search(where)
+            self.assertEqual(fingerprint.call_count, 1)
+
+            self.cache.new_phase()
+            self.search()
+            self.assertEqual(fingerprint.call_count, 2)
+
+    def test_recheck_looks_at_the_fingerprint_again(self):
+        self.search()
+        with self.backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            cursor.insertRow(["FR", "FL"])
+
+        self.cache.recheck(os.path.join("local.sde", "global_exposure.dbo.countryconfig"))
+        self.assertEqual(self.search("ISO2 = 'FR'"), [("FR", "FL")])
+        self.assertEqual(self.cache.refreshes, 2)
+
+    def test_written_table_is_read_from_the_server(self):
+        self.search()
+        self.cache.mark_written(os.path.join("local.sde", "global_exposure.dbo.countryconfig"))
+        with self.backend.update_cursor("COUNTRYCONFIG", ["Perils"], "ISO2 = 'NL'") as cursor:
+            for row in cursor:
+                cursor.updateRow(["EQ,FL"])
+        self.backend.reset_stats()
+
+        self.assertEqual(self.search("ISO2 = 'NL'"), [("NL", "EQ,FL")])
+        # no fingerprint and no refresh, just the filtered read
+        self.assertEqual((self.backend.stats["queries"], self.cache.refreshes), (1, 1))
+
+    def test_survives_reopen(self):
+        self.search()
+        self.cache.close()
+        self.cache = SnapshotCache(os.path.join(self.directory.name, "snapshots.sqlite"), self.backend)
+
+        self.search()
+        self.assertEqual((self.cache.refreshes, self.cache.hits), (0, 1))
+
+    def test_read_rows_without_cache_uses_cursor(self):
+        previous = set_snapshots(None)
+        try:
+            self.assertEqual(sorted(read_rows(self.table, ["ISO2"], backend=self.backend)), [("BE",), ("NL",)])
+        finally:
+            set_snapshots(previous)
+
+
+if __name__ == '__main__':
+    unittest.main()
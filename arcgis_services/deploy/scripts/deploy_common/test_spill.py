@@ -0,0 +1,41 @@
+import unittest
+
+from deploy_common.spill import SpillDict
+
+
+class TestSpillDict(unittest.TestCase):
+
+    def test_add_reports_new_keys_across_the_spill(self):
+        keys = SpillDict(max_keys=2)
+        self.addCleanup(keys.close)
+
+        self.assertEqual([keys.add(key) for key in [("a", "1"), ("b", "2"), ("a", "1")]], [True, True, False])
+        self.assertFalse(keys.spilled)
+        self.assertTrue(keys.add(("c", "3")))
+        self.assertTrue(keys.spilled)
+
+        self.assertEqual([keys.add(key) for key in [("a", "1"), ("c", "3"), ("d", "4")]], [False, False, True])
+        self.assertIn(("b", "2"), keys)
+        self.assertNotIn(("e", "5"), keys)
+        self.assertEqual(len(keys), 4)
+
+    def test_setdefault_keeps_the_first_value(self):
+        values = SpillDict(max_keys=1)
+        self.addCleanup(values.close)
+
+        self.assertEqual(values.setdefault("ipc", ("IPC", "intact")), ("IPC", "intact"))
+        values.setdefault("rsa", ("RSA", "rsa uk"))
+        self.assertTrue(values.spilled)
+        self.assertEqual(values.setdefault("ipc", ("IPC", "other")), ["IPC", "intact"])
+
+    def test_close_empties_it(self):
+        keys = SpillDict(max_keys=1)
+        keys.add("a")
+        keys.add("b")
+        keys.close()
+        self.assertEqual(len(keys), 0)
+        self.assertFalse(keys.spilled)
+
+
+if __name__ == '__main__':
+    unittest.main()
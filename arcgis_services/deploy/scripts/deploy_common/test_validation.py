@@ -0,0 +1,40 @@
+import unittest
+
+from deploy_common.validation import Problems, ValidationError, check_fields
+
+
+class TestProblems(unittest.TestCase):
+
+    def test_caps_each_kind(self):
+        problems = Problems(limit=2)
+        for n in range(5):
+            problems.add("too long", "value {0} too long".format(n))
+        problems.add("missing", "table missing")
+        self.assertEqual(problems.report(), ["value 0 too long", "value 1 too long", "table missing",
+                                             "... and 3 more: too long"])
+
+    def test_raises_everything_together(self):
+        problems = Problems()
+        problems.add("a", "first")
+        problems.add("b", "second")
+        with self.assertRaises(ValidationError) as raised:
+            problems.raise_if_any()
+        self.assertEqual(raised.exception.problems, ["first", "second"])
+
+    def test_nothing_to_raise(self):
+        Problems().raise_if_any()
+
+
+class TestCheckFields(unittest.TestCase):
+
+    def test_lengths_and_missing_fields(self):
+        problems = Problems()
+        check_fields(problems, "Lookup_Peril", {"CODE": 2, "Value": None}, {"Code": "EQX", "Value": "x" * 500, "Nope": 1})
+        self.assertEqual(problems.report(), [
+            "Lookup_Peril: Code 'EQX' is 3 characters, the field allows 2",
+            "Lookup_Peril has no Nope field",
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
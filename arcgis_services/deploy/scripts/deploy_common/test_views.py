@@ -0,0 +1,51 @@
+import unittest
+
+from deploy_common.backends import SqliteBackend, set_backend
+from deploy_common.views import ViewRegistry
+
+
+class TestViewRegistry(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["Peril", "ProducingOperation"])
+        self.previous = set_backend(self.backend)
+        self.views = ViewRegistry(max_views=2)
+
+    def tearDown(self):
+        set_backend(self.previous)
+
+    def test_one_view_per_table(self):
+        view = self.views.get("server.sde\\GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS")
+        self.assertEqual(self.views.get("SERVER.sde\\GLOBAL_EXPOSURE.dbo.domainlookups"), view)
+        self.assertNotEqual(self.views.get("other.sde\\GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS"), view)
+        self.assertEqual(set(self.backend.views), {view, self.views.get("other.sde\\GLOBAL_EXPOSURE.dbo.DOMAINLOOKUPS")})
+
+    def test_least_recently_used_view_is_deleted(self):
+        domains = self.views.get("DOMAINLOOKUPS")
+        peril = self.views.get("Lookup_Peril")
+        self.views.get("DOMAINLOOKUPS")
+        self.views.get("Lookup_ProducingOperation")
+
+        self.assertEqual(len(self.views), 2)
+        self.assertIn(domains, self.backend.views)
+        self.assertNotIn(peril, self.backend.views)
+
+        self.views.close()
+        self.assertEqual(self.backend.views, {})
+
+    def test_view_made_again_on_a_new_backend(self):
+        view = self.views.get("DOMAINLOOKUPS")
+        backend = SqliteBackend()
+        backend.create_schema()
+        set_backend(backend)
+        self.assertNotEqual(self.views.get("DOMAINLOOKUPS"), view)
+        self.assertEqual(len(backend.views), 1)
+
+    def test_missing_table_fails(self):
+        with self.assertRaises(RuntimeError):
+            self.views.get("Lookup_Nope")
+        self.assertEqual(len(self.views), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
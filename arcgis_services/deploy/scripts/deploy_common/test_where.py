@@ -0,0 +1,88 @@
+import unittest
+
+from deploy_common.backends import SqliteBackend
+from deploy_common.where import equals, in_clauses, match_clauses, quote, starts_with
+
+
+class TestQuote(unittest.TestCase):
+
+    def test_doubles_single_quotes(self):
+        self.assertEqual(quote("O'Brien"), "'O''Brien'")
+        self.assertEqual(equals("Value", "it's"), "Value = 'it''s'")
+
+    def test_starts_with_matches_wildcards_literally(self):
+        backend = SqliteBackend()
+        backend.create_schema(["ProducingOperation"])
+        with backend.insert_cursor("Lookup_ProducingOperation", ["Code"]) as cursor:
+            for code in ["A_1", "AB1", "a%2", "O'B"]:
+                cursor.insertRow([code])
+
+        def codes(prefix):
+            with backend.search_cursor("Lookup_ProducingOperation", ["Code"], starts_with("Code", prefix)) as cursor:
+                return sorted(row[0] for row in cursor)
+
+        self.assertEqual(codes("A_"), ["A_1"])
+        self.assertEqual(codes("A%"), ["a%2"])
+        self.assertEqual(codes("a"), ["AB1", "A_1", "a%2"])
+        self.assertEqual(codes("O'"), ["O'B"])
+
+
+class TestInClauses(unittest.TestCase):
+
+    def test_one_clause_for_few_values(self):
+        self.assertEqual(list(in_clauses("ISO2", ["NL", "BE", "NL"])), ["ISO2 IN ('NL','BE')"])
+
+    def test_chunks_on_value_count(self):
+        clauses = list(in_clauses("ISO2", ["A", "B", "C", "D", "E"], max_values=2))
+        self.assertEqual(clauses, ["ISO2 IN ('A','B')", "ISO2 IN ('C','D')", "ISO2 IN ('E')"])
+
+    def test_chunks_on_length(self):
+        clauses = list(in_clauses("Code", ["x" * 10] * 1 + ["y" * 10, "z" * 10], max_length=40))
+        self.assertTrue(all(len(clause) <= 40 for clause in clauses))
+        self.assertEqual(len(clauses), 2)
+
+    def test_empty(self):
+        self.assertEqual(list(in_clauses("ISO2", [])), [])
+
+
+class TestMatchClauses(unittest.TestCase):
+
+    def test_or_of_and_groups(self):
+        clauses = list(match_clauses(["Code", "Value"], [("A", "O'Brien"), ("B", "b")]))
+        self.assertEqual(clauses, ["(Code = 'A' AND Value = 'O''Brien') OR (Code = 'B' AND Value = 'b')"])
+
+    def test_value_limit_counts_every_field(self):
+        rows = [(str(i), str(i)) for i in range(5)]
+        clauses = list(match_clauses(["Code", "Value"], rows, max_values=4))
+        self.assertEqual([clause.count(" OR ") + 1 for clause in clauses], [2, 2, 1])
+
+    def test_repeats_dropped_within_a_clause_only(self):
+        rows = [("A", "a"), ("A", "a"), ("B", "b"), ("C", "c"), ("A", "a")]
+        clauses = list(match_clauses(["Code", "Value"], rows, max_values=4))
+        self.assertEqual(clauses, [
+            "(Code = 'A' AND Value = 'a') OR (Code = 'B' AND Value = 'b')",
+            "(Code = 'C' AND Value = 'c') OR (Code = 'A' AND Value = 'a')",
+        ])
+        self.assertEqual(list(match_clauses(["Code"], [("A",), ("a",), ("A",)])), ["Code IN ('A','a')"])
+
+    def test_mismatched_row(self):
+        with self.assertRaises(ValueError):
+            list(match_clauses(["Code", "Value"], [("A",)]))
+
+    def test_clauses_run_against_sqlite(self):
+        backend = SqliteBackend()
+        backend.create_schema(["ProducingOperation"])
+        with backend.insert_cursor("Lookup_ProducingOperation", ["Code", "Value"]) as cursor:
+            cursor.insertRow(["OBR", "O'Brien"])
+            cursor.insertRow(["IPC", "Intact"])
+
+        rows = [("obr", "o'brien"), ("RSA", "RSA UK")]
+        found = []
+        for where in match_clauses(["Code", "Value"], rows, max_values=2):
+            with backend.search_cursor("Lookup_ProducingOperation", ["Code"], where) as cursor:
+                found.extend(cursor)
+        self.assertEqual(found, [("OBR",)])
+
+
+if __name__ == '__main__':
+    unittest.main()
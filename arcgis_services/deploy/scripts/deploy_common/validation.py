@@ -0,0 +1,94 @@
+"""
+Up-front validation for the deploy scripts
+
+Each script checks every config section against the target schema before
+anything is written, collects every problem it finds, and raises them
+together in one ValidationError, so a typo in the last section stops the run
+before the first section has written a row.
+"""
+
+
+MAX_PROBLEMS_PER_CHECK = 20
+
+
+class ValidationError(Exception):
+    """
+    Raised with every problem found by a validation pass
+
+    :param problems: list of problem descriptions
+    """
+
+    def __init__(self, problems: list):
+        self.problems = list(problems)
+        super().__init__("{0} problem(s) found before writing anything: {1}".format(
+            len(self.problems), "; ".join(self.problems)))
+
+
+class Problems:
+    """
+    Collects problems, keeping at most MAX_PROBLEMS_PER_CHECK of each kind
+
+    A source file with thousands of over-length values reports the first few
+    and a count, rather than thousands of lines.
+    """
+
+    def __init__(self, limit: int = MAX_PROBLEMS_PER_CHECK):
+        self.limit = limit
+        self.problems = []
+        self.counts = {}
+
+    def add(self, kind: str, message: str) -> None:
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if self.counts[kind] <= self.limit:
+            self.problems.append(message)
+
+    def extend(self, problems) -> None:
+        for problem in problems:
+            self.add(problem, problem)
+
+    def __bool__(self):
+        return bool(self.counts)
+
+    def report(self) -> list:
+        """
+        The kept problems, plus a line per kind that went over the limit
+        """
+        overflow = ["... and {0} more: {1}".format(count - self.limit, kind)
+                    for kind, count in self.counts.items() if count > self.limit]
+        return self.problems + overflow
+
+    def raise_if_any(self) -> None:
+        if self:
+            raise ValidationError(self.report())
+
+
+def field_length(description: dict, field: str):
+    """
+    Max length of field from a backend describe() result, matched case-insensitively
+
+    :returns: length, None if the field has no length, KeyError if there is no such field
+    """
+    for name, length in description.items():
+        if name.lower() == field.lower():
+            return length
+    raise KeyError(field)
+
+
+def check_fields(problems: Problems, label: str, description: dict, values: dict) -> None:
+    """
+    Add a problem for every value that is longer than its field allows
+
+    :param label: table name and section to report the problem against
+    :param description: backend describe() result for the table
+    :param values: dict of field name -> value
+    """
+    for field, value in values.items():
+        try:
+            limit = field_length(description, field)
+        except KeyError:
+            problems.add("{0}: no {1} field".format(label, field), "{0} has no {1} field".format(label, field))
+            continue
+        if limit is not None and len(str(value)) > limit:
+            problems.add("{0}: {1} too long".format(label, field),
+                         "{0}: {1} '{2}' is {3} characters, the field allows {4}".format(
+                             label, field, value, len(str(value)), limit))
@@ -0,0 +1,124 @@
+"""
+Registry of the table views the deploy scripts write through
+
+Every MakeTableView is a round trip to SDE and the view then lives in the
+arcpy process's memory until it is deleted. The registry hands out one view
+per (workspace, table), so sections writing to the same table (DOMAINLOOKUPS
+on a server, say) share it instead of each making their own. Once more than
+max_views are open the least recently used one is deleted, and close()
+deletes the rest at the end of the run.
+"""
+import atexit
+import collections
+import itertools
+import logging
+import os
+
+from deploy_common.backends import get_backend
+from deploy_common.metrics import get_metrics
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_VIEWS = 16
+
+# view names are unique across every registry in the process
+_names = itertools.count(1)
+
+
+def view_key(in_table) -> tuple:
+    """
+    (workspace, table) for a table path, compared case-insensitively like the server does
+    """
+    workspace, table = os.path.split(str(in_table))
+    return workspace.lower(), table.lower()
+
+
+class ViewRegistry:
+    """
+    LRU cache of table views keyed on (workspace, table)
+
+    A view belongs to the backend that made it; if the process backend has
+    been swapped since, the view is made again on the new one.
+
+    :param max_views: views kept open at once, at least 1
+    """
+
+    def __init__(self, max_views: int = DEFAULT_MAX_VIEWS):
+        if max_views < 1:
+            raise ValueError("max_views must be at least 1, not {0}".format(max_views))
+        self.max_views = max_views
+        self._views = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._views)
+
+    def get(self, in_table, workspace=None) -> str:
+        """
+        View over in_table, made on first use
+
+        Fails the way MakeTableView does if in_table does not exist.
+
+        :returns: view name, to pass to cursors in place of the table path
+        """
+        backend = get_backend()
+        key = view_key(in_table)
+
+        if key in self._views:
+            view, owner = self._views[key]
+            if owner is backend:
+                self._views.move_to_end(key)
+                get_metrics().count("views_reused")
+                return view
+            del self._views[key]
+
+        view = "deploy_view_{0}".format(next(_names))
+        with get_metrics().timer("make_table_view"):
+            backend.make_table_view(in_table, view, workspace=workspace)
+        self._views[key] = (view, backend)
+
+        while len(self._views) > self.max_views:
+            _, (evicted, owner) = self._views.popitem(last=False)
+            self._delete(evicted, owner)
+
+        return view
+
+    def close(self) -> None:
+        """
+        Delete every view still open
+        """
+        while self._views:
+            _, (view, owner) = self._views.popitem(last=False)
+            self._delete(view, owner)
+
+    def _delete(self, view: str, backend) -> None:
+        try:
+            backend.delete(view)
+            get_metrics().count("views_deleted")
+        except Exception as e:
+            # a view that won't go away only costs memory, not worth failing a run over
+            logger.warning("Could not delete table view {0}: {1}".format(view, e))
+
+
+_views = None
+
+
+def get_views() -> ViewRegistry:
+    """
+    Registry shared by the whole process, closed at exit
+    """
+    global _views
+    if _views is None:
+        _views = ViewRegistry()
+        atexit.register(_views.close)
+    return _views
+
+
+def set_views(views: ViewRegistry) -> ViewRegistry:
+    """
+    Swap the process registry, eg. for one run, returning the previous one
+    """
+    global _views
+    previous = _views
+    _views = views
+    return previous
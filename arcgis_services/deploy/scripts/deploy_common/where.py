@@ -0,0 +1,99 @@
+"""
+Where clause builders for arcpy cursors
+
+Values are written as escaped SQL literals, so a code like O'Brien becomes
+'O''Brien' instead of ending the string early. Clauses matching many values
+or rows are split into chunks, each kept under MAX_VALUES literals (SQL
+Server refuses more than 2100 parameters once a statement is parameterised)
+and MAX_LENGTH characters, so a lookup over thousands of rows runs as a
+handful of queries instead of one per row.
+"""
+
+MAX_VALUES = 2000
+MAX_LENGTH = 30000
+
+
+def quote(value) -> str:
+    """
+    SQL literal for value, with embedded single quotes doubled
+    """
+    return "'{0}'".format(str(value).replace("'", "''"))
+
+
+def equals(field: str, value) -> str:
+    return "{0} = {1}".format(field, quote(value))
+
+
+def starts_with(field: str, prefix) -> str:
+    """
+    "field LIKE 'prefix%'", with the LIKE wildcards in prefix matched literally
+    """
+    for char in "\\%_[":
+        prefix = str(prefix).replace(char, "\\" + char)
+    return "{0} LIKE {1} ESCAPE '\\'".format(field, quote(prefix + "%"))
+
+
+def _chunks(terms, cost: int, joiner: str, max_values: int, max_length: int, unique: bool = False):
+    # unique drops a term already in the chunk being built; only one chunk's terms are held
+    chunk = []
+    seen = set()
+    length = 0
+    for term in terms:
+        if unique:
+            if term in seen:
+                continue
+            seen.add(term)
+        if chunk and (len(chunk) + 1 > max_values // cost or length + len(joiner) + len(term) > max_length):
+            yield chunk
+            chunk = []
+            seen = {term} if unique else seen
+            length = 0
+        length += len(term) + (len(joiner) if chunk else 0)
+        chunk.append(term)
+    if chunk:
+        yield chunk
+
+
+def in_clauses(field: str, values, max_values: int = MAX_VALUES, max_length: int = MAX_LENGTH):
+    """
+    Yield "field IN (...)" clauses that between them cover every distinct value
+
+    :param field: field to match on
+    :param values: iterable of values, duplicates are dropped
+    :param max_values: most literals in one clause
+    :param max_length: longest clause, in characters (a single huge value may still exceed it)
+    """
+    literals = (quote(value) for value in dict.fromkeys(values))
+    for chunk in _chunks(literals, 1, ",", max_values, max_length - len(field) - 6):
+        yield "{0} IN ({1})".format(field, ",".join(chunk))
+
+
+def match_clauses(fields: list, rows, max_values: int = MAX_VALUES, max_length: int = MAX_LENGTH):
+    """
+    Yield clauses matching any of rows on all of fields
+
+    SQL Server has no tuple IN, so multi-field rows become
+    (a = 'x' AND b = 'y') OR (...) groups; a single field becomes an IN clause.
+    Repeated rows are only dropped within a clause, so a large input is never
+    held in memory beyond one clause's worth, and a row repeated far apart can
+    be matched by two clauses.
+
+    :param fields: fields making up the match, in row order
+    :param rows: iterable of rows, each with one value per field
+    """
+    def groups():
+        for row in rows:
+            if len(row) != len(fields):
+                raise ValueError("Different number of fields ({0}) and values ({1})".format(len(fields), len(row)))
+            if len(fields) == 1:
+                yield quote(row[0])
+            else:
+                yield "({0})".format(" AND ".join(equals(field, value) for field, value in zip(fields, row)))
+
+    if len(fields) == 1:
+        for chunk in _chunks(groups(), 1, ",", max_values, max_length - len(fields[0]) - 6, unique=True):
+            yield "{0} IN ({1})".format(fields[0], ",".join(chunk))
+        return
+
+    for chunk in _chunks(groups(), len(fields), " OR ", max_values, max_length, unique=True):
+        yield " OR ".join(chunk)
@@ -0,0 +1,73 @@
+"""
+Drift check of COUNTRYCONFIG, DOMAINLOOKUPS and Lookup_* tables between environments
+
+Compares every table against the first environment given and prints the
+rows that differ (see deploy_common/drift.py). Exits 1 if any table drifted.
+
+Usage:
+    python drift_check.py --env staging=pnp_user@staging-sql/GLOBAL_EXPOSURE \\
+                          --env prod=pnp_user@prod-sql/GLOBAL_EXPOSURE \\
+                          --tables COUNTRYCONFIG DOMAINLOOKUPS Lookup_Peril
+
+Environments are user@server/database labels, connected through the shared
+pool (passwords as in deploy_common/connections.py), or .sde paths.
+"""
+import argparse
+import os
+import sys
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scripts_dir)
+
+from deploy_common.drift import DEFAULT_PREFIX_LENGTH, compare_table, describe_difference, table_fields
+from deploy_common.metrics import get_metrics
+from deploy_common.snapshot import source_workspace
+
+
+QUALIFIER = "GLOBAL_EXPOSURE.dbo."
+
+
+def environment(value: str) -> tuple:
+    name, separator, source = value.partition("=")
+    if not (separator and name and source):
+        raise argparse.ArgumentTypeError("expected NAME=user@server/database or NAME=path.sde, not {0}".format(value))
+    return name, source
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare the deploy tables between environments")
+    parser.add_argument("--env", type=environment, action="append", required=True, metavar="NAME=SOURCE",
+                        help="environment to compare, the first one is the reference")
+    parser.add_argument("--tables", nargs="+", default=["COUNTRYCONFIG", "DOMAINLOOKUPS"],
+                        help="tables to compare, eg. COUNTRYCONFIG DOMAINLOOKUPS Lookup_Peril")
+    parser.add_argument("--qualifier", default=QUALIFIER, help="prefix of the table names in every workspace")
+    parser.add_argument("--prefix-length", type=int, default=DEFAULT_PREFIX_LENGTH,
+                        help="key characters per partition; longer means smaller partitions to fetch when they differ")
+    parser.add_argument("--metrics-file", default=os.path.join(scripts_dir, "drift_metrics.jsonl"),
+                        help="JSON Lines file for phase timings and counters")
+    args = parser.parse_args(argv)
+
+    if len(args.env) < 2:
+        parser.error("give at least two --env to compare")
+
+    workspaces = {name: source_workspace(source) for name, source in args.env}
+    reference = args.env[0][0]
+
+    drifted = False
+    for table in args.tables:
+        key_fields, value_fields = table_fields(table)
+        tables = {name: os.path.join(workspace, args.qualifier + table) for name, workspace in workspaces.items()}
+        differences = compare_table(tables, key_fields, value_fields, args.prefix_length)
+
+        print("{0}: {1} difference(s) from {2}".format(table, len(differences), reference))
+        for difference in differences:
+            print("  " + describe_difference(table, reference, difference))
+        drifted = drifted or bool(differences)
+
+    get_metrics().flush(args.metrics_file)
+
+    return 1 if drifted else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import check_indexes
+import deploy
+import drift_check
+from deploy_common.backends import ArcpyBackend, SqliteBackend, set_backend
+from deploy_common.logs import stop_logging
+from deploy_common.metrics import get_metrics
+
+
+DOMAINS_CONFIG = """[add_prod_op]
+toolbox_path=ArcDatabaseSettings.pyt
+username=PNP_USER
+server=server
+database=GLOBAL_EXPOSURE
+domain_type=ProducingOperation
+values=Intact Personal Canada
+codes=IPC
+"""
+
+PERILS_CONFIG = """[connection]
+workspace=local.sde
+
+[add_perils]
+perils=FL
+countries_iso2_codes=NL
+include=true
+"""
+
+
+class TestDeployRunner(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = SqliteBackend()
+        self.backend.create_schema(["ProducingOperation"])
+        with self.backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            cursor.insertRow(["NL", "EQ"])
+        self.previous = set_backend(self.backend)
+        self.env = mock.patch.dict(os.environ, {"DEPLOY_PASSWORD_PNP_USER": "pw"})
+        self.env.start()
+
+        self.domains_config = self.write("domains.ini", DOMAINS_CONFIG)
+        self.perils_config = self.write("perils.ini", PERILS_CONFIG)
+
+    def tearDown(self):
+        self.env.stop()
+        set_backend(self.previous)
+        stop_logging()
+        self.directory.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def main(self, *argv):
+        return deploy.main(list(argv) + ["--metrics-file", os.path.join(self.directory.name, "metrics.jsonl"),
+                                         "--snapshot-cache", os.path.join(self.directory.name, "snapshots.sqlite"),
+                                         "--before-images", os.path.join(self.directory.name, "before_images.jsonl"),
+                                         "--log-dir", self.directory.name])
+
+    def test_both_stages_in_one_process(self):
+        metrics_file = os.path.join(self.directory.name, "metrics.jsonl")
+        get_metrics().counters.clear()  # left over from other tests that never flushed
+        exit_code = self.main("--domains-config", self.domains_config, "--perils-config", self.perils_config)
+        self.assertEqual(exit_code, 0)
+        with open(metrics_file) as f:
+            records = [json.loads(line) for line in f]
+        phases = {record.get("phase") for record in records}
+        self.assertTrue({"stage_domains", "stage_perils", "scan", "insert", "peril_bits"} <= phases)
+        counters = [record["counters"] for record in records if record["type"] == "counters"][-1]
+        # DOMAINLOOKUPS, Lookup_ProducingOperation and COUNTRYCONFIG copied down once each,
+        # hashing DOMAINLOOKUPS after the inserts reads it from the server
+        self.assertEqual((counters["snapshot_refreshes"], counters["snapshot_bypasses"]), (3, 1))
+        with self.backend.search_cursor("Lookup_ProducingOperation", ["Code"]) as cursor:
+            self.assertEqual(list(cursor), [("IPC",)])
+        with self.backend.search_cursor("COUNTRYCONFIG", ["Perils"]) as cursor:
+            self.assertEqual(list(cursor), [("EQ,FL",)])
+        self.assertEqual(len(self.backend.create_domains_calls), 1)
+        stop_logging()
+        for log_file in ("app.log", "update_country_peril.log"):
+            self.assertGreater(os.path.getsize(os.path.join(self.directory.name, log_file)), 0)
+
+    def test_failed_stage_sets_exit_code(self):
+        bad_config = self.write("bad.ini", DOMAINS_CONFIG.replace("ProducingOperation", "Nope"))
+        exit_code = self.main("--stages", "domains", "--domains-config", bad_config)
+        self.assertEqual(exit_code, 1)
+
+    def test_rerun_reads_unchanged_tables_from_snapshot(self):
+        argv = ["--domains-config", self.domains_config, "--perils-config", self.perils_config]
+        self.main(*argv)
+        # tables written by the first run are copied down again once
+        self.main(*argv)
+        self.backend.reset_stats()
+
+        self.assertEqual(self.main(*argv), 0)
+        with open(os.path.join(self.directory.name, "metrics.jsonl")) as f:
+            counters = [json.loads(line)["counters"] for line in f if '"counters"' in line][-1]
+        self.assertNotIn("snapshot_refreshes", counters)
+        # every read served locally, nothing left to write
+        self.assertEqual(self.backend.stats["cursor_opens"], 0)
+
+    def test_rollback_undoes_the_run(self):
+        self.main("--domains-config", self.domains_config, "--perils-config", self.perils_config)
+
+        self.assertEqual(self.main("--rollback", get_metrics().run_id), 0)
+
+        with self.backend.search_cursor("Lookup_ProducingOperation", ["Code"]) as cursor:
+            self.assertEqual(list(cursor), [])
+        with self.backend.search_cursor("DOMAINLOOKUPS", ["Code"]) as cursor:
+            self.assertEqual(list(cursor), [])
+        with self.backend.search_cursor("COUNTRYCONFIG", ["Perils"]) as cursor:
+            self.assertEqual(list(cursor), [("EQ",)])
+        # a second rollback of the same run is refused
+        self.assertEqual(self.main("--rollback", get_metrics().run_id), 1)
+
+
+class TestDriftCheck(unittest.TestCase):
+
+    def test_same_tables_do_not_drift(self):
+        backend = SqliteBackend()
+        backend.create_schema(["Peril"])
+        with backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            cursor.insertRow(["NL", "EQ"])
+        previous = set_backend(backend)
+        self.addCleanup(set_backend, previous)
+
+        with tempfile.TemporaryDirectory() as directory:
+            exit_code = drift_check.main([
+                "--env", "staging=staging.sde", "--env", "prod=prod.sde", "--tables", "COUNTRYCONFIG", "Lookup_Peril",
+                "--metrics-file", os.path.join(directory, "metrics.jsonl"),
+            ])
+        self.assertEqual(exit_code, 0)
+
+
+class TestIndexCheck(unittest.TestCase):
+
+    def test_check_only_fails_until_indexes_are_created(self):
+        backend = SqliteBackend()
+        backend.create_schema(["Peril"])
+        previous = set_backend(backend)
+        self.addCleanup(set_backend, previous)
+
+        with tempfile.TemporaryDirectory() as directory:
+            argv = ["--source", "prod.sde", "--tables", "COUNTRYCONFIG", "Lookup_Peril", "--repeat", "1",
+                    "--metrics-file", os.path.join(directory, "metrics.jsonl")]
+            self.assertEqual(check_indexes.main(argv + ["--check-only"]), 1)
+            self.assertEqual(check_indexes.main(argv), 0)
+            self.assertEqual(check_indexes.main(argv + ["--check-only"]), 0)
+        self.assertEqual(len(backend.list_indexes("Lookup_Peril")), 1)
+
+
+class TestArcpyBackendLaziness(unittest.TestCase):
+
+    def test_arcpy_not_imported_until_used(self):
+        with mock.patch.dict(sys.modules):
+            sys.modules.pop("arcpy", None)
+            ArcpyBackend()
+            self.assertNotIn("arcpy", sys.modules)
+
+    def test_toolbox_loaded_once(self):
+        fake_arcpy = mock.MagicMock()
+        with mock.patch.dict(sys.modules, {"arcpy": fake_arcpy}):
+            backend = ArcpyBackend()
+            backend.create_domains("ArcDatabaseSettings.pyt", "DOMAINLOOKUPS", "a.sde")
+            backend.create_domains("ArcDatabaseSettings.pyt", "DOMAINLOOKUPS", "b.sde")
+        fake_arcpy.AddToolbox.assert_called_once_with("ArcDatabaseSettings.pyt")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+"""
+Bitset form of COUNTRYCONFIG Perils for whole-table add/remove
+
+Every peril gets a bit in a PerilVocabulary, and PerilMatrix holds one
+bitmask per country. A config section then becomes one bitwise OR (include)
+or AND-NOT (exclude) over the rows it selects, instead of a set update per
+country and peril, and the new masks of all countries are worked out in a
+single step. Only the rows whose mask moved are turned back into strings.
+
+NumPy (shipped with ArcGIS Pro's Python) stores the masks as a countries x
+words uint64 array; without it they are plain Python ints, which behave the
+same, just one row at a time.
+"""
+from peril_index import split_perils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+WORD_BITS = 64
+WORD = (1 << WORD_BITS) - 1
+
+
+class PerilVocabulary:
+    """
+    Peril name <-> bit position, in the order perils are first seen
+    """
+
+    def __init__(self, perils=()):
+        self.bits = {}
+        self.perils = []
+        for peril in perils:
+            self.bit(peril)
+
+    def bit(self, peril):
+        """
+        Bit position of peril, adding it to the vocabulary if it is new
+        """
+        peril = peril.strip()
+        if peril not in self.bits:
+            self.bits[peril] = len(self.perils)
+            self.perils.append(peril)
+        return self.bits[peril]
+
+    def encode(self, perils):
+        """
+        Mask of an iterable of perils or a Perils string
+        """
+        if isinstance(perils, str) or perils is None:
+            perils = split_perils(perils)
+        mask = 0
+        for peril in perils:
+            mask |= 1 << self.bit(peril)
+        return mask
+
+    def decode(self, mask):
+        """
+        Perils in mask, sorted
+        """
+        perils = []
+        while mask:
+            low = mask & -mask
+            perils.append(self.perils[low.bit_length() - 1])
+            mask ^= low
+        return sorted(perils)
+
+    def canonical(self, mask):
+        """
+        Perils value of mask, as canonical_perils would write it
+        """
+        return ",".join(self.decode(mask))
+
+    def words(self):
+        """
+        uint64 words needed per mask
+        """
+        return max(1, -(-len(self.perils) // WORD_BITS))
+
+
+class PerilMatrix:
+    """
+    Current peril masks of every country, plus the pending adds and removes
+
+    :param index: PerilIndex of COUNTRYCONFIG to take the countries and their Perils from
+    :param use_numpy: store the masks in NumPy arrays, defaults to whether NumPy imports
+    """
+
+    def __init__(self, index, use_numpy=None):
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        self.countries = index.countries()
+        self.rows = {country: row for row, country in enumerate(self.countries)}
+        self.values = [index.perils(country) for country in self.countries]
+        self.vocabulary = PerilVocabulary()
+
+        masks = [self.vocabulary.encode(value) for value in self.values]
+        if self.use_numpy:
+            self.masks = self._array(masks)
+            self.to_add = numpy.zeros_like(self.masks)
+            self.to_remove = numpy.zeros_like(self.masks)
+        else:
+            self.masks = masks
+            self.to_add = [0] * len(masks)
+            self.to_remove = [0] * len(masks)
+
+    def add(self, perils, countries):
+        """
+        Add perils to countries: to_add |= perils, to_remove &= ~perils
+        """
+        rows, mask = self._select(perils, countries)
+        if self.use_numpy:
+            words = self._words(mask)
+            self.to_add[rows] |= words
+            self.to_remove[rows] &= ~words
+            return
+        for row in rows:
+            self.to_add[row] |= mask
+            self.to_remove[row] &= ~mask
+
+    def remove(self, perils, countries):
+        """
+        Remove perils from countries
+
+        Only the perils a country carries, or gets from an earlier add, are
+        marked for removal, so countries without them stay out of the plan.
+        """
+        rows, mask = self._select(perils, countries)
+        if self.use_numpy:
+            words = self._words(mask)
+            self.to_remove[rows] |= words & (self.masks[rows] | self.to_add[rows])
+            self.to_add[rows] &= ~words
+            return
+        for row in rows:
+            self.to_remove[row] |= mask & (self.masks[row] | self.to_add[row])
+            self.to_add[row] &= ~mask
+
+    def plan(self):
+        """
+        The pending changes in build_plan's form, for the countries that have any
+
+        :returns: dict of ISO2 -> (set of perils to add, set of perils to remove)
+        """
+        plan = {}
+        for row in self._touched():
+            to_add, to_remove = self._mask(self.to_add, row), self._mask(self.to_remove, row)
+            plan[self.countries[row]] = (set(self.vocabulary.decode(to_add)), set(self.vocabulary.decode(to_remove)))
+        return plan
+
+    def diff(self, countries):
+        """
+        Apply the pending changes of countries in one step: (masks | to_add) & ~to_remove
+
+        :returns: (dict of ISO2 -> (current perils string, new perils string) for the
+            countries that change, number of countries left as they are)
+        """
+        rows = sorted(self.rows[country] for country in countries if country in self.rows)
+        if self.use_numpy:
+            rows = numpy.array(rows, dtype=numpy.intp)
+            new = (self.masks[rows] | self.to_add[rows]) & ~self.to_remove[rows]
+            changed_at = numpy.flatnonzero((new != self.masks[rows]).any(axis=1))
+            changed = [(int(rows[i]), self._join(new[i])) for i in changed_at]
+        else:
+            new = [(row, (self.masks[row] | self.to_add[row]) & ~self.to_remove[row]) for row in rows]
+            changed = [(row, mask) for row, mask in new if mask != self.masks[row]]
+
+        diff = {
+            self.countries[row]: (self.values[row], self.vocabulary.canonical(mask))
+            for row, mask in changed
+        }
+        return diff, len(rows) - len(diff)
+
+    def _select(self, perils, countries):
+        mask = self.vocabulary.encode(perils)
+        rows = sorted({self.rows[country] for country in countries if country in self.rows})
+        if self.use_numpy:
+            self._widen()
+            rows = numpy.array(rows, dtype=numpy.intp)
+        return rows, mask
+
+    def _touched(self):
+        if self.use_numpy:
+            return [int(row) for row in numpy.flatnonzero((self.to_add | self.to_remove).any(axis=1))]
+        return [row for row, (to_add, to_remove) in enumerate(zip(self.to_add, self.to_remove)) if to_add or to_remove]
+
+    def _mask(self, masks, row):
+        return self._join(masks[row]) if self.use_numpy else masks[row]
+
+    def _array(self, masks):
+        words = self.vocabulary.words()
+        array = numpy.zeros((len(masks), words), dtype=numpy.uint64)
+        for row, mask in enumerate(masks):
+            array[row] = self._words(mask, words)
+        return array
+
+    def _words(self, mask, words=None):
+        words = words or self.masks.shape[1]
+        return numpy.array([(mask >> (WORD_BITS * word)) & WORD for word in range(words)], dtype=numpy.uint64)
+
+    @staticmethod
+    def _join(words):
+        mask = 0
+        for word, value in enumerate(words):
+            mask |= int(value) << (WORD_BITS * word)
+        return mask
+
+    def _widen(self):
+        """
+        Grow the arrays by a word when new perils no longer fit
+        """
+        extra = self.vocabulary.words() - self.masks.shape[1]
+        if extra > 0:
+            padding = numpy.zeros((len(self.countries), extra), dtype=numpy.uint64)
+            self.masks = numpy.hstack([self.masks, padding])
+            self.to_add = numpy.hstack([self.to_add, padding])
+            self.to_remove = numpy.hstack([self.to_remove, padding])
@@ -0,0 +1,72 @@
+"""
+Peril -> countries inverted index over COUNTRYCONFIG
+
+Built from one scan of the table (or its local snapshot), it answers "which
+countries have peril X" without splitting every Perils string again, and
+lets the update touch only the rows that carry a peril being removed.
+"""
+from deploy_common import snapshot
+
+
+def split_perils(perils_string):
+    """
+    Split a Perils value into a list of stripped, non-empty perils
+    """
+    return [p.strip() for p in (perils_string or "").split(",") if p.strip()]
+
+
+class PerilIndex:
+    """
+    :param rows: iterable of (ISO2, Perils) rows
+    """
+
+    def __init__(self, rows=()):
+        self.perils_by_country = {}
+        self.countries_by_peril = {}
+        for iso2, perils_string in rows:
+            self.set_perils(iso2, perils_string)
+
+    @classmethod
+    def build(cls, target_path, backend=None):
+        """
+        Index COUNTRYCONFIG with a single read
+
+        :param target_path: path to COUNTRYCONFIG
+        :param backend: CursorBackend to read through, defaults to the process backend
+        """
+        return cls(snapshot.read_rows(target_path, ["ISO2", "Perils"], backend=backend))
+
+    def set_perils(self, iso2, perils_string):
+        """
+        Index (or re-index, after an update) one country's Perils value
+        """
+        country = iso2.strip().upper()
+        for peril in split_perils(self.perils_by_country.get(country)):
+            self.countries_by_peril[peril].discard(country)
+        self.perils_by_country[country] = perils_string
+        for peril in split_perils(perils_string):
+            self.countries_by_peril.setdefault(peril, set()).add(country)
+
+    def countries(self):
+        """
+        Every ISO2 in COUNTRYCONFIG, sorted
+        """
+        return sorted(self.perils_by_country)
+
+    def countries_with(self, peril):
+        """
+        ISO2 codes of the countries whose Perils include peril, sorted
+        """
+        return sorted(self.countries_by_peril.get(peril.strip(), ()))
+
+    def has(self, country, peril):
+        return country in self.countries_by_peril.get(peril.strip(), ())
+
+    def perils(self, country):
+        """
+        Current Perils value of country as stored, or None if it is not in COUNTRYCONFIG
+        """
+        return self.perils_by_country.get(country.strip().upper())
+
+    def __contains__(self, country):
+        return country.strip().upper() in self.perils_by_country
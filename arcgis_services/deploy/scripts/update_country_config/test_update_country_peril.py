@@ -1,5 +1,18 @@
+import configparser
+import os
+import tempfile
+import threading
+import time
 import unittest
-from update_country_peril import UpdateCountryPeril
+from unittest import mock
+import update_country_peril
+from update_country_peril import UpdateCountryPeril, merge_perils
+from deploy_common.backends import LockTimeout, SqliteBackend, SqliteUpdateCursor
+from deploy_common.journal import read_records
+from deploy_common.logs import stop_logging
+import peril_bits
+from peril_bits import PerilMatrix, PerilVocabulary
+from peril_index import PerilIndex
 
 class TestCombineRemovePerils(unittest.TestCase):
     def setUp(self):
@@ -116,11 +129,385 @@ class TestCombineRemovePerils(unittest.TestCase):
         result = self.processor.remove_perils(to_remove, current)
         self.assertEqual(set(result.split(',')), {'EQ-1', 'FL2'})
 
+    def test_combine_perils_is_sorted_and_normalised(self):
+        result = self.processor.combine_perils([' ST', 'FL '], ['WS', 'EQ', '', 'FL'])
+        self.assertEqual(result, 'EQ,FL,ST,WS')
+
+    def test_remove_perils_is_sorted_and_normalised(self):
+        result = self.processor.remove_perils(['FL'], ['WS ', ' FL', 'EQ'])
+        self.assertEqual(result, 'EQ,WS')
+
     def test_remove_perils_nonexistent(self):
         to_remove = ['ST']
         current = ['EQ', 'FL']
         result = self.processor.remove_perils(to_remove, current)
         self.assertEqual(set(result.split(',')), {'EQ', 'FL'})
 
+
+class TestApplyPlan(unittest.TestCase):
+    def setUp(self):
+        # keep the processor's log out of the working folder
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(stop_logging)
+        log_file = mock.patch.object(update_country_peril, "default_log_file", os.path.join(directory.name, "update.log"))
+        log_file.start()
+        self.addCleanup(log_file.stop)
+
+        self.backend = SqliteBackend()
+        self.backend.create_schema()
+        with self.backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            cursor.insertRow(["NL", "EQ,NETHERLANDS_DIKE_RINGS"])
+            cursor.insertRow(["BE", "EQ"])
+            cursor.insertRow(["FR", "FL"])
+
+    def perils(self):
+        with self.backend.search_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+            return {row[0]: set(row[1].split(",")) - {""} for row in cursor}
+
+    def test_sections_merged_into_one_plan(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "add": {"perils": "FL,ST", "countries_iso2_codes": "NL,BE", "include": "true"},
+            "remove": {"perils": "NETHERLANDS_DIKE_RINGS,ST", "countries_iso2_codes": "NL", "include": "false"},
+        })
+        UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+        self.assertEqual(self.perils(), {"NL": {"EQ", "FL"}, "BE": {"EQ", "FL", "ST"}, "FR": {"FL"}})
+
+    def test_sections_applied_in_one_update_cursor_pass(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "add": {"perils": "ST", "countries_iso2_codes": "NL,BE,FR", "include": "true"},
+            "add_more": {"perils": "WS", "countries_iso2_codes": "FR", "include": "true"},
+            "remove": {"perils": "EQ", "countries_iso2_codes": "NL,BE", "include": "false"},
+        })
+        self.backend.reset_stats()
+        processor = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+        self.assertEqual(processor.summary, {"changed": 3, "skipped": 0})
+        # one read of COUNTRYCONFIG to plan, one UpdateCursor over ISO2 IN (...) for every section
+        self.assertEqual(self.backend.stats["cursor_opens"], 2)
+        self.assertEqual(self.perils(), {"NL": {"NETHERLANDS_DIKE_RINGS", "ST"}, "BE": {"ST"}, "FR": {"FL", "ST", "WS"}})
+
+    def test_dry_run_writes_nothing(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"add": {"perils": "FL", "countries_iso2_codes": "NL", "include": "true"}})
+        UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend, dry_run=True)
+        self.assertEqual(self.perils()["NL"], {"EQ", "NETHERLANDS_DIKE_RINGS"})
+
+    def test_commits_every_chunk(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"add": {"perils": "ST", "countries_iso2_codes": "NL,BE,FR", "include": "true"}})
+        self.backend.reset_stats()
+        UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend, chunk_size=2)
+        self.assertEqual(self.backend.stats["commits"], 3)  # two chunks plus the final save
+        self.assertEqual(self.perils()["FR"], {"FL", "ST"})
+
+    def test_unchanged_rows_are_not_written(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"add": {"perils": "EQ", "countries_iso2_codes": "NL,BE,FR", "include": "true"}})
+        self.backend.reset_stats()
+        processor = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+        self.assertEqual(processor.summary, {"changed": 1, "skipped": 2})
+        # the plan read, the chunk's update cursor select and a single UPDATE for FR
+        self.assertEqual(self.backend.stats["queries"], 3)
+        self.assertEqual(self.perils()["FR"], {"EQ", "FL"})
+
+    def test_resume_skips_committed_countries(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"add": {"perils": "ST", "countries_iso2_codes": "NL,BE,FR", "include": "true"}})
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        journal_path = os.path.join(directory.name, "journal.jsonl")
+
+        update_row = SqliteUpdateCursor.updateRow
+        calls = []
+
+        def flaky_update(cursor, row):
+            calls.append(row)
+            if len(calls) == 2:
+                raise RuntimeError("network blip")
+            return update_row(cursor, row)
+
+        with mock.patch.object(SqliteUpdateCursor, "updateRow", flaky_update):
+            failed = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend,
+                                        chunk_size=1, journal_path=journal_path)
+        self.assertTrue(failed.errors)
+
+        resumed = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend,
+                                     chunk_size=1, journal_path=journal_path, resume=True)
+
+        self.assertEqual(resumed.errors, [])
+        # BE went in before the failure and is not read again
+        self.assertEqual(resumed.summary, {"changed": 2, "skipped": 0})
+        self.assertEqual(self.perils(), {"NL": {"EQ", "NETHERLANDS_DIKE_RINGS", "ST"}, "BE": {"EQ", "ST"}, "FR": {"FL", "ST"}})
+        self.assertEqual(read_records(journal_path)[-1]["type"], "finish")
+
+    def test_resume_of_wildcard_removal_keeps_its_checkpoints(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"retire": {"perils": "EQ", "countries_iso2_codes": "*", "include": "false"}})
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        journal_path = os.path.join(directory.name, "journal.jsonl")
+
+        update_row = SqliteUpdateCursor.updateRow
+        calls = []
+
+        def flaky_update(cursor, row):
+            calls.append(row)
+            if len(calls) == 2:
+                raise RuntimeError("network blip")
+            return update_row(cursor, row)
+
+        with mock.patch.object(SqliteUpdateCursor, "updateRow", flaky_update):
+            failed = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend,
+                                        chunk_size=1, journal_path=journal_path)
+        self.assertTrue(failed.errors)
+
+        # BE no longer carries EQ, so the plan worked out from the table has shrunk
+        resumed = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend,
+                                     chunk_size=1, journal_path=journal_path, resume=True)
+
+        self.assertEqual(resumed.errors, [])
+        self.assertEqual(self.perils(), {"NL": {"NETHERLANDS_DIKE_RINGS"}, "BE": set(), "FR": {"FL"}})
+        records = [record for record in read_records(journal_path) if "scope" in record]
+        self.assertEqual([record["type"] for record in records], ["checkpoint", "checkpoint", "done"])
+        self.assertEqual(len({record["digest"] for record in records}), 1)
+
+    def test_wildcard_removal_touches_only_carriers(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"retire": {"perils": "NETHERLANDS_DIKE_RINGS", "countries_iso2_codes": "*", "include": "false"}})
+        self.backend.reset_stats()
+        processor = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+        self.assertEqual(processor.summary, {"changed": 1, "skipped": 0})
+        # one scan for the index, then only NL is selected and updated
+        self.assertEqual(self.backend.stats["queries"], 3)
+        self.assertEqual(self.perils()["NL"], {"EQ"})
+
+    def test_wildcard_removal_undoes_earlier_add(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "add": {"perils": "ST", "countries_iso2_codes": "FR", "include": "true"},
+            "retire": {"perils": "ST", "countries_iso2_codes": "*", "include": "false"},
+        })
+        processor = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend, dry_run=True)
+        self.assertEqual(processor.summary, {"changed": 0, "skipped": 1})
+
+    def test_region_groups(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "regions": {"benelux": "NL,BE"},
+            "add": {"perils": "ST", "countries_iso2_codes": "Benelux,FR", "include": "true"},
+        })
+        UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+        self.assertEqual({country for country, perils in self.perils().items() if "ST" in perils}, {"NL", "BE", "FR"})
+
+    def test_wildcard_needs_table(self):
+        processor = UpdateCountryPeril.__new__(UpdateCountryPeril)
+        with self.assertRaises(ValueError):
+            processor.expand_countries("*", {})
+
+    def test_config_problems_reported_together(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "regions": {"benelux": "NL,BE,LU"},
+            "add": {"perils": "ST", "countries_iso2_codes": "NL,XX", "include": "yes"},
+            "broken": {"perils": "FL"},
+        })
+        processor = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+        self.assertEqual(processor.errors, [
+            "[regions] benelux lists unknown ISO2 'LU'",
+            "[add] include must be true or false, not 'yes'",
+            "[add] unknown ISO2 or region 'XX'",
+            "[broken] is missing countries_iso2_codes, include",
+        ])
+        self.assertEqual(self.perils()["NL"], {"EQ", "NETHERLANDS_DIKE_RINGS"})
+
+    def test_over_length_perils_stop_the_write(self):
+        self.backend.create_table("COUNTRYCONFIG", ["ISO2", "Perils"], {"Perils": 10})
+        config = configparser.ConfigParser()
+        config.read_dict({"add": {"perils": "STORM_SURGE", "countries_iso2_codes": "BE,FR", "include": "true"}})
+        processor = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+        self.assertEqual(len(processor.errors), 2)
+        self.assertIn("COUNTRYCONFIG BE: Perils 'EQ,STORM_SURGE' is 14 characters", processor.errors[0])
+        self.assertEqual(self.perils()["BE"], {"EQ"})
+
+    def test_change_since_planning_is_merged_not_lost(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            "add": {"perils": "FL", "countries_iso2_codes": "NL,BE", "include": "true"},
+            "remove": {"perils": "NETHERLANDS_DIKE_RINGS", "countries_iso2_codes": "NL", "include": "false"},
+        })
+        validate_diff = UpdateCountryPeril.validate_diff
+
+        def other_deploy(processor, target_path, diff):
+            # another deploy commits between our read and our write
+            with self.backend.update_cursor("COUNTRYCONFIG", ["ISO2", "Perils"], "ISO2 IN ('NL', 'BE')") as cursor:
+                for row in cursor:
+                    row[1] = {"NL": "EQ,NETHERLANDS_DIKE_RINGS,ST", "BE": "EQ,FL"}[row[0]]
+                    cursor.updateRow(row)
+            return validate_diff(processor, target_path, diff)
+
+        with mock.patch.object(UpdateCountryPeril, "validate_diff", other_deploy):
+            processor = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+
+        self.assertEqual(processor.errors, [])
+        self.assertEqual(self.perils(), {"NL": {"EQ", "FL", "ST"}, "BE": {"EQ", "FL"}, "FR": {"FL"}})
+        self.assertEqual(processor.index.perils("BE"), "EQ,FL")
+
+    def test_merged_value_too_long_is_skipped_and_reported(self):
+        self.backend.create_table("COUNTRYCONFIG", ["ISO2", "Perils"], {"Perils": 12})
+        config = configparser.ConfigParser()
+        config.read_dict({"add": {"perils": "WS", "countries_iso2_codes": "BE,FR", "include": "true"}})
+        validate_diff = UpdateCountryPeril.validate_diff
+
+        def other_deploy(processor, target_path, diff):
+            # the planned 'EQ,WS' fits, merged onto this it is 14 characters
+            with self.backend.update_cursor("COUNTRYCONFIG", ["Perils"], "ISO2 = 'BE'") as cursor:
+                for row in cursor:
+                    cursor.updateRow(["EQ,FL,ST,WF"])
+            return validate_diff(processor, target_path, diff)
+
+        with mock.patch.object(UpdateCountryPeril, "validate_diff", other_deploy):
+            processor = UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+
+        self.assertEqual(len(processor.errors), 1)
+        self.assertIn("COUNTRYCONFIG BE: Perils 'EQ,FL,ST,WF,WS' is 14 characters", processor.errors[0])
+        self.assertEqual(processor.summary["changed"], 1)
+        self.assertEqual(self.perils(), {"NL": {"EQ", "NETHERLANDS_DIKE_RINGS"}, "BE": {"EQ", "FL", "ST", "WF"},
+                                         "FR": {"FL", "WS"}})
+
+    def test_write_holds_the_countryconfig_lock(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"add": {"perils": "FL", "countries_iso2_codes": "NL", "include": "true"}})
+        update_row = SqliteUpdateCursor.updateRow
+        refused = []
+
+        def locked_update(cursor, row):
+            try:
+                with self.backend.lock("local.sde", ["COUNTRYCONFIG"], timeout=0):
+                    pass
+            except LockTimeout:
+                refused.append(row[0])
+            update_row(cursor, row)
+
+        with mock.patch.object(SqliteUpdateCursor, "updateRow", locked_update):
+            UpdateCountryPeril(workspace="local.sde", config=config, backend=self.backend)
+
+        self.assertEqual(refused, ["NL"])
+        with self.backend.lock("local.sde", ["COUNTRYCONFIG"], timeout=0):
+            pass
+
+    def test_concurrent_deploys_both_land(self):
+        # two deploys with their own connections plan from the same NL row; the
+        # second reads and writes it only once the first has committed
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, "deploy.sqlite")
+            backend = SqliteBackend(database)
+            backend.create_schema()
+            with backend.insert_cursor("COUNTRYCONFIG", ["ISO2", "Perils"]) as cursor:
+                cursor.insertRow(["NL", "EQ"])
+            backend.connection.close()
+
+            first_writing = threading.Event()
+            update_row = SqliteUpdateCursor.updateRow
+            errors = []
+
+            def paused_update(cursor, row):
+                update_row(cursor, row)
+                if threading.current_thread().name == "first":
+                    first_writing.set()
+                    # without the lock the second deploy reads NL now, before this commits
+                    time.sleep(0.5)
+
+            def deploy(perils):
+                config = configparser.ConfigParser()
+                config.read_dict({"add": {"perils": perils, "countries_iso2_codes": "NL", "include": "true"}})
+                errors.extend(UpdateCountryPeril(workspace="local.sde", config=config,
+                                                 backend=SqliteBackend(database)).errors)
+
+            first = threading.Thread(target=deploy, args=["FL"], name="first")
+            second = threading.Thread(target=deploy, args=["ST"], name="second")
+            with mock.patch.object(SqliteUpdateCursor, "updateRow", paused_update):
+                first.start()
+                self.assertTrue(first_writing.wait(10))
+                second.start()
+                first.join()
+                second.join()
+
+            backend = SqliteBackend(database)
+            with backend.search_cursor("COUNTRYCONFIG", ["Perils"]) as cursor:
+                self.assertEqual([set(row[0].split(",")) for row in cursor], [{"EQ", "FL", "ST"}])
+            backend.connection.close()
+        self.assertEqual(errors, [])
+
+    def test_merge_perils(self):
+        self.assertEqual(merge_perils("EQ,FL", "EQ,ST", "EQ,FL,WF"), "EQ,ST,WF")
+        self.assertEqual(merge_perils("EQ", "EQ,FL", None), "FL")
+
+
+class TestPerilIndex(unittest.TestCase):
+
+    def test_which_countries_have_peril(self):
+        index = PerilIndex([("nl", "EQ, FL"), ("BE", "EQ"), ("FR", "")])
+        self.assertEqual(index.countries_with("EQ"), ["BE", "NL"])
+        self.assertEqual(index.countries_with("ST"), [])
+        self.assertEqual(index.countries(), ["BE", "FR", "NL"])
+
+    def test_set_perils_reindexes(self):
+        index = PerilIndex([("NL", "EQ,FL")])
+        index.set_perils("NL", "FL")
+        self.assertEqual(index.countries_with("EQ"), [])
+        self.assertEqual(index.perils("nl"), "FL")
+
+
+class TestPerilMatrix(unittest.TestCase):
+    use_numpy = False
+
+    def matrix(self, rows):
+        return PerilMatrix(PerilIndex(rows), use_numpy=self.use_numpy)
+
+    def test_sections_applied_in_order(self):
+        matrix = self.matrix([("NL", "EQ,NETHERLANDS_DIKE_RINGS"), ("BE", "EQ"), ("FR", "FL")])
+        matrix.add("FL,ST", ["NL", "BE"])
+        matrix.remove("NETHERLANDS_DIKE_RINGS,ST", ["NL"])
+        self.assertEqual(matrix.plan(), {"NL": ({"FL"}, {"NETHERLANDS_DIKE_RINGS", "ST"}), "BE": ({"FL", "ST"}, set())})
+        self.assertEqual(matrix.diff(["BE", "NL"]), ({
+            "BE": ("EQ", "EQ,FL,ST"),
+            "NL": ("EQ,NETHERLANDS_DIKE_RINGS", "EQ,FL"),
+        }, 0))
+
+    def test_removal_skips_countries_without_the_peril(self):
+        matrix = self.matrix([("NL", "EQ"), ("BE", "FL"), ("FR", "")])
+        matrix.add("ST", ["FR"])
+        matrix.remove("EQ,ST", ["NL", "BE", "FR"])
+        self.assertEqual(matrix.plan(), {"NL": (set(), {"EQ"}), "FR": (set(), {"ST"})})
+        self.assertEqual(matrix.diff(["FR", "NL"]), ({"NL": ("EQ", "")}, 1))
+
+    def test_only_changed_rows_are_decoded(self):
+        matrix = self.matrix([("NL", "FL, EQ"), ("BE", "EQ")])
+        matrix.add("EQ", ["NL", "BE", "XX"])
+        self.assertEqual(matrix.diff(["BE", "NL"]), ({}, 2))
+
+    def test_more_perils_than_a_word(self):
+        matrix = self.matrix([("NL", ",".join(f"P{i:03}" for i in range(60))), ("BE", "")])
+        added = [f"Q{i:03}" for i in range(10)]
+        matrix.add(",".join(added), ["BE", "NL"])
+        matrix.remove("P000,Q009", ["NL"])
+        diff, unchanged = matrix.diff(["BE", "NL"])
+        self.assertEqual(diff["BE"][1], ",".join(added))
+        self.assertEqual(diff["NL"][1].split(","), [f"P{i:03}" for i in range(1, 60)] + added[:-1])
+        self.assertEqual(matrix.vocabulary.words(), 2)
+
+    def test_vocabulary_round_trip(self):
+        vocabulary = PerilVocabulary(["ST", "EQ"])
+        self.assertEqual(vocabulary.encode(" EQ , FL"), 0b110)
+        self.assertEqual(vocabulary.canonical(0b111), "EQ,FL,ST")
+
+
+@unittest.skipIf(peril_bits.numpy is None, "NumPy is not installed")
+class TestPerilMatrixNumpy(TestPerilMatrix):
+    use_numpy = True
+
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -4,118 +4,521 @@ print("Starting update_country_peril.py.py")
 print("Importing dependencies")
 
 import configparser
-import arcpy
 import os
 import sys
 import logging.handlers
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
 from helpers import get_logger
+from deploy_common.backends import COUNTRYCONFIG, get_backend
+from deploy_common.before_images import DEFAULT_PATH as BEFORE_IMAGES_PATH, BeforeImages, get_before_images, set_before_images
+from deploy_common.connections import get_pool
+from deploy_common.journal import Journal, digest
+from deploy_common.metrics import get_metrics, profiled
+from deploy_common.plan import DEFAULT_CHUNK_SIZE, chunked, log_plan
+from deploy_common import snapshot
+from deploy_common.validation import Problems, ValidationError, check_fields
+from deploy_common.where import in_clauses
+from peril_bits import PerilMatrix
+from peril_index import PerilIndex, split_perils
 
 cconf_table = "GLOBAL_EXPOSURE.dbo.COUNTRYCONFIG"
+connection_section = "connection"
+regions_section = "regions"
+all_countries = "*"
+default_workspace = 'D:\\arcgisserver\\connections\\STAGING_GLOBAL_EXPOSURE_as_PNP_USER.sde'
+default_log_file = "update_country_peril.log"
 
-class UpdateCountryPeril:
-    __logger = {}
+def canonical_perils(perils_array):
+    """
+    Canonical Perils value: unique, whitespace-stripped, sorted and comma joined
+
+    Sorting makes the stored value deterministic, so re-running the same change
+    produces the same string and unchanged rows can be detected and skipped.
+    """
+    return ','.join(sorted({p.strip() for p in perils_array if p and p.strip()}))
 
-    def __init__(self):
-        self.__logger = logging.getLogger(__name__)
-        self.__logger.setLevel(logging.DEBUG)
-        script_file = os.path.basename(__file__)
-        formatter = logging.Formatter('%(asctime)s - {} - %(levelname)s - %(message)s'.format(script_file))
 
-        consoleHandler = logging.StreamHandler(sys.stdout)
-        consoleHandler.setLevel(logging.DEBUG)
-        consoleHandler.setFormatter(formatter)
+def merge_perils(planned_from, planned_to, current):
+    """
+    Three-way merge of a planned Perils change onto a value someone else has changed since
 
-        fileHandler = logging.handlers.RotatingFileHandler(filename="update_country_peril.log",maxBytes=1024000, backupCount=10, mode="a")
-        fileHandler.setLevel(logging.INFO)
-        fileHandler.setFormatter(formatter)
+    The perils the plan adds (in planned_to, not planned_from) are added to
+    current and the ones it removes are taken out; anything else in current,
+    eg. a peril another deploy added meanwhile, is kept.
 
-        self.__logger.addHandler(consoleHandler)
-        self.__logger.addHandler(fileHandler)
+    :returns: canonical Perils string
+    """
+    planned_from, planned_to = set(split_perils(planned_from)), set(split_perils(planned_to))
+    merged = (set(split_perils(current)) | (planned_to - planned_from)) - (planned_from - planned_to)
+    return canonical_perils(merged)
+
+
+class UpdateCountryPeril:
+    __logger = logging.getLogger(__name__)
+    backend = None
+    workspace = None
+    dry_run = False
+    chunk_size = DEFAULT_CHUNK_SIZE
+    journal = None
+    before_images = None
+    index = None
+    matrix = None
+
+    def __init__(self, workspace=None, config=None, backend=None, dry_run=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                 journal_path=None, resume=False, log_file=None):
+        """
+        Apply the peril changes in config to COUNTRYCONFIG
+
+        :param workspace: .sde connection to update, defaults to the [connection] section
+            of config, then to the staging connection
+        :param config: ConfigParser of peril sections, defaults to config/config.ini
+        :param backend: CursorBackend to go through, defaults to deploy_common.backends.get_backend()
+        :param dry_run: only log the planned changes, write nothing
+        :param chunk_size: countries per edit session commit
+        :param journal_path: journal every commit to this file (see deploy_common/journal.py)
+        :param resume: carry on from the last unfinished run in journal_path
+        :param log_file: file to log to, defaults to update_country_peril.log in the working folder
+
+        The Perils values it replaces are recorded in the process's before-images
+        file, if it has one (see deploy_common/before_images.py).
+        """
+        self.backend = backend
+        self.dry_run = dry_run
+        self.chunk_size = chunk_size
+        self.errors = []
+        self.summary = {"changed": 0, "skipped": 0}
+        self.__logger = get_logger(__name__, log_file or default_log_file, os.path.basename(__file__))
 
         self.__logger.info("Start")
-        self.__logger.info(arcpy.GetMessages())
+        self.__logger.info(self.get_backend().get_messages())
 
-        config = self.read_config_ini()
+        if config is None:
+            config = self.read_config_ini()
 
         try:
-            #TODO:Create the connection on the fly? db server, user password... this will  fail in prod & preprod or run on db servers?
-            #workspace = r"C:\Users\S01397\Code\arcgisserver\connections\STAGING_GLOBAL_EXPOSURE_as_PNP_USER.sde"
-            workspace = 'D:\\arcgisserver\\connections\\STAGING_GLOBAL_EXPOSURE_as_PNP_USER.sde'
-            
+            if workspace is None:
+                workspace = self.resolve_workspace(config)
+            self.workspace = workspace
+
             target_path = os.path.join(workspace, cconf_table)
             self.__logger.info("Target table: {}".format(target_path))
 
-            for config_key_arg in config:
-                if config_key_arg == 'DEFAULT':
-                    continue
-            
-                perils = config[config_key_arg]["perils"]
-                countries_iso2_codes = config[config_key_arg]["countries_iso2_codes"]
-                add = config[config_key_arg]["include"]
+            self.validate_config(config, target_path)
+
+            if journal_path and not dry_run:
+                self.journal = Journal.start(journal_path, resume)
+
+            self.before_images = get_before_images()
+            if self.before_images is not None and self.journal is not None:
+                self.before_images = self.before_images.for_run(self.journal.run_id)
+
+            plan = self.build_plan(config, target_path)
+            self.summary = self.apply_plan(target_path, plan, self.config_digest(config))
+
+            if self.journal is not None and not self.errors:
+                self.journal.finish()
 
-                if add.lower() == "true":
-                    self.AddPerils(target_path, perils, countries_iso2_codes)                        
-                else:
-                    self.RemovePerils(target_path, perils, countries_iso2_codes)
+        except ValidationError as e:
+            for problem in e.problems:
+                self.__logger.error(f"Validation: {problem}")
+            self.errors.extend(e.problems)
 
         except Exception as e:
             self.__logger.error(e)
+            self.errors.append(str(e))
+
+    def build_plan(self, config, target_path):
+        """
+        Merge every config section into a single add/remove plan per ISO2
+
+        Sections are applied in file order, so a peril added by one section and
+        removed by a later one ends up removed (and vice versa).
+
+        countries_iso2_codes may name groups from the [regions] section, or be *
+        for every country in COUNTRYCONFIG. COUNTRYCONFIG is indexed once (see
+        peril_index.py), each section is applied to the whole table as one
+        bitwise step (see peril_bits.py) and removals only touch the countries
+        that carry the peril.
+
+        :param config: ConfigParser with one section per peril change
+        :param target_path: path to COUNTRYCONFIG
+        :returns: dict of ISO2 -> (set of perils to add, set of perils to remove)
+        """
+        regions = self.read_regions(config)
+        matrix = self.peril_matrix(target_path)
+
+        for config_key_arg in config:
+            if config_key_arg in ('DEFAULT', connection_section, regions_section):
+                continue
+
+            perils = config[config_key_arg]["perils"]
+            countries_iso2_codes = config[config_key_arg]["countries_iso2_codes"]
+            add = config[config_key_arg]["include"]
+
+            countries = self.expand_countries(countries_iso2_codes, regions, self.index)
+            if add.lower() == "true":
+                matrix.add(perils, countries)
+            else:
+                matrix.remove(perils, countries)
+
+        return matrix.plan()
+
+    @staticmethod
+    def config_digest(config):
+        """
+        Digest of the peril sections and regions, in file order, to journal the run against
+
+        Taken from the config rather than the plan, because the plan is worked
+        out from COUNTRYCONFIG's current state and shrinks as a run commits, so
+        a resumed run would not recognise its own checkpoints.
+        """
+        return digest([[name, dict(config[name])] for name in config if name not in ('DEFAULT', connection_section)])
+
+    def validate_config(self, config, target_path):
+        """
+        Check every section before anything is written, raising all problems together
+
+        Catches missing options, include values other than true/false, sections
+        without perils and ISO2 codes (direct or in a region) that are not in
+        COUNTRYCONFIG.
+
+        :raises ValidationError: listing every problem found
+        """
+        problems = Problems()
+
+        with get_metrics().timer("validate"):
+            if self.get_backend().describe(target_path) is None:
+                raise ValidationError([f"{target_path} does not exist"])
+
+            regions = self.read_regions(config)
+            index = self.peril_index(target_path)
+
+            for name, codes in regions.items():
+                for code in codes:
+                    if code not in index:
+                        problems.add(f"[{regions_section}] unknown ISO2",
+                                     f"[{regions_section}] {name} lists unknown ISO2 '{code}'")
+
+            for config_key_arg in config:
+                if config_key_arg in ('DEFAULT', connection_section, regions_section):
+                    continue
+                section = config[config_key_arg]
+
+                missing = [option for option in ("perils", "countries_iso2_codes", "include") if option not in section]
+                if missing:
+                    problems.add(f"[{config_key_arg}] missing", f"[{config_key_arg}] is missing {', '.join(missing)}")
+                    continue
+
+                if section["include"].strip().lower() not in ("true", "false"):
+                    problems.add(f"[{config_key_arg}] include",
+                                 f"[{config_key_arg}] include must be true or false, not '{section['include']}'")
+                if not split_perils(section["perils"]):
+                    problems.add(f"[{config_key_arg}] perils", f"[{config_key_arg}] lists no perils")
+
+                for code in section["countries_iso2_codes"].split(","):
+                    code = code.strip()
+                    if code and code != all_countries and code.lower() not in regions and code.upper() not in index:
+                        problems.add(f"[{config_key_arg}] unknown ISO2",
+                                     f"[{config_key_arg}] unknown ISO2 or region '{code}'")
+
+        problems.raise_if_any()
+
+    def validate_diff(self, target_path, diff):
+        """
+        Check every new Perils value fits the field before any is written
+
+        :raises ValidationError: listing every country whose value is too long
+        """
+        problems = Problems()
+        description = self.get_backend().describe(target_path) or {}
+        for country, (_, new_perils_string) in sorted(diff.items()):
+            check_fields(problems, f"COUNTRYCONFIG {country}", description, {"Perils": new_perils_string})
+        problems.raise_if_any()
+
+    @staticmethod
+    def read_regions(config):
+        """
+        Named country groups from the optional [regions] section, eg. benelux = NL,BE,LU
+
+        :returns: dict of lower case region name -> list of ISO2 codes
+        """
+        if not config.has_section(regions_section):
+            return {}
+        return {
+            name.lower(): [code.strip().upper() for code in codes.split(",") if code.strip()]
+            for name, codes in config.items(regions_section, raw=True)
+            if name not in config.defaults()
+        }
+
+    def expand_countries(self, countries_iso2_codes, regions, index=None):
+        """
+        Turn a countries_iso2_codes value into ISO2 codes, expanding region names and *
+
+        :param index: PerilIndex of COUNTRYCONFIG, needed to expand *
+        """
+        countries = []
+        for code in countries_iso2_codes.split(","):
+            code = code.strip()
+            if not code:
+                continue
+            if code == all_countries:
+                if index is None:
+                    raise ValueError("countries_iso2_codes=* needs COUNTRYCONFIG to expand")
+                countries.extend(index.countries())
+            elif code.lower() in regions:
+                countries.extend(regions[code.lower()])
+            else:
+                countries.append(code.upper())
+        return countries
+
+    def peril_index(self, target_path):
+        """
+        PerilIndex of COUNTRYCONFIG, built with one read the first time it is needed
+        """
+        if self.index is None:
+            with get_metrics().timer("peril_index"):
+                self.index = PerilIndex.build(target_path, self.get_backend())
+        return self.index
+
+    def peril_matrix(self, target_path):
+        """
+        New PerilMatrix of COUNTRYCONFIG's current Perils, which diff_plan then works from
+        """
+        self.matrix = PerilMatrix(self.peril_index(target_path))
+        return self.matrix
+
+    @staticmethod
+    def resolve_workspace(config):
+        """
+        Workspace from the optional [connection] section, through the shared connection pool
+
+        The section takes either workspace=<path to .sde> or server, database and username.
+        """
+        if not config.has_section(connection_section):
+            return default_workspace
+
+        connection = config[connection_section]
+        if "workspace" in connection:
+            return connection["workspace"]
+
+        return get_pool().get(connection["server"], connection["database"], connection["username"])
+
+    def apply_plan(self, target_path, plan, plan_digest=None):
+        """
+        Apply a plan from build_plan (or the PerilMatrix of AddPerils/RemovePerils):
+        log the diff, then (unless this is a dry run) write it in chunked edit sessions
+
+        Countries whose canonical Perils value would not change are not written.
+
+        :param plan_digest: digest the journal records the run under, see config_digest;
+            defaults to a digest of the plan itself
+        :returns: dict with the number of rows changed and unchanged rows skipped
+        """
+        summary = {"changed": 0, "skipped": 0}
+        if not plan:
+            self.__logger.info("No peril changes to apply")
+            return summary
+
+        scope = "perils:{0}:COUNTRYCONFIG".format(snapshot.source_label(os.path.dirname(target_path)))
+        if plan_digest is None:
+            plan_digest = digest({country: [sorted(to_add), sorted(to_remove)] for country, (to_add, to_remove) in plan.items()})
+        if self.journal is not None:
+            if self.journal.is_done(scope, plan_digest):
+                self.__logger.info(f"COUNTRYCONFIG already updated in run {self.journal.run_id}, skipping")
+                return summary
+            confirmed = self.confirmed_countries(scope, plan_digest)
+            if confirmed:
+                self.__logger.info(f"Resuming: {len(confirmed)} country(ies) already committed in run {self.journal.run_id}")
+                plan = {country: entry for country, entry in plan.items() if country not in confirmed}
 
-    def AddPerils(self, target_path, perils, countries_iso2_codes):
         try:
-            incoming_perils_array = perils.split(",")
-
-            for country in countries_iso2_codes.split(","):
-                fields = ['ISO2', 'Perils']
-                with arcpy.da.UpdateCursor(in_table=target_path, field_names=fields, where_clause="ISO2 = '{0}'".format(country)) as cursor: 
-                    for row in cursor:
-                        current_perils_array = row[1].split(",")
-                        new_perils_string = self.combine_perils(incoming_perils_array, current_perils_array)
-                        self.__logger.info(f"Updating {country} perils to add {new_perils_string}")  
-                        row[1] = new_perils_string
-                        cursor.updateRow(row)    
-   
-     
+            diff, summary["skipped"] = self.diff_plan(plan)
+            summary["changed"] = len(diff)
+            get_metrics().count("perils_unchanged", summary["skipped"])
+            log_plan("COUNTRYCONFIG Perils", [
+                f"~ {country}: '{current}' -> '{new}'" for country, (current, new) in sorted(diff.items())
+            ], self.__logger)
+
+            self.validate_diff(target_path, diff)
+
+            if self.dry_run:
+                self.__logger.info("Dry run, nothing written")
+            else:
+                failed = self.apply_diff(target_path, diff, scope, plan_digest)
+                summary["changed"] -= len(failed)
+                get_metrics().count("perils_changed", summary["changed"])
+                # a run with failed countries is not done, so running it again retries them
+                if self.journal is not None and not failed:
+                    self.journal.done(scope, plan_digest, **summary)
+
+            self.__logger.info("COUNTRYCONFIG: {changed} row(s) changed, {skipped} unchanged row(s) skipped".format(**summary))
+
+        except ValidationError:
+            raise
+
         except Exception as e:
-            self.__logger.error(f"AddPerils error - {e}")
+            self.__logger.error(f"apply_plan error - {e}")
+            self.errors.append(f"apply_plan error - {e}")
+
+        return summary
+
+    def diff_plan(self, plan):
+        """
+        Work out the new Perils of every country in plan, in one step over the
+        PerilMatrix the plan was built on
+
+        :returns: (dict of ISO2 -> (current perils string, new perils string) for the
+            countries that change, number of countries left as they are)
+        """
+        with get_metrics().timer("peril_bits"):
+            return self.matrix.diff(plan)
+
+    def confirmed_countries(self, scope, plan_digest):
+        """
+        Countries the journaled run already committed for this plan
+        """
+        confirmed = set()
+        for record in self.journal.records(scope, plan_digest):
+            confirmed.update(record.get("countries", []))
+        return confirmed
+
+    def apply_diff(self, target_path, diff, scope=None, plan_digest=None):
+        """
+        Write the new Perils values from diff_plan, committing every chunk_size countries
+
+        Each commit is journaled with the countries it wrote, when there is a journal,
+        and the values it replaced are recorded as before-images just ahead of it.
+
+        The write holds the deploys' COUNTRYCONFIG lock (see CursorBackend.lock),
+        so a concurrent deploy can't change a row between it being read here and
+        written back. A row whose Perils no longer holds the value the plan was
+        worked out from was changed after planning, by an earlier deploy or by
+        hand, and the planned change is merged onto its current value (see
+        merge_perils) instead of overwriting it. A merged value that does not
+        fit the field is not written; the country is reported in self.errors
+        and left out of the journal's checkpoints.
+
+        :returns: list of the countries that failed
+        """
+        backend = self.get_backend()
+        fields = ['ISO2', 'Perils']
+        workspace = self.workspace or os.path.dirname(target_path)
+        description = backend.describe(target_path) or {}
+        committed = 0
+        failed = []
+
+        if diff:
+            snapshot.mark_written(target_path)
+
+        with backend.lock(workspace, [COUNTRYCONFIG]), get_metrics().timer("peril_write"), \
+                backend.edit_session(workspace) as session:
+            for countries in chunked(sorted(diff), self.chunk_size):
+                replaced = {}
+                after = {}
+                for where in in_clauses("ISO2", countries):
+                    with backend.update_cursor(target_path, fields, where_clause=where) as cursor:
+                        for row in cursor:
+                            country = row[0].strip().upper()
+                            planned_from, new_perils_string = diff[country]
+                            if row[1] != planned_from:
+                                new_perils_string = merge_perils(planned_from, new_perils_string, row[1])
+                                self.__logger.warning(f"{country} perils changed to '{row[1]}' since they were read, "
+                                                      f"merging the planned change onto them")
+                                get_metrics().count("perils_conflicts")
+                                if new_perils_string == canonical_perils(split_perils(row[1])):
+                                    after[country] = row[1]
+                                    continue
+                                problems = Problems()
+                                check_fields(problems, f"COUNTRYCONFIG {country}", description,
+                                             {"Perils": new_perils_string})
+                                if problems:
+                                    for problem in problems.report():
+                                        self.__logger.error(f"apply_diff error - {problem}")
+                                        self.errors.append(f"apply_diff error - {problem}")
+                                    failed.append(country)
+                                    continue
+                            self.__logger.info(f"Updating {country} perils to {new_perils_string}")
+                            replaced[country] = row[1]
+                            after[country] = new_perils_string
+                            row[1] = new_perils_string
+                            cursor.updateRow(row)
+                if self.before_images is not None:
+                    self.before_images.updated(target_path, "ISO2", "Perils", replaced)
+                session.commit()
+                if self.index is not None:
+                    for country, perils_string in after.items():
+                        self.index.set_perils(country, perils_string)
+                if self.journal is not None:
+                    committed += len(countries)
+                    self.journal.checkpoint(scope, plan_digest, committed,
+                                            countries=[country for country in countries if country not in failed])
+
+        return failed
+
+    def get_backend(self):
+        return self.backend or get_backend()
+
+    def AddPerils(self, target_path, perils, countries_iso2_codes):
+        matrix = self.peril_matrix(target_path)
+        matrix.add(perils, self.expand_countries(countries_iso2_codes, {}, self.index))
+        self.apply_plan(target_path, matrix.plan())
 
     def combine_perils(self, incoming_perils_array, current_perils_array):
-        new_perils_array = list(set(incoming_perils_array + current_perils_array))
-        new_perils_string = ','.join(new_perils_array)
-        return new_perils_string
+        return canonical_perils(incoming_perils_array + current_perils_array)
 
     def RemovePerils(self, target_path, perils, countries_iso2_codes):
-        try:
-            perils_to_remove_array = perils.split(",")
-
-            for country in countries_iso2_codes.split(","):
-                        
-                fields = ['ISO2', 'Perils']
-                with arcpy.da.UpdateCursor(in_table=target_path, field_names=fields, where_clause="ISO2 = '{0}'".format(country)) as cursor: 
-                    for row in cursor:
-                        current_perils_array = row[1].split(",")
-                        new_perils_string = self.remove_perils(perils_to_remove_array, current_perils_array)
-                        self.__logger.info(f"Updating {country} perils to  {new_perils_string}")    
-                        row[1] = new_perils_string
-                        cursor.updateRow(row)      
- 
-                                    
-        except Exception as e:
-            self.__logger.error(f"Remove error - {e}")
+        matrix = self.peril_matrix(target_path)
+        matrix.remove(perils, self.expand_countries(countries_iso2_codes, {}, self.index))
+        self.apply_plan(target_path, matrix.plan())
 
     def remove_perils(self, perils_to_remove_array, current_perils_array):
-        new_perils_array = list(set(current_perils_array) - set(perils_to_remove_array))
-        new_perils_string = ','.join(new_perils_array)
-        return new_perils_string
+        perils_to_remove = {p.strip() for p in perils_to_remove_array}
+        return canonical_perils(p for p in current_perils_array if p.strip() not in perils_to_remove)
 
-    def read_config_ini(self):
+    @staticmethod
+    def read_config_ini():
         path = os.path.dirname(os.path.realpath(__file__))
-        config_ini_path = os.path.join(path, "config\config.ini")
+        config_ini_path = os.path.join(path, "config", "config.ini")
         config = configparser.ConfigParser()
         # config.optionxform = str  # Case sensitive config values
         config.read(config_ini_path)
         return config
 
 if __name__ == "__main__":
-    processor = UpdateCountryPeril()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Add/remove perils in COUNTRYCONFIG from config/config.ini")
+    parser.add_argument("--plan", action="store_true", help="dry run: print the Perils changes and stop")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="countries per edit session commit")
+    parser.add_argument("--metrics-file", default="update_country_peril_metrics.jsonl", help="JSON Lines file for phase timings")
+    parser.add_argument("--profile", help="write cProfile stats for the whole run to this file")
+    parser.add_argument("--snapshot-cache", default=snapshot.DEFAULT_PATH,
+                        help="local SQLite snapshot of COUNTRYCONFIG used while planning")
+    parser.add_argument("--no-snapshot-cache", action="store_true", help="always read COUNTRYCONFIG from the server")
+    parser.add_argument("--resume", action="store_true", help="carry on from the last run that did not finish")
+    parser.add_argument("--journal", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "journal.jsonl"),
+                        help="operation journal used by --resume")
+    parser.add_argument("--which-countries", metavar="PERIL", help="print the countries that have PERIL and stop")
+    parser.add_argument("--before-images", default=BEFORE_IMAGES_PATH,
+                        help="file the replaced Perils values are recorded in, for deploy.py --rollback")
+    args = parser.parse_args()
+
+    if not args.no_snapshot_cache:
+        snapshot.set_snapshots(snapshot.SnapshotCache(args.snapshot_cache))
+    set_before_images(BeforeImages(args.before_images))
+
+    if args.which_countries:
+        workspace = UpdateCountryPeril.resolve_workspace(UpdateCountryPeril.read_config_ini())
+        index = PerilIndex.build(os.path.join(workspace, cconf_table))
+        print(",".join(index.countries_with(args.which_countries)))
+        sys.exit(0)
+
+    with profiled(args.profile), get_metrics().timer("run"):
+        processor = UpdateCountryPeril(dry_run=args.plan, chunk_size=args.chunk_size,
+                                       journal_path=args.journal, resume=args.resume)
+
+    get_metrics().flush(args.metrics_file)
+
+    sys.exit(1 if processor.errors else 0)